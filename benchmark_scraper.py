@@ -0,0 +1,672 @@
+'''
+Offline benchmark of the scraper against a local fixture site, so that throughput can be compared run-to-run
+without touching autotrader.
+
+The fixture site mimics the parts of the real pages the scraper depends on:
+- search results: data-cmp="resultsCount", /cars-for-sale/vehicle/{id} links that keep loading as you scroll
+- vehicle listing: heading, listingPrice, VIN, listColumns, seeMore, responsiveImage,
+  and a "View All Media" modal whose modalScrollPanel lazily loads images as it is scrolled;
+  plus a json-ld block with the same data, for the browser-free http backend
+
+usage:
+    python benchmark_scraper.py --n-listings 10
+    python benchmark_scraper.py --n-listings 10000 --skip-browser   # compile functions only
+'''
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import psutil
+import pandas as pd
+
+import find_vehicle_image_urls as fviu
+from scraper_metrics import metrics
+
+
+####################################
+### Settings
+images_per_listing = 30
+lazy_load_delay_ms = 50  # how long the fixture pages take to "fetch" more content after a scroll
+fixture_image_kb = 40  # served image size, roughly a 500px listing photo
+lean_comparison_listings = 20  # listings loaded with each of the regular / lean driver
+parity_listings = 10  # listings loaded with both the http and the selenium backend, to compare their output
+tab_comparison_listings = 20  # listings loaded with one tab and with tabs_per_browser tabs in one browser
+planner_page_loads = 300  # simulated search results page loads per strategy in bench_search_planner
+####################################
+
+## smallest valid jpeg, served (padded) for every image on the fixture site
+jpeg_bytes = base64.b64decode(
+    '/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAP//////////////////////////////////////////////////////////////////////////'
+    '////////////wgALCAABAAEBAREA/8QAFBABAAAAAAAAAAAAAAAAAAAAAP/aAAgBAQABPxA='
+)
+first_vehicle_id = 700000000
+
+
+def fixture_vehicle_ids(n_listings:int) -> list:
+    return [first_vehicle_id + i for i in range(n_listings)]
+
+
+def fixture_image_hash(vehicle_id:int, k:int) -> str:
+    return hashlib.md5(f'{vehicle_id}-{k}'.encode()).hexdigest()
+
+
+def search_page_html(vehicle_ids:list, first_record:int, total:int) -> str:
+    page_ids = vehicle_ids[first_record:first_record + fviu.search_page_size]
+    return f'''<!DOCTYPE html>
+<html><head><title>fixture search results</title></head>
+<body>
+<div data-cmp="resultsCount">{total:,} Results</div>
+<div id="listings"></div>
+<script>
+var ids = {json.dumps(page_ids)};
+var rendered = 0;
+function render(n) {{
+    var container = document.getElementById('listings');
+    for (var k = 0; k < n && rendered < ids.length; k++, rendered++) {{
+        var card = document.createElement('div');
+        card.style.height = '220px';
+        card.innerHTML = '<a href="/cars-for-sale/vehicle/' + ids[rendered] + '">Used 2021 Ford F150 XLT ' + ids[rendered] + '</a>';
+        container.appendChild(card);
+    }}
+}}
+render(8);
+window.addEventListener('scroll', function () {{
+    if (window.innerHeight + window.scrollY >= document.body.scrollHeight - 400) {{
+        setTimeout(function () {{ render(6); }}, {lazy_load_delay_ms});
+    }}
+}});
+</script>
+</body></html>'''
+
+
+def vehicle_page_html(vehicle_id:int, n_images:int, base_url:str) -> str:
+    hashes = [fixture_image_hash(vehicle_id, k) for k in range(n_images)]
+    vin = f'1FTFW1E5{vehicle_id:09d}'[:17]
+    ## what a server-rendered listing embeds for search engines; the http backend can read this without a browser
+    json_ld = json.dumps({
+        '@context': 'https://schema.org', '@type': 'Car', 'name': 'Used 2021 Ford F150 XLT',
+        'vehicleIdentificationNumber': vin, 'offers': {'@type': 'Offer', 'price': 31995, 'priceCurrency': 'USD'},
+        'image': [f'https://images.autotrader.com/scaler/500/375/hn/c/{h}.jpg' for h in hashes],
+    })
+    return f'''<!DOCTYPE html>
+<html><head><title>fixture vehicle {vehicle_id}</title>
+<script type="application/ld+json">{json_ld}</script></head>
+<body>
+<h1 data-cmp="heading" id="vehicle-details-heading">Used 2021 Ford F150 XLT</h1>
+<div data-cmp="listingPrice"><span>Price</span>
+<span>$31,995</span></div>
+<span class="display-block display-sm-inline-block">VIN: {vin}</span>
+<ul data-cmp="listColumns" class="list columns columns-1">
+<li>31,207 miles</li><li>4WD</li><li>Black exterior</li><li>Gray interior</li>
+</ul>
+<div data-cmp="seeMore">One owner. Clean title.
+Tow package.</div>
+<img data-cmp="responsiveImage" src="{base_url}/img/header-{vehicle_id}.jpg">
+<p>View All Media</p>
+<div id="modal" style="display:none">
+<div data-cmp="modalScrollPanel" style="height:600px; overflow-y:auto"></div>
+</div>
+<div style="height:2000px"></div>
+<script>
+var hashes = {json.dumps(hashes)};
+var rendered = 0;
+var panel = document.querySelector('[data-cmp="modalScrollPanel"]');
+function render(n) {{
+    for (var k = 0; k < n && rendered < hashes.length; k++, rendered++) {{
+        var h = hashes[rendered];
+        var block = document.createElement('div');
+        block.style.height = '300px';
+        block.innerHTML = '<picture><source data-srcset="https://images.autotrader.com/scaler/100/75/hn/c/' + h +
+            '.jpg 100w, https://images.autotrader.com/scaler/500/375/hn/c/' + h + '.jpg 500w">' +
+            '<img src="/img/' + h + '.jpg"></picture>';
+        panel.appendChild(block);
+    }}
+}}
+Array.from(document.querySelectorAll('p')).forEach(function (p) {{
+    if (p.textContent.trim() === 'View All Media') {{
+        p.addEventListener('click', function () {{
+            document.getElementById('modal').style.display = 'block';
+            render(4);
+        }});
+    }}
+}});
+panel.addEventListener('scroll', function () {{
+    if (panel.scrollTop + panel.clientHeight >= panel.scrollHeight - 300) {{
+        setTimeout(function () {{ render(4); }}, {lazy_load_delay_ms});
+    }}
+}});
+</script>
+</body></html>'''
+
+
+class FixtureSite:
+    '''
+    local HTTP server for the fixture pages; counts requests and bytes served
+    '''
+
+    def __init__(self, n_listings:int, n_images:int=images_per_listing, host:str='127.0.0.1', port:int=0):
+        self.vehicle_ids = fixture_vehicle_ids(n_listings)
+        self.n_images = n_images
+        self.n_requests = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                status, content_type, body = site.route(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with site._lock:
+                    site.n_requests += 1
+                    site.bytes_served += len(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.base_url = f'http://{host}:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def route(self, path:str) -> tuple:
+        parts = urlsplit(path)
+        vehicle_match = re.match(r'^/cars-for-sale/vehicle/([0-9]+)$', parts.path)
+        if vehicle_match:
+            html = vehicle_page_html(int(vehicle_match.group(1)), self.n_images, self.base_url)
+            return 200, 'text/html; charset=utf-8', html.encode()
+        if parts.path.startswith('/cars-for-sale/'):
+            first_record = int(parse_qs(parts.query).get('firstRecord', ['0'])[0])
+            html = search_page_html(self.vehicle_ids, first_record, len(self.vehicle_ids))
+            return 200, 'text/html; charset=utf-8', html.encode()
+        if parts.path.startswith('/img/'):
+            ## padding after the end-of-image marker, so the bytes look like a real photo
+            return 200, 'image/jpeg', jpeg_bytes + b'\0' * (fixture_image_kb * 1024)
+        return 404, 'text/plain', b'not found'
+
+    def search_url(self, first_record:int=0) -> str:
+        return f'{self.base_url}/cars-for-sale/ford/f150/san-diego-ca?firstRecord={first_record}&zip=92101'
+
+    def vehicle_url(self, vehicle_id:int) -> str:
+        return f'{self.base_url}/cars-for-sale/vehicle/{vehicle_id}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+class PeakRssSampler:
+    '''
+    samples the RSS of this process plus all its children (chromedriver, the browser) in the background
+    '''
+
+    def __init__(self, interval:float=0.2):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self) -> int:
+        process = psutil.Process()
+        total = 0
+        for p in [process] + process.children(recursive=True):
+            try:
+                total += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self.sample())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.sample())
+
+
+def percentile(values:list, q:float) -> float:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lower, upper = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(name:str, latencies:list, n_items:int=None, n_images:int=None, peak_rss:int=None) -> dict:
+    total = sum(latencies)
+    n_items = len(latencies) if n_items is None else n_items
+    result = {
+        'benchmark': name,
+        'n': n_items,
+        'seconds': round(total, 3),
+        'per_sec': round(n_items / total, 3) if total > 0 else None,
+        'p50_seconds': percentile(latencies, 50),
+        'p95_seconds': percentile(latencies, 95),
+    }
+    if n_images is not None:
+        result['images'] = n_images
+        result['images_per_sec'] = round(n_images / total, 3) if total > 0 else None
+    if peak_rss is not None:
+        result['peak_rss_mb'] = round(peak_rss / 2 ** 20, 1)
+    return result
+
+
+def bench_capture_listings(site:FixtureSite, pool, n_pages:int) -> dict:
+    latencies = []
+    n_listings = 0
+    with PeakRssSampler() as rss:
+        for page in range(n_pages):
+            with pool.checkout() as driver:
+                start = time.perf_counter()
+                driver.get(site.search_url(first_record=page * fviu.search_page_size))
+                df, driver_after = fviu.capture_listings_from_current_page(driver)
+                latencies.append(time.perf_counter() - start)
+                if driver_after is None:
+                    pool.discard(driver)
+            n_listings += len(df)
+    return summarize('capture_listings_from_current_page', latencies, peak_rss=rss.peak_bytes) | \
+        {'listings': n_listings}
+
+
+def bench_process_vehicle_webpage(site:FixtureSite, pool, n_listings:int) -> dict:
+    latencies = []
+    n_images = 0
+    with PeakRssSampler() as rss:
+        for vehicle_id in site.vehicle_ids[:n_listings]:
+            start = time.perf_counter()
+            df, _ = fviu.process_vehicle_webpage(site.vehicle_url(vehicle_id), pool=pool)
+            latencies.append(time.perf_counter() - start)
+            n_images += len(df)
+    return summarize('process_vehicle_webpage', latencies, n_images=n_images, peak_rss=rss.peak_bytes)
+
+
+def bench_find_image_urls(site:FixtureSite, pool, repeat:int=20) -> dict:
+    from selenium.webdriver.common.by import By
+    latencies = []
+    n_images = 0
+    with pool.checkout() as driver:
+        driver.get(site.vehicle_url(site.vehicle_ids[0]))
+        driver.find_element(By.XPATH, "//p[normalize-space(text())='View All Media']").click()
+        ## load the whole gallery, then time the extraction on its own
+        panel = driver.find_element(By.CSS_SELECTOR, "div[data-cmp='modalScrollPanel']")
+        for _ in range(site.n_images):
+            driver.execute_script('arguments[0].scrollTop = arguments[0].scrollHeight;', panel)
+            time.sleep(lazy_load_delay_ms / 1000 * 2)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            urls = fviu.find_image_urls_v2(driver)
+            latencies.append(time.perf_counter() - start)
+            n_images += len(urls)
+    return summarize('find_image_urls_v2', latencies, n_images=n_images)
+
+
+def bench_lean_driver(site:FixtureSite, n_listings:int) -> list:
+    '''
+    the same listings with a regular and with a lean driver; bytes are what the fixture site served
+    '''
+    from driver_pool import DriverPool
+    results = []
+    for lean in [False, True]:
+        requests_before, bytes_before = site.n_requests, site.bytes_served
+        latencies = []
+        n_images = 0
+        with DriverPool(size=1, max_pages_per_driver=10 ** 6, lean=lean) as pool, PeakRssSampler() as rss:
+            for vehicle_id in site.vehicle_ids[:n_listings]:
+                start = time.perf_counter()
+                df, _ = fviu.process_vehicle_webpage(site.vehicle_url(vehicle_id), pool=pool)
+                latencies.append(time.perf_counter() - start)
+                n_images += len(df)
+        n = max(len(latencies), 1)
+        results.append(summarize(f'process_vehicle_webpage (lean={lean})', latencies, n_images=n_images,
+                                 peak_rss=rss.peak_bytes) | {
+            'requests_per_listing': round((site.n_requests - requests_before) / n, 1),
+            'kb_per_listing': round((site.bytes_served - bytes_before) / n / 1024, 1),
+        })
+    return results
+
+
+def bench_tabs(site:FixtureSite, n_listings:int) -> list:
+    '''
+    one browser working through the same listings with 1 tab and with fviu.tabs_per_browser tabs;
+    listings_per_gb is listings in flight per GB of peak RSS (python, chromedriver and the browser)
+    '''
+    from tab_concurrency import process_vehicle_webpages_in_tabs
+    urls = [site.vehicle_url(vehicle_id) for vehicle_id in site.vehicle_ids[:n_listings]]
+    results = []
+    for n_tabs in sorted({1, fviu.tabs_per_browser}):
+        with PeakRssSampler() as rss:
+            start = time.perf_counter()
+            df = process_vehicle_webpages_in_tabs(urls, n_tabs=n_tabs)
+            elapsed = time.perf_counter() - start
+        results.append(summarize(f'process_vehicle_webpages_in_tabs (tabs={n_tabs})', [elapsed], n_items=len(urls),
+                                 n_images=len(df), peak_rss=rss.peak_bytes) | {
+            'listings_per_gb': round(n_tabs / (rss.peak_bytes / 2 ** 30), 1) if rss.peak_bytes > 0 else None,
+        })
+    return results
+
+
+def bench_http_extraction(site:FixtureSite, pool, n_listings:int) -> list:
+    '''
+    the http backend over the fixture listings, and its output compared to the selenium path's for the same pages
+    (same fields, same image urls); tests/test_http_extraction.py asserts parity with the original selenium values
+    '''
+    import asyncio
+    from http_extraction import process_vehicle_webpages_async
+    urls = [site.vehicle_url(vehicle_id) for vehicle_id in site.vehicle_ids[:n_listings]]
+    start = time.perf_counter()
+    df_http, fallback_urls = asyncio.run(process_vehicle_webpages_async(urls, save=False))
+    elapsed = time.perf_counter() - start
+    results = [summarize('process_vehicle_webpages_async (http)', [elapsed], n_items=len(urls),
+                         n_images=len(df_http)) | {'fallback': len(fallback_urls)}]
+
+    field_columns = ['vin', 'year_make_model', 'list_price', 'listing_details', 'listing_narrative']
+    n_compared, mismatches = 0, []
+    for url in urls[:parity_listings]:
+        if url in fallback_urls:
+            continue
+        df_browser, _ = fviu.process_vehicle_webpage(url, pool=pool)
+        vehicle_id = fviu.clean_vehicle_url(url).split('/')[-1]
+        df_page = df_http[df_http['vehicle_id'] == vehicle_id] if len(df_http) > 0 else df_http
+        n_compared += 1
+        if len(df_page) == 0 or len(df_browser) == 0:
+            mismatches.append({'vehicle_id': vehicle_id, 'column': 'rows', 'http': len(df_page),
+                               'browser': len(df_browser)})
+            continue
+        for column in field_columns:
+            http_value, browser_value = df_page[column].iloc[0], df_browser[column].iloc[0]
+            if http_value != browser_value:
+                mismatches.append({'vehicle_id': vehicle_id, 'column': column, 'http': http_value,
+                                   'browser': browser_value})
+        if set(df_page['vehicle_image_url']) != set(df_browser['vehicle_image_url']):
+            mismatches.append({'vehicle_id': vehicle_id, 'column': 'vehicle_image_url',
+                               'http': len(df_page), 'browser': len(df_browser)})
+    for mismatch in mismatches:
+        print(f'parity mismatch {mismatch}')
+    results.append({'benchmark': 'http vs selenium parity', 'n': n_compared, 'mismatches': len(mismatches)})
+    return results
+
+
+def bench_search_planner(page_loads:int=planner_page_loads, seed:int=0) -> list:
+    '''
+    unique listings from the same number of search results page loads, choosing searches like notebook 02 does
+    (random make/model, zip and first_record = 25 * randint(0, 200)) vs with the SearchPlanner.
+    Simulated, no browser: every make/model has a few hundred to a few thousand listings, and each region
+    (first zip digit) sees them in its own order, the way results are sorted by distance from the zip.
+    '''
+    import numpy as np
+    from search_planner import SearchPlanner, n_regions
+
+    rng = np.random.default_rng(seed)
+    vehicles = fviu.get_vehicle_make_model_list()
+    result_counts = {(v['make'], v['model']): int(rng.integers(100, 3000)) for v in vehicles}
+    orders = {(key, region): rng.permutation(n) for key, n in result_counts.items() for region in range(n_regions)}
+
+    def load_page(vehicle_info:dict) -> tuple:
+        key = (vehicle_info['make'], vehicle_info['model'])
+        region = int(str(vehicle_info['zipcode']).zfill(5)[0])
+        first_record = int(vehicle_info['first_record'])
+        page = orders[(key, region)][first_record:first_record + fviu.search_page_size]
+        return {f'{key[0]}-{key[1]}-{i}' for i in page}, result_counts[key]
+
+    class SimulatedPlanner(SearchPlanner):
+        def sample_location(self, region:int) -> dict:
+            return {'zip': f'{region}{int(self.rng.integers(0, 10000)):04d}', 'city_state_lower': None}
+
+    results = []
+    seen = set()
+    for _ in range(page_loads):
+        vehicle = vehicles[int(rng.integers(len(vehicles)))]
+        vehicle_info = {**vehicle, 'zipcode': f'{int(rng.integers(0, 100000)):05d}',
+                        'first_record': fviu.search_page_size * int(rng.integers(0, 200))}
+        seen |= load_page(vehicle_info)[0]
+    results.append({'benchmark': 'random searches (simulated)', 'n': page_loads, 'unique_listings': len(seen)})
+
+    seen = set()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            SimulatedPlanner(os.path.join(tmpdir, 'search_planner.sqlite'), vehicles=vehicles, seed=seed) as planner:
+        n_done = 0
+        while n_done < page_loads:
+            for vehicle_info in planner.plan(min(5, page_loads - n_done)):
+                vehicle_ids, result_count = load_page(vehicle_info)
+                planner.record(vehicle_info, len(vehicle_ids), len(vehicle_ids - seen), result_count)
+                seen |= vehicle_ids
+                n_done += 1
+    results.append({'benchmark': 'planned searches (simulated)', 'n': page_loads, 'unique_listings': len(seen),
+                    'seconds': round(time.perf_counter() - start, 3)})
+    return results
+
+
+def bench_startup(repeat:int=3) -> list:
+    '''
+    wall time of a fresh interpreter for main.py --help, and for each CLI subcommand up to the point where its handler
+    has imported what it needs (--help alone exits in argparse before any handler runs), plus whether that dragged in
+    selenium / cv2 / matplotlib
+    '''
+    import sys
+    import subprocess
+    import main
+    here = os.path.dirname(os.path.abspath(__file__))
+    heavy_check = 'print(int(any(m in sys.modules for m in ["selenium", "cv2", "matplotlib"])))'
+    commands = {'main.py --help': [sys.executable, 'main.py', '--help']}
+    for command in ['search', 'listings', 'download', 'compile', 'stats', 'inventory']:
+        imports = '; '.join(f'import {module}' for module in main.handler_modules(command))
+        commands[f'main.py {command}'] = [sys.executable, '-c', f'import sys, main; {imports}; {heavy_check}']
+    commands['import find_vehicle_image_urls'] = [sys.executable, '-c',
+                                                  f'import sys, find_vehicle_image_urls; {heavy_check}']
+    results = []
+    for name, command in commands.items():
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = subprocess.run(command, cwd=here, capture_output=True, text=True, check=False)
+            latencies.append(time.perf_counter() - start)
+        results.append(summarize(f'startup: {name}', latencies))
+        if name != 'main.py --help':
+            results[-1]['loads_heavy_modules'] = result.stdout.strip()
+    return results
+
+
+def write_fixture_csvs(folder:str, n_listings:int, n_images:int=images_per_listing):
+    vehicle_ids = fixture_vehicle_ids(n_listings)
+    for page_start in range(0, n_listings, fviu.search_page_size):
+        page_ids = vehicle_ids[page_start:page_start + fviu.search_page_size]
+        df = pd.DataFrame({
+            'listing_header': [f'Used 2021 Ford F150 XLT {i}' for i in page_ids],
+            'url': [f'https://www.autotrader.com/cars-for-sale/vehicle/{i}?zip=92101' for i in page_ids],
+        })
+        df['search_url'] = f'https://www.autotrader.com/cars-for-sale/ford/f150/san-diego-ca?firstRecord={page_start}'
+        df['search_timestamp'] = 1739300000 + page_start
+        df['result_count'] = n_listings
+        df['make'] = 'ford'
+        df['model'] = 'f150'
+        df['search_metadata'] = str({'make': 'ford', 'model': 'f150', 'first_record': page_start})
+        df.to_csv(os.path.join(folder, f'search_results_ford_f150_{1739300000 + page_start}.csv'), index=False)
+    for vehicle_id in vehicle_ids:
+        hashes = [fixture_image_hash(vehicle_id, k) for k in range(n_images)]
+        df = pd.DataFrame({
+            'vehicle_image_url': [f'https://images.autotrader.com/scaler/500/375/hn/c/{h}.jpg' for h in hashes],
+        })
+        df['vehicle_id'] = vehicle_id
+        df['url'] = f'https://www.autotrader.com/cars-for-sale/vehicle/{vehicle_id}'
+        df['vin'] = f'1FTFW1E5{vehicle_id:09d}'[:17]
+        df['year_make_model'] = 'Used 2021 Ford F150 XLT'
+        df['list_price'] = '$31,995'
+        df['listing_details'] = '31,207 miles^4WD^Black exterior^Gray interior'
+        df['listing_narrative'] = 'One owner. Clean title.^Tow package.'
+        df.to_csv(os.path.join(folder, f'{vehicle_id}.csv'), index=False)
+
+
+def bench_compile(folder:str, n_listings:int) -> list:
+    results = []
+    for use_store, label in [(False, 'csv'), (True, 'store, first compile'), (True, 'store, incremental')]:
+        for name, compile_function in [('compile_search_results_df', fviu.compile_search_results_df),
+                                       ('compile_image_urls_df', fviu.compile_image_urls_df)]:
+            with PeakRssSampler() as rss:
+                start = time.perf_counter()
+                df = compile_function(use_store=use_store)
+                elapsed = time.perf_counter() - start
+            results.append(summarize(f'{name} ({label})', [elapsed], n_items=n_listings, peak_rss=rss.peak_bytes) |
+                           {'rows': len(df)})
+    return results
+
+
+def bench_download_manifest(n_listings:int) -> list:
+    '''
+    the download work list for the fixture listings: merge + build_download_jobs vs build_download_manifest
+    (both compile the DFs first), checked to produce the same (url, relpath) jobs
+    '''
+    from download_images import compile_download_df, build_download_jobs
+    from download_manifest import build_download_manifest
+
+    start = time.perf_counter()
+    jobs = build_download_jobs(compile_download_df())
+    merge_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    manifest = build_download_manifest()
+    manifest_seconds = time.perf_counter() - start
+    mismatches = len(set(jobs) ^ set(zip(manifest['vehicle_image_url'], manifest['relpath'])))
+    return [
+        summarize('compile_download_df + build_download_jobs', [merge_seconds], n_items=n_listings) |
+        {'rows': len(jobs)},
+        summarize('build_download_manifest', [manifest_seconds], n_items=n_listings) |
+        {'rows': len(manifest), 'mismatches': mismatches},
+    ]
+
+
+def write_fixture_image_tree(images_dir:str, n_listings:int, n_images:int):
+    vehicles = fviu.get_vehicle_make_model_list()
+    for i, vehicle_id in enumerate(fixture_vehicle_ids(n_listings)):
+        vehicle = vehicles[i % len(vehicles)]
+        folder = os.path.join(images_dir, f'make-{vehicle["make"]}', f'model-{vehicle["model"]}',
+                              f'vehicle_id-{vehicle_id}')
+        os.makedirs(folder)
+        for k in range(n_images):
+            with open(os.path.join(folder, f'{fixture_image_hash(vehicle_id, k)}.jpg'), 'wb') as f:
+                f.write(jpeg_bytes + b'\0' * k)
+
+
+def bench_image_inventory(images_dir:str, n_listings:int, n_images:int) -> list:
+    '''
+    class balance of a fixture image tree: walk + count (what find | cut | sort | uniq -c does)
+    vs ImageInventory rebuild (first and incremental) vs a query of the inventory, checked to give the same counts
+    '''
+    from collections import Counter
+    from image_inventory import ImageInventory
+    write_fixture_image_tree(images_dir, n_listings, n_images)
+
+    start = time.perf_counter()
+    walked = Counter()
+    for folder, _, filenames in os.walk(images_dir):
+        parts = os.path.relpath(folder, images_dir).split(os.sep)
+        if len(parts) == 3:
+            walked[(parts[0][len('make-'):], parts[1][len('model-'):])] += len(filenames)
+    walk_seconds = time.perf_counter() - start
+
+    results = [summarize('class balance by walking the tree', [walk_seconds], n_items=n_listings * n_images)]
+    with ImageInventory(images_dir=images_dir) as inventory:
+        for label in ['first', 'incremental']:
+            start = time.perf_counter()
+            inventory.rebuild()
+            results.append(summarize(f'ImageInventory.rebuild ({label})', [time.perf_counter() - start],
+                                     n_items=n_listings * n_images))
+        start = time.perf_counter()
+        balance = inventory.class_balance()
+        query_seconds = time.perf_counter() - start
+    queried = Counter({(row.make, row.model): row.images for row in balance.itertuples()})
+    results.append(summarize('ImageInventory.class_balance', [query_seconds], n_items=n_listings * n_images) |
+                   {'mismatches': len(set(walked.items()) ^ set(queried.items()))})
+    return results
+
+
+def run_benchmarks(n_listings:int=10, n_images:int=images_per_listing, skip_browser:bool=False,
+                   skip_compile:bool=False, skip_lean:bool=False, skip_tabs:bool=False) -> list:
+    results = bench_startup()
+    results.extend(bench_search_planner())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ## keep everything the scraper writes inside the temp dir
+        fviu.parent_directory_url_csvs = os.path.join(tmpdir, 'vehicle_metadata') + '/'
+        fviu.metadata_store_path = os.path.join(tmpdir, 'vehicle_metadata.sqlite')
+        os.makedirs(fviu.parent_directory_url_csvs)
+        metrics.jsonl_path = os.path.join(tmpdir, 'scraper_metrics.jsonl')
+        metrics.prometheus_path = os.path.join(tmpdir, 'scraper_metrics.prom')
+
+        if not skip_browser:
+            from driver_pool import DriverPool
+            with FixtureSite(n_listings, n_images) as site, DriverPool(size=1, max_pages_per_driver=10 ** 6) as pool:
+                n_pages = -(-n_listings // fviu.search_page_size)
+                results.append(bench_capture_listings(site, pool, n_pages))
+                results.append(bench_process_vehicle_webpage(site, pool, n_listings))
+                results.append(bench_find_image_urls(site, pool))
+                results[-1]['fixture_requests'] = site.n_requests
+                results[-1]['fixture_bytes'] = site.bytes_served
+                results.extend(bench_http_extraction(site, pool, n_listings))
+                if not skip_lean:
+                    results.extend(bench_lean_driver(site, min(n_listings, lean_comparison_listings)))
+                if not skip_tabs:
+                    results.extend(bench_tabs(site, min(n_listings, tab_comparison_listings)))
+
+        if not skip_compile:
+            compile_folder = os.path.join(tmpdir, 'compile_fixture') + '/'
+            os.makedirs(compile_folder)
+            write_fixture_csvs(compile_folder, n_listings, n_images)
+            fviu.parent_directory_url_csvs = compile_folder
+            results.extend(bench_compile(compile_folder, n_listings))
+            results.extend(bench_download_manifest(n_listings))
+            results.extend(bench_image_inventory(os.path.join(tmpdir, 'images'), n_listings, n_images))
+    return results
+
+
+def print_results(results:list):
+    columns = ['benchmark', 'n', 'seconds', 'per_sec', 'images_per_sec', 'p50_seconds', 'p95_seconds', 'peak_rss_mb',
+               'listings_per_gb', 'unique_listings', 'requests_per_listing', 'kb_per_listing', 'fallback', 'mismatches',
+               'loads_heavy_modules']
+    df = pd.DataFrame(results)
+    print(df[[c for c in columns if c in df]].to_string(index=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-listings', type=int, default=10, help='scale of the fixture site, e.g. 10 to 10000')
+    parser.add_argument('--images-per-listing', type=int, default=images_per_listing)
+    parser.add_argument('--skip-browser', action='store_true', help='only benchmark the compile functions')
+    parser.add_argument('--skip-compile', action='store_true', help='only benchmark the browser paths')
+    parser.add_argument('--skip-lean', action='store_true', help='skip the regular vs lean driver comparison')
+    parser.add_argument('--skip-tabs', action='store_true', help='skip the one tab vs several tabs comparison')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.n_listings, args.images_per_listing, args.skip_browser, args.skip_compile,
+                             args.skip_lean, args.skip_tabs)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
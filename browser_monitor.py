@@ -0,0 +1,183 @@
+import threading
+import statistics
+from collections import deque
+
+import psutil
+
+from scraper_metrics import metrics
+
+
+####################################
+### Settings
+recycle_after_pages = 200  # for sessions outside a DriverPool, which has its own max_pages_per_driver
+recycle_above_rss_mb = 2048  # driver + browser process tree
+max_latency_drift = 2.0  # recycle when recent pages take this many times longer than the first ones
+latency_window = 5  # pages in the baseline, and in the recent window compared against it
+####################################
+
+
+class BrowserMonitor:
+    '''
+    Samples RSS, CPU and open file descriptors of a webdriver's process tree (chromedriver / geckodriver and
+    the browser processes under it) after each page, exports the samples through scraper_metrics,
+    and says when a session should be recycled:
+    - after max_pages pages,
+    - when the process tree uses more than max_rss_mb,
+    - when the median latency of the last latency_window pages is max_latency_drift times that of the first ones.
+
+    Sessions are told apart by their webdriver session id, so state never leaks to a new driver.
+
+    usage:
+        reason = monitor.after_page(driver, elapsed_seconds)
+        if reason is not None:
+            driver.quit()
+            monitor.forget(driver)
+    '''
+
+    def __init__(self, max_pages:int=recycle_after_pages, max_rss_mb:float=recycle_above_rss_mb,
+                 max_latency_drift:float=max_latency_drift, latency_window:int=latency_window):
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.max_latency_drift = max_latency_drift
+        self.latency_window = latency_window
+        self._sessions = {}  # session id -> per-session state
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(driver) -> str:
+        return getattr(driver, 'session_id', None) or str(id(driver))
+
+    @staticmethod
+    def driver_pid(driver) -> int:
+        '''
+        pid of the chromedriver / geckodriver process, None for remote sessions
+        '''
+        process = getattr(getattr(driver, 'service', None), 'process', None)
+        return getattr(process, 'pid', None)
+
+    def _state(self, driver) -> dict:
+        key = self._key(driver)
+        with self._lock:
+            if key not in self._sessions:
+                ## sessions that were quit without forget() (e.g. after an error) are dropped here
+                for stale_key in [k for k, state in self._sessions.items()
+                                  if state['pid'] is not None and not psutil.pid_exists(state['pid'])]:
+                    del self._sessions[stale_key]
+                self._sessions[key] = {
+                    'pid': self.driver_pid(driver),
+                    'pages': 0,
+                    'processes': {},  # pid -> psutil.Process, reused so that cpu_percent has a previous reading
+                    'baseline': [],
+                    'recent': deque(maxlen=self.latency_window),
+                    'last_sample': None,
+                    'recycle_reason': None,
+                }
+            return self._sessions[key]
+
+    def sample(self, driver) -> dict:
+        '''
+        :return: rss_mb, cpu_percent (summed over processes, so it can go above 100), open_fds, n_processes
+                 of the process tree; None if the driver process is not local / not running
+        '''
+        pid = self.driver_pid(driver)
+        if pid is None:
+            return None
+        state = self._state(driver)
+        cache = state['processes']
+        try:
+            root = cache.get(pid) or psutil.Process(pid)
+            tree = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+
+        rss, cpu, fds = 0, 0.0, 0
+        processes = {}
+        for process in tree:
+            process = cache.get(process.pid, process)
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    cpu += process.cpu_percent(interval=None)
+                    fds += process.num_fds() if hasattr(process, 'num_fds') else process.num_handles()
+            except psutil.Error:
+                continue
+            processes[process.pid] = process
+        state['processes'] = processes
+        return {'rss_mb': round(rss / 2 ** 20, 1), 'cpu_percent': round(cpu, 1), 'open_fds': fds,
+                'n_processes': len(processes)}
+
+    def after_page(self, driver, elapsed:float=None, browser:str=None) -> str:
+        '''
+        record one page visit by driver, sample its process tree and export the sample
+        :param elapsed: seconds the page took, for the latency drift check
+        :return: why the session should be recycled now, or None
+        '''
+        state = self._state(driver)
+        state['pages'] += 1
+        if elapsed is not None:
+            if len(state['baseline']) < self.latency_window:
+                state['baseline'].append(elapsed)
+            else:
+                state['recent'].append(elapsed)
+
+        sample = self.sample(driver)
+        state['last_sample'] = sample
+        labels = {} if browser is None else {'browser': browser}
+        if sample is not None:
+            for name, value in sample.items():
+                metrics.set(f'browser_{name}', value, **labels)
+
+        reason = self.recycle_reason(driver)
+        if reason is not None:
+            metrics.inc('driver_recycles_total', reason=reason, **labels)
+            print(f'browser monitor - recycle the driver: {reason} (after {state["pages"]} pages, {sample})')
+        return reason
+
+    def recycle_reason(self, driver) -> str:
+        '''
+        the policy, from what after_page recorded so far: 'pages', 'rss', 'latency_drift' or None
+        '''
+        state = self._state(driver)
+        sample = state['last_sample']
+        if self.max_pages is not None and state['pages'] >= self.max_pages:
+            state['recycle_reason'] = 'pages'
+        elif self.max_rss_mb is not None and sample is not None and sample['rss_mb'] > self.max_rss_mb:
+            state['recycle_reason'] = 'rss'
+        elif self.max_latency_drift is not None and len(state['recent']) == self.latency_window and \
+                statistics.median(state['recent']) > self.max_latency_drift * statistics.median(state['baseline']):
+            state['recycle_reason'] = 'latency_drift'
+        return state['recycle_reason']
+
+    def forget(self, driver):
+        with self._lock:
+            self._sessions.pop(self._key(driver), None)
+
+    def summary(self) -> dict:
+        '''
+        pages and last sample per session, handy in a notebook
+        '''
+        with self._lock:
+            return {key: {'pages': state['pages'], **(state['last_sample'] or {})}
+                    for key, state in self._sessions.items()}
+
+
+def recycle_if_needed(driver, elapsed:float=None, browser:str=None):
+    '''
+    for sessions kept alive across calls with quit=False:
+    quit the driver if the monitor says it should be recycled
+    :return: the driver, or None if it was quit (the next call then starts a fresh one)
+    '''
+    if driver is None:
+        return None
+    if monitor.after_page(driver, elapsed, browser=browser) is None:
+        return driver
+    try:
+        driver.quit()
+    except Exception:
+        pass
+    monitor.forget(driver)
+    return None
+
+
+## process-wide instance used by the scraper
+monitor = BrowserMonitor()
@@ -0,0 +1,284 @@
+import time
+import sqlite3
+import traceback
+
+import pandas as pd
+
+from find_vehicle_image_urls import crawl_frontier_path, vehicle_url_pattern
+
+
+job_states = ['pending', 'leased', 'done', 'failed']
+
+## kind -> (table, key columns, payload columns)
+## a missing key (e.g. a search without a zipcode) is stored as '', because UNIQUE treats every NULL as distinct
+job_kinds = {
+    'search': ('search_jobs', ['make', 'model', 'zipcode', 'first_record'], ['city_state_lower', 'body_style']),
+    'listing': ('listing_jobs', ['vehicle_id'], ['url_clean', 'search_id']),
+}
+
+
+class CrawlFrontier:
+    '''
+    Durable work queue for the crawl, in SQLite, so that a crash or a restarted notebook picks up where it left off.
+
+    Two kinds of jobs:
+    - search: make/model/zipcode/first_record, i.e. one search results page
+    - listing: vehicle_id/url_clean, i.e. one vehicle listing page
+
+    Each job is pending -> leased -> done, or back to pending after a failure (until max_attempts, then failed).
+    A lease that is not completed before it expires (e.g. the worker crashed) makes the job available again,
+    so no job is loaded twice unless the first attempt never finished; that counts as an attempt too.
+    complete / fail / requeue only apply while the caller still holds the lease, so a worker whose lease expired
+    cannot undo what the worker that leased the job after it did.
+    Higher priority jobs are leased first.
+    '''
+
+    def __init__(self, path:str=crawl_frontier_path, max_attempts:int=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        for kind, (table, keys, payload) in job_kinds.items():
+            columns = ', '.join(f'{column} TEXT' for column in keys + payload)
+            self.conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    {columns},
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    priority REAL NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_expires_at REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    UNIQUE ({', '.join(keys)})
+                )
+            ''')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_next ON {table} (state, priority, id)')
+            ## frontiers written before missing keys became '': the first NULL-keyed copy of a job becomes the '' one,
+            ## the repeats that slipped past UNIQUE are dropped
+            for column in keys:
+                self.conn.execute(f"UPDATE OR IGNORE {table} SET {column} = '' WHERE {column} IS NULL")
+                self.conn.execute(f'DELETE FROM {table} WHERE {column} IS NULL')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _add(self, kind:str, records:list, priority:float=0) -> int:
+        '''
+        :return: number of jobs that were new
+        '''
+        table, keys, payload = job_kinds[kind]
+        columns = keys + payload
+        now = time.time()
+        rows = [tuple(str(record[c]) if record.get(c) is not None else '' if c in keys else None for c in columns) +
+                (priority, now, now) for record in records]
+        sql = f'''INSERT OR IGNORE INTO {table} ({', '.join(columns)}, priority, created_at, updated_at)
+                  VALUES ({', '.join('?' * (len(columns) + 3))})'''
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            before = self.conn.total_changes
+            self.conn.executemany(sql, rows)
+            n_new = self.conn.total_changes - before
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return n_new
+
+    def add_search_job(self, vehicle_info:dict, priority:float=0) -> int:
+        '''
+        :param vehicle_info: like the input to find_listings_for_make_model; needs make, model, zipcode
+        '''
+        record = {**vehicle_info, 'first_record': int(vehicle_info.get('first_record', 0))}
+        return self._add('search', [record], priority=priority)
+
+    def add_search_jobs(self, vehicle_infos:list, priority:float=0) -> int:
+        records = [{**v, 'first_record': int(v.get('first_record', 0))} for v in vehicle_infos]
+        return self._add('search', records, priority=priority)
+
+    def add_listing_jobs(self, df:pd.DataFrame, search_id:int=None, priority:float=0) -> int:
+        '''
+        :param df: search results e.g. from capture_listings_from_current_page, needs a url column
+        :return: number of listings that were not in the frontier yet
+        '''
+        if len(df) == 0:
+            return 0
+        url_clean = df['url_clean'] if 'url_clean' in df else df['url'].astype(str).str.extract(vehicle_url_pattern)[0]
+        records = [{'vehicle_id': str(url).split('/')[-1], 'url_clean': url, 'search_id': search_id}
+                   for url in url_clean.dropna().unique()]
+        return self._add('listing', records, priority=priority)
+
+    def lease(self, kind:str, lease_seconds:float=600) -> dict:
+        '''
+        take the next pending job (or one whose lease has expired)
+        :return: job as a dict, or None if there is nothing to do; pass it to complete / fail / requeue
+        '''
+        table, _, _ = job_kinds[kind]
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            ## an expired lease was an attempt that never finished, e.g. the page killed the worker
+            self.conn.execute(f'''
+                UPDATE {table}
+                SET state = 'failed', lease_expires_at = NULL, last_error = 'lease expired', updated_at = ?
+                WHERE state = 'leased' AND lease_expires_at < ? AND attempts >= ?
+            ''', (now, now, self.max_attempts))
+            row = self.conn.execute(f'''
+                SELECT * FROM {table}
+                WHERE state = 'pending' OR (state = 'leased' AND lease_expires_at < ?)
+                ORDER BY priority DESC, id
+                LIMIT 1
+            ''', (now,)).fetchone()
+            if row is not None:
+                self.conn.execute(f'''
+                    UPDATE {table} SET state = 'leased', attempts = attempts + 1, lease_expires_at = ?, updated_at = ?
+                    WHERE id = ?
+                ''', (now + lease_seconds, now, row['id']))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        job = dict(row)
+        job['attempts'] += 1
+        job['state'] = 'leased'
+        job['lease_expires_at'] = now + lease_seconds
+        return job
+
+    def _finish(self, kind:str, job:dict, assignments:str, params:tuple) -> bool:
+        '''
+        update the job if this lease still holds it
+        :return: False if the lease expired and the job was leased again (or given up on) in the meantime
+        '''
+        table, _, _ = job_kinds[kind]
+        cursor = self.conn.execute(f'''
+            UPDATE {table} SET {assignments}, lease_expires_at = NULL, updated_at = ?
+            WHERE id = ? AND state = 'leased' AND lease_expires_at = ?
+        ''', params + (time.time(), job['id'], job['lease_expires_at']))
+        if cursor.rowcount == 0:
+            print(f'frontier - lost the lease on {kind} job {job["id"]}, leaving it to whoever has it now')
+            return False
+        return True
+
+    def complete(self, kind:str, job:dict) -> bool:
+        return self._finish(kind, job, "state = 'done', last_error = NULL", ())
+
+    def fail(self, kind:str, job:dict, error:str=None) -> bool:
+        '''
+        put the job back in the queue, or give up on it after max_attempts
+        '''
+        return self._finish(kind, job,
+                            "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, last_error = ?",
+                            (self.max_attempts, error))
+
+    def requeue(self, kind:str, job:dict, error:str=None) -> bool:
+        '''
+        put the job back in the queue without counting the attempt, for failures that are not the job's fault
+        (the site is down, or timing out everywhere)
+        '''
+        return self._finish(kind, job, "state = 'pending', attempts = MAX(attempts - 1, 0), last_error = ?", (error,))
+
+    def counts(self, kind:str) -> dict:
+        table, _, _ = job_kinds[kind]
+        counts = dict(self.conn.execute(f'SELECT state, COUNT(*) FROM {table} GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in job_states}
+
+    def mark_listings_done(self, vehicle_ids) -> int:
+        '''
+        one-time migration: listings that were already scraped before the frontier existed
+        '''
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "UPDATE listing_jobs SET state = 'done', updated_at = ? WHERE vehicle_id = ? AND state != 'done'",
+            [(now, str(vehicle_id)) for vehicle_id in vehicle_ids]
+        )
+        n_updated = self.conn.total_changes - before
+        self.conn.execute('COMMIT')
+        return n_updated
+
+
+def bootstrap_frontier(frontier:CrawlFrontier) -> dict:
+    '''
+    one-time import of what has been crawled so far (via the metadata store):
+    every listing found by a search becomes a listing job, and the ones that already have image urls are done
+    '''
+    from find_vehicle_image_urls import compile_search_results_df, compile_image_urls_df
+    n_new = frontier.add_listing_jobs(compile_search_results_df())
+    n_done = frontier.mark_listings_done(compile_image_urls_df()['vehicle_id'].unique())
+    print(f'frontier bootstrap - {n_new} new listing jobs, {n_done} marked done')
+    return frontier.counts('listing')
+
+
+def run_job(frontier:CrawlFrontier, kind:str, job:dict, pool=None) -> str:
+    '''
+    run one leased job and record the outcome in the frontier
+    :return: one of find_vehicle_image_urls.page_outcomes: 'success' if the page produced results,
+             'empty' if it loaded fine but had nothing (no images / no listings),
+             'site_unavailable', 'timeout' or 'error' otherwise
+    '''
+    from find_vehicle_image_urls import process_vehicle_webpage, find_listings_for_make_model
+    try:
+        if kind == 'listing':
+            df, _ = process_vehicle_webpage(job['url_clean'], quit=pool is None, pool=pool)
+        else:
+            vehicle_info = {key: job[key] for key in ['make', 'model', 'zipcode', 'city_state_lower', 'first_record']
+                            if job[key] not in (None, '')}
+            df, _ = find_listings_for_make_model(vehicle_info, quit=pool is None, pool=pool, frontier=frontier,
+                                                 search_id=job['id'])
+    except Exception:
+        frontier.fail(kind, job, traceback.format_exc())
+        return 'error'
+
+    if len(df) == 0:
+        outcome = df.attrs.get('outcome', 'error')
+        if outcome in ('site_unavailable', 'timeout'):
+            ## site-wide, says nothing about this job; do not let an outage use up its attempts
+            frontier.requeue(kind, job, outcome)
+            return outcome
+        error = ('no images found' if kind == 'listing' else 'no listings found') if outcome == 'empty' else outcome
+        frontier.fail(kind, job, error)
+        return outcome
+    ## with output_format 'jsonl' the rows may still be buffered; they must be on disk before the job is done
+    from listing_writer import flush_listing_writers
+    flush_listing_writers()
+    frontier.complete(kind, job)
+    return 'success'
+
+
+def run_jobs(frontier:CrawlFrontier, kind:str, pool=None, max_jobs:int=None, sleep:float=0,
+             lease_seconds:float=600) -> int:
+    '''
+    lease jobs of one kind and run them until the queue is empty (or max_jobs are done)
+    - listing jobs are scraped with process_vehicle_webpage
+    - search jobs run find_listings_for_make_model, and the listings found are queued as listing jobs
+    :return: number of jobs completed
+    '''
+    n_done = 0
+    while max_jobs is None or n_done < max_jobs:
+        job = frontier.lease(kind, lease_seconds=lease_seconds)
+        if job is None:
+            print(f'frontier - no {kind} jobs left')
+            break
+        n_done += int(run_job(frontier, kind, job, pool=pool) == 'success')
+        if sleep:
+            time.sleep(sleep)
+    return n_done
+
+
+def run_listing_jobs(frontier:CrawlFrontier, **kwargs) -> int:
+    return run_jobs(frontier, 'listing', **kwargs)
+
+
+def run_search_jobs(frontier:CrawlFrontier, **kwargs) -> int:
+    return run_jobs(frontier, 'search', **kwargs)
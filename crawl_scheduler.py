@@ -0,0 +1,191 @@
+import time
+import traceback
+import multiprocessing as mp
+
+from find_vehicle_image_urls import crawl_frontier_path
+
+
+####################################
+### Settings
+n_workers = 2
+requests_per_minute = 4.0  # starting page-load budget shared by all workers
+min_requests_per_minute = 0.2
+max_requests_per_minute = 12.0
+slow_page_seconds = 90  # a page that takes longer than this counts as a sign of throttling
+####################################
+
+## run_job outcomes that mean the site is pushing back; 'empty' (a listing without images, a search without
+## listings) is a normal page and does not slow anybody down
+backoff_outcomes = ['site_unavailable', 'timeout', 'error']
+
+
+class SharedTokenBucket:
+    '''
+    Token bucket shared by all worker processes, so together they stay within one request budget.
+
+    The rate adapts (additive increase, multiplicative decrease):
+    - every successful page nudges the rate up by `increase` requests/minute, up to max_rate
+    - a failed page (site unavailable, timeout, error) halves the rate and pauses everybody
+      for an exponentially growing backoff
+    - a slow page cuts the rate a little
+    '''
+
+    def __init__(self, rate:float=requests_per_minute, min_rate:float=min_requests_per_minute,
+                 max_rate:float=max_requests_per_minute, burst:float=1, increase:float=0.5,
+                 base_backoff:float=60, max_backoff:float=1800):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._lock = mp.Lock()
+        self._rate = mp.Value('d', rate, lock=False)  # requests per minute
+        self._tokens = mp.Value('d', burst, lock=False)
+        self._last = mp.Value('d', time.time(), lock=False)
+        self._paused_until = mp.Value('d', 0.0, lock=False)
+        self._consecutive_failures = mp.Value('i', 0, lock=False)
+
+    @property
+    def rate(self) -> float:
+        return self._rate.value
+
+    def acquire(self, stop_event=None) -> bool:
+        '''
+        block until a request may be made
+        :return: False if stop_event was set while waiting
+        '''
+        while stop_event is None or not stop_event.is_set():
+            with self._lock:
+                now = time.time()
+                rate_per_second = self._rate.value / 60
+                self._tokens.value = min(self.burst, self._tokens.value + (now - self._last.value) * rate_per_second)
+                self._last.value = now
+                if now < self._paused_until.value:
+                    wait = self._paused_until.value - now
+                elif self._tokens.value >= 1:
+                    self._tokens.value -= 1
+                    return True
+                else:
+                    wait = (1 - self._tokens.value) / rate_per_second
+            time.sleep(min(wait, 1.0))
+        return False
+
+    def report_success(self):
+        with self._lock:
+            self._consecutive_failures.value = 0
+            self._rate.value = min(self.max_rate, self._rate.value + self.increase)
+
+    def report_slow(self):
+        with self._lock:
+            self._rate.value = max(self.min_rate, self._rate.value * 0.8)
+
+    def report_failure(self):
+        with self._lock:
+            self._consecutive_failures.value += 1
+            self._rate.value = max(self.min_rate, self._rate.value / 2)
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self._consecutive_failures.value - 1))
+            self._paused_until.value = max(self._paused_until.value, time.time() + backoff)
+            self._tokens.value = 0
+        print(f'token bucket - failure #{self._consecutive_failures.value}, '
+              f'rate now {self._rate.value:.2f}/min, pausing {backoff:.0f}s')
+
+
+def worker_main(worker_id:int, kind:str, bucket:SharedTokenBucket, stop_event, frontier_path:str,
+                max_pages_per_driver:int, lease_seconds:float, max_jobs:int):
+    '''
+    one crawl worker: its own browser (via a DriverPool of size 1) and its own frontier connection
+    '''
+    from driver_pool import DriverPool
+    from crawl_frontier import CrawlFrontier, run_job
+    from listing_writer import flush_listing_writers
+    from scraper_metrics import metrics
+
+    ## one prometheus textfile per worker, otherwise they overwrite each other's totals; one event log each too
+    metrics.prometheus_path = metrics.prometheus_path.replace('.prom', f'_worker{worker_id}.prom')
+    metrics.jsonl_path = metrics.jsonl_path.replace('.jsonl', f'_worker{worker_id}.jsonl')
+    metrics.event_labels = {'worker': worker_id}
+
+    n_jobs = 0
+    with CrawlFrontier(frontier_path) as frontier, DriverPool(size=1, max_pages_per_driver=max_pages_per_driver) as pool:
+        try:
+            while not stop_event.is_set() and (max_jobs is None or n_jobs < max_jobs):
+                if not bucket.acquire(stop_event):
+                    break
+                job = frontier.lease(kind, lease_seconds=lease_seconds)
+                if job is None:
+                    print(f'worker {worker_id} - no {kind} jobs left')
+                    break
+
+                start = time.time()
+                try:
+                    outcome = run_job(frontier, kind, job, pool=pool)
+                except Exception:
+                    print(f'worker {worker_id} - error:\n', traceback.format_exc())
+                    outcome = 'error'
+                elapsed = time.time() - start
+                n_jobs += 1
+
+                if outcome in backoff_outcomes:
+                    bucket.report_failure()
+                elif elapsed > slow_page_seconds:
+                    bucket.report_slow()
+                else:
+                    bucket.report_success()
+                print(f'worker {worker_id} - {kind} job {job["id"]} {outcome} in {elapsed:.1f}s, '
+                      f'rate {bucket.rate:.2f}/min')
+        finally:
+            ## forked workers leave through os._exit, which skips the atexit flush / export
+            flush_listing_writers()
+            metrics.export()
+
+
+class CrawlScheduler:
+    '''
+    Runs n_workers browser workers in separate processes, pulling jobs of one kind from the CrawlFrontier.
+    Instead of every worker sleeping a worst-case fixed amount, they share a SharedTokenBucket,
+    which uses the whole allowed request rate and backs off when the site pushes back.
+
+    usage:
+        CrawlScheduler(n_workers=3, kind='listing').run()
+    '''
+
+    def __init__(self, n_workers:int=n_workers, kind:str='listing', bucket:SharedTokenBucket=None,
+                 frontier_path:str=crawl_frontier_path, max_pages_per_driver:int=50, lease_seconds:float=600,
+                 max_jobs_per_worker:int=None):
+        self.n_workers = n_workers
+        self.kind = kind
+        self.bucket = bucket if bucket is not None else SharedTokenBucket()
+        self.frontier_path = frontier_path
+        self.max_pages_per_driver = max_pages_per_driver
+        self.lease_seconds = lease_seconds
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.stop_event = mp.Event()
+
+    def run(self):
+        processes = [
+            mp.Process(
+                target=worker_main,
+                args=(i, self.kind, self.bucket, self.stop_event, self.frontier_path, self.max_pages_per_driver,
+                      self.lease_seconds, self.max_jobs_per_worker),
+                name=f'crawl-worker-{i}',
+            )
+            for i in range(self.n_workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            print('stopping workers after their current page')
+            self.stop_event.set()
+            for process in processes:
+                process.join()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+if __name__ == '__main__':
+    CrawlScheduler(kind='listing').run()
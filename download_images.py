@@ -0,0 +1,269 @@
+import os
+import time
+import uuid
+import threading
+import traceback
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from find_vehicle_image_urls import parent_directory_images, compile_search_results_df, compile_image_urls_df
+from image_inventory import ImageInventory, inventory_record, get_body_styles
+
+
+####################################
+### Settings
+download_manifest_filename = '.download_manifest.txt'
+max_workers = 16
+max_connections_per_host = 8
+requests_per_second = 10.0
+request_timeout = 30  # seconds
+inventory_batch_size = 500  # downloaded files per write to the image inventory
+####################################
+
+
+class RateLimiter:
+    '''
+    Thread-safe token bucket: on average `rate` acquisitions per second, with bursts of up to `burst`.
+    '''
+
+    def __init__(self, rate:float, burst:int=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class DownloadManifest:
+    '''
+    Append-only list of files (relative to the image directory) that have been completely downloaded.
+    Loaded once into a set, so a rerun knows what to skip without touching the file system per image.
+    '''
+
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.completed = set(line.rstrip('\n') for line in f if line.strip())
+        self._file = open(path, 'a')
+
+    def __contains__(self, relpath:str) -> bool:
+        return relpath in self.completed
+
+    def add(self, relpath:str):
+        with self._lock:
+            self.completed.add(relpath)
+            self._file.write(relpath + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def compile_download_df() -> pd.DataFrame:
+    '''
+    image urls joined with the make/model of the search that found the vehicle
+    (what notebook 04 used to build by hand)
+    '''
+    search_results_df = compile_search_results_df()
+    search_results_df = search_results_df.drop_duplicates(subset=['vehicle_id'])
+    df_vehicle_image_urls = compile_image_urls_df()
+    df_vehicle_image_urls = df_vehicle_image_urls.drop_duplicates(subset=['vehicle_image_url'])
+    df_vehicle_image_urls['vehicle_id'] = df_vehicle_image_urls['vehicle_id'].astype(int)
+    search_results_df['vehicle_id'] = search_results_df['vehicle_id'].astype(int)
+    return df_vehicle_image_urls.merge(search_results_df, on=['vehicle_id'], how='inner', suffixes=('', '.search'))
+
+
+def build_download_jobs(df:pd.DataFrame) -> list:
+    '''
+    :param df: needs columns make, model, vehicle_id, vehicle_image_url
+    :return: list of (image_url, relative filepath) tuples, filepath like make-{make}/model-{model}/vehicle_id-{vehicle_id}/{basename}
+    '''
+    folders = 'make-' + df['make'].astype(str) + '/model-' + df['model'].astype(str) + \
+              '/vehicle_id-' + df['vehicle_id'].astype(str) + '/'
+    basenames = df['vehicle_image_url'].astype(str).str.rsplit('/', n=1).str[-1]
+    return list(zip(df['vehicle_image_url'].astype(str), folders + basenames))
+
+
+class ImageDownloader:
+    '''
+    Downloads (image_url, relative filepath) jobs into dest_dir with a thread pool.
+
+    - each worker thread keeps its own requests.Session, so connections are kept alive and reused
+    - at most max_connections_per_host requests are in flight against any one host
+    - all workers share one RateLimiter
+    - files are written to a temp file and renamed into place, so a crash never leaves a truncated jpg
+    - completed files are recorded in the DownloadManifest and skipped on the next run
+    - with inventory=True, every file written is also added to the ImageInventory of dest_dir
+      (its size and dimensions are read in the worker thread, the rows are written in batches)
+    '''
+
+    def __init__(self, dest_dir:str=parent_directory_images, max_workers:int=max_workers,
+                 max_connections_per_host:int=max_connections_per_host,
+                 requests_per_second:float=requests_per_second, manifest_path:str=None,
+                 timeout:float=request_timeout, inventory:bool=True):
+        self.dest_dir = dest_dir
+        self.max_workers = max_workers
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(requests_per_second, burst=max(1, int(requests_per_second)))
+        if manifest_path is None:
+            manifest_path = os.path.join(dest_dir, download_manifest_filename)
+        self.manifest_path = manifest_path
+        self.inventory = inventory
+        self._body_styles = get_body_styles() if inventory else None
+        self._local = threading.local()
+        self._host_semaphores = {}
+        self._host_lock = threading.Lock()
+        self._folders_created = set()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_connections_per_host, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def _host_semaphore(self, url:str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_semaphores[host]
+
+    def _makedirs(self, folder:str):
+        if folder not in self._folders_created:
+            os.makedirs(folder, exist_ok=True)
+            self._folders_created.add(folder)
+
+    def download_one(self, image_url:str, relpath:str) -> int:
+        '''
+        :return: number of bytes written
+        '''
+        filepath = os.path.join(self.dest_dir, relpath)
+        self._makedirs(os.path.dirname(filepath))
+        tmp_filepath = f'{filepath}.{uuid.uuid4().hex}.tmp'
+
+        self.rate_limiter.acquire()
+        try:
+            with self._host_semaphore(image_url):
+                response = self._session().get(image_url, timeout=self.timeout, stream=True)
+                try:
+                    response.raise_for_status()
+                    n_bytes = 0
+                    with open(tmp_filepath, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            f.write(chunk)
+                            n_bytes += len(chunk)
+                finally:
+                    response.close()
+            os.replace(tmp_filepath, filepath)
+        except Exception:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+        return n_bytes
+
+    def _download_job(self, image_url:str, relpath:str):
+        try:
+            n_bytes = self.download_one(image_url, relpath)
+        except Exception:
+            print(f'download failed [{image_url}]:\n', traceback.format_exc(limit=1))
+            return relpath, None, None
+        record = inventory_record(self.dest_dir, relpath, self._body_styles) if self.inventory else None
+        return relpath, n_bytes, record
+
+    def run(self, jobs:list, verbose_every:int=1000) -> dict:
+        '''
+        :param jobs: list of (image_url, relative filepath)
+        :return: summary counts
+        '''
+        manifest = DownloadManifest(self.manifest_path)
+        pending = {}  # relpath -> url, one download per target file
+        for url, relpath in jobs:
+            if relpath not in manifest:
+                pending.setdefault(relpath, url)
+        stats = {'skipped': len(jobs) - len(pending), 'downloaded': 0, 'failed': 0, 'bytes': 0}
+        print(f'{len(pending)} images to download, {stats["skipped"]} already done')
+
+        start = time.time()
+        inventory = ImageInventory(self.dest_dir) if self.inventory else None
+        records = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._download_job, url, relpath) for relpath, url in pending.items()]
+                for i, future in enumerate(as_completed(futures), start=1):
+                    relpath, n_bytes, record = future.result()
+                    if n_bytes is None:
+                        stats['failed'] += 1
+                    else:
+                        manifest.add(relpath)
+                        stats['downloaded'] += 1
+                        stats['bytes'] += n_bytes
+                    if record is not None:
+                        records.append(record)
+                        if len(records) >= inventory_batch_size:
+                            inventory.add(records)
+                            records = []
+                    if verbose_every and i % verbose_every == 0:
+                        elapsed = time.time() - start
+                        print(f'{i}/{len(pending)} done, {i / elapsed:.1f} images/sec')
+        finally:
+            manifest.close()
+            if inventory is not None:
+                inventory.add(records)
+                inventory.close()
+
+        stats['seconds'] = round(time.time() - start, 2)
+        print(stats)
+        return stats
+
+
+    def run_chunks(self, chunks, verbose_every:int=1000) -> dict:
+        '''
+        run() one chunk of jobs at a time, e.g. from download_manifest.iter_pending_downloads,
+        so that millions of jobs never have to be held as futures (or python tuples) at once
+        :return: summary counts over all chunks
+        '''
+        totals = {'skipped': 0, 'downloaded': 0, 'failed': 0, 'bytes': 0, 'seconds': 0}
+        for chunk in chunks:
+            stats = self.run(chunk, verbose_every=verbose_every)
+            for key in totals:
+                totals[key] += stats[key]
+        totals['seconds'] = round(totals['seconds'], 2)
+        print(totals)
+        return totals
+
+
+def download_images(jobs:list, **kwargs) -> dict:
+    return ImageDownloader(**kwargs).run(jobs)
+
+
+if __name__ == '__main__':
+    from download_manifest import build_download_manifest, pending_downloads, iter_download_chunks
+    pending = pending_downloads(build_download_manifest())
+    print(pending.shape)
+    ImageDownloader().run_chunks(iter_download_chunks(pending))
@@ -0,0 +1,172 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from find_vehicle_image_urls import parent_directory_images
+
+
+####################################
+### Settings
+pending_downloads_prefix = '.pending_downloads'  # {images_dir}/.pending_downloads.urls.npy / .relpaths.npy
+download_chunk_size = 10000  # jobs per chunk handed to the downloader
+####################################
+
+
+def parse_vehicle_ids(vehicle_ids:pd.Series) -> np.ndarray:
+    '''
+    :return: int64 array, -1 where the vehicle_id is missing or not a number
+    '''
+    try:
+        return vehicle_ids.astype('int64').to_numpy()
+    except (ValueError, TypeError):
+        return pd.to_numeric(vehicle_ids, errors='coerce').fillna(-1).astype('int64').to_numpy()
+
+
+def search_make_model_by_vehicle_id(search_results_df:pd.DataFrame) -> pd.DataFrame:
+    '''
+    make / model of the first search that found each vehicle, indexed by vehicle_id (int64, unique)
+    '''
+    search = pd.DataFrame({'make': search_results_df['make'].astype(str).to_numpy(),
+                           'model': search_results_df['model'].astype(str).to_numpy()},
+                          index=pd.Index(parse_vehicle_ids(search_results_df['vehicle_id']), name='vehicle_id'))
+    search = search[search.index >= 0]
+    return search[~search.index.duplicated(keep='first')]
+
+
+def build_download_manifest(image_urls_df:pd.DataFrame=None, search_results_df:pd.DataFrame=None) -> pd.DataFrame:
+    '''
+    Every image to download and where it goes, i.e. compile_download_df + build_download_jobs without the full merge:
+    the search results are reduced to one row per vehicle keyed by vehicle_id, each image looks up its vehicle's
+    row once through that index, and the folder path is built once per vehicle rather than once per image.
+
+    :param image_urls_df: e.g. compile_image_urls_df(); default: compile it
+    :param search_results_df: e.g. compile_search_results_df(); default: compile it
+    :return: DF with vehicle_image_url, relpath (make-{make}/model-{model}/vehicle_id-{vehicle_id}/{basename}),
+             vehicle_id (int64), make and model (category); images whose vehicle is in no search are left out
+    '''
+    if image_urls_df is None:
+        from find_vehicle_image_urls import compile_image_urls_df
+        image_urls_df = compile_image_urls_df()
+    if search_results_df is None:
+        from find_vehicle_image_urls import compile_search_results_df
+        search_results_df = compile_search_results_df()
+
+    search = search_make_model_by_vehicle_id(search_results_df)
+    makes = pd.Categorical(search['make'])
+    models = pd.Categorical(search['model'])
+    folders = ('make-' + search['make'] + '/model-' + search['model'] +
+               '/vehicle_id-' + search.index.astype(str).to_numpy() + '/').to_numpy()
+
+    images = image_urls_df.drop_duplicates(subset=['vehicle_image_url'])
+    positions = search.index.get_indexer(parse_vehicle_ids(images['vehicle_id']))
+    found = positions >= 0
+    positions = positions[found]
+
+    urls = images['vehicle_image_url'].astype(str).to_numpy(dtype=object)[found]
+    ## several times faster than .str.rsplit('/', n=1).str[-1] on millions of urls
+    basenames = np.array([url.rpartition('/')[2] for url in urls], dtype=object)
+    return pd.DataFrame({
+        'vehicle_image_url': urls,
+        'relpath': folders[positions] + basenames,
+        'vehicle_id': search.index.to_numpy()[positions],
+        'make': makes[positions],
+        'model': models[positions],
+    })
+
+
+def list_downloaded_files(images_dir:str=parent_directory_images) -> np.ndarray:
+    '''
+    :return: relpaths of every file in the make-*/model-*/vehicle_id-* tree, temp files excluded
+    '''
+    relpaths = []
+    if not os.path.isdir(images_dir):
+        return np.array(relpaths, dtype=object)
+    with os.scandir(images_dir) as makes:
+        for make_entry in makes:
+            if not (make_entry.is_dir() and make_entry.name.startswith('make-')):
+                continue
+            with os.scandir(make_entry.path) as models:
+                for model_entry in models:
+                    if not (model_entry.is_dir() and model_entry.name.startswith('model-')):
+                        continue
+                    with os.scandir(model_entry.path) as vehicles:
+                        for vehicle_entry in vehicles:
+                            if not (vehicle_entry.is_dir() and vehicle_entry.name.startswith('vehicle_id-')):
+                                continue
+                            prefix = f'{make_entry.name}/{model_entry.name}/{vehicle_entry.name}/'
+                            with os.scandir(vehicle_entry.path) as images:
+                                relpaths += [prefix + entry.name for entry in images
+                                             if not entry.name.endswith('.tmp')]
+    return np.array(relpaths, dtype=object)
+
+
+def pending_downloads(manifest:pd.DataFrame, images_dir:str=parent_directory_images, scan:bool=True) -> pd.DataFrame:
+    '''
+    the rows of manifest whose file is not there yet, checked in one isin against everything that is
+    :param scan: also walk images_dir, not just the download_images manifest of completed files
+                 (catches files that were downloaded some other way)
+    '''
+    from download_images import download_manifest_filename
+    present = []
+    manifest_path = os.path.join(images_dir, download_manifest_filename)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            present.append(np.array(f.read().split('\n'), dtype=object))
+    if scan:
+        present.append(list_downloaded_files(images_dir))
+    if len(present) == 0:
+        return manifest
+    present = np.concatenate(present)
+    return manifest[~manifest['relpath'].isin(present)].reset_index(drop=True)
+
+
+def write_pending_downloads(pending:pd.DataFrame, prefix:str=None, images_dir:str=parent_directory_images) -> str:
+    '''
+    save the urls and relpaths as two fixed-width byte arrays (.npy), which downloaders memory-map
+    and read in chunks, see iter_pending_downloads
+    :return: the prefix the arrays were saved under
+    '''
+    prefix = os.path.join(images_dir, pending_downloads_prefix) if prefix is None else prefix
+    for column, suffix in [('vehicle_image_url', 'urls'), ('relpath', 'relpaths')]:
+        values = pending[column].astype(str).str.encode('utf-8').to_numpy().astype(bytes)
+        tmp_path = f'{prefix}.{suffix}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, values)
+        os.replace(tmp_path, f'{prefix}.{suffix}.npy')
+    print(f'saved {len(pending)} pending downloads to {prefix}.*.npy')
+    return prefix
+
+
+def iter_download_chunks(pending:pd.DataFrame, chunk_size:int=download_chunk_size):
+    '''
+    :return: generator of lists of (image_url, relpath) jobs, for ImageDownloader.run_chunks
+    '''
+    urls = pending['vehicle_image_url'].to_numpy()
+    relpaths = pending['relpath'].to_numpy()
+    for start in range(0, len(pending), chunk_size):
+        yield list(zip(urls[start:start + chunk_size], relpaths[start:start + chunk_size]))
+
+
+def iter_pending_downloads(prefix:str=None, chunk_size:int=download_chunk_size,
+                           images_dir:str=parent_directory_images):
+    '''
+    read side of write_pending_downloads; only one chunk is decoded at a time
+    :return: generator of lists of (image_url, relpath) jobs
+    '''
+    prefix = os.path.join(images_dir, pending_downloads_prefix) if prefix is None else prefix
+    urls = np.load(f'{prefix}.urls.npy', mmap_mode='r')
+    relpaths = np.load(f'{prefix}.relpaths.npy', mmap_mode='r')
+    for start in range(0, len(urls), chunk_size):
+        yield list(zip(np.char.decode(urls[start:start + chunk_size], 'utf-8').tolist(),
+                       np.char.decode(relpaths[start:start + chunk_size], 'utf-8').tolist()))
+
+
+if __name__ == '__main__':
+    start = time.time()
+    manifest = build_download_manifest()
+    print(f'manifest - {len(manifest)} images in {time.time() - start:.1f}s')
+    start = time.time()
+    pending = pending_downloads(manifest)
+    print(f'pending - {len(pending)} images not downloaded yet, checked in {time.time() - start:.1f}s')
+    write_pending_downloads(pending)
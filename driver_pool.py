@@ -0,0 +1,154 @@
+import time
+import threading
+import queue
+import traceback
+from contextlib import contextmanager
+
+from find_vehicle_image_urls import browser, lean, driver_init
+
+
+class DriverPool:
+    '''
+    Keeps a handful of WebDriver sessions alive so that we pay browser startup once,
+    not once per listing.
+
+    usage:
+        pool = DriverPool(size=1, max_pages_per_driver=50)
+        with pool.checkout() as driver:
+            driver.get(url)
+        ...
+        pool.close()
+
+    A driver is recycled (quit and replaced by a fresh one) after max_pages_per_driver checkouts,
+    when the BrowserMonitor says so (too much memory, pages getting slower), or when it fails the health check
+    before being handed out again. Every checkout counts as one page for the monitor.
+    If the code inside the `with` block raises, the driver is considered broken and is discarded.
+    '''
+
+    def __init__(self, size:int=1, max_pages_per_driver:int=50, browser:str=browser, checkout_timeout:float=None,
+                 lean:bool=lean, monitor=None):
+        if monitor is None:
+            from browser_monitor import BrowserMonitor
+            monitor = BrowserMonitor(max_pages=None)  # pages are limited by max_pages_per_driver
+        self.size = size
+        self.monitor = monitor
+        self.max_pages_per_driver = max_pages_per_driver
+        self.browser = browser
+        self.lean = lean
+        self.checkout_timeout = checkout_timeout
+        self._idle = queue.LifoQueue()
+        self._pages = {}  # id(driver) -> number of checkouts so far
+        self._n_live = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _new_driver(self):
+        # no google warm-up, the first real page load does the same job
+        driver = driver_init(self.browser, warm_up=False, lean=self.lean)
+        if driver is None:
+            raise ValueError(f'unsupported browser {self.browser}')
+        with self._lock:
+            self._pages[id(driver)] = 0
+        print(f'driver pool - launched new {self.browser} driver ({self._n_live}/{self.size} live)')
+        return driver
+
+    def _quit(self, driver):
+        with self._lock:
+            if id(driver) not in self._pages:
+                return  # already discarded
+            del self._pages[id(driver)]
+            self._n_live -= 1
+        self._idle.put(None)  # wakes up a thread waiting in _acquire, it can launch a driver in the freed slot
+        self.monitor.forget(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @staticmethod
+    def is_healthy(driver) -> bool:
+        '''cheap round-trip to make sure the session and the browser behind it are still alive'''
+        try:
+            return driver.execute_script('return 1;') == 1
+        except Exception:
+            return False
+
+    def _acquire(self):
+        if self._closed:
+            raise RuntimeError('driver pool is closed')
+
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                driver = None
+
+            if driver is None:
+                with self._lock:
+                    can_launch = self._n_live < self.size
+                    if can_launch:
+                        self._n_live += 1
+                if can_launch:
+                    try:
+                        return self._new_driver()
+                    except Exception:
+                        with self._lock:
+                            self._n_live -= 1
+                        raise
+                # everybody is busy, wait for a driver to come back or for one to be quit
+                driver = self._idle.get(timeout=self.checkout_timeout)
+                if driver is None:
+                    continue
+
+            if self.is_healthy(driver):
+                return driver
+            print('driver pool - driver failed health check, replacing it')
+            self._quit(driver)
+
+    def _release(self, driver, elapsed:float=None):
+        with self._lock:
+            if id(driver) not in self._pages:
+                return  # discarded while checked out
+            self._pages[id(driver)] += 1
+            n_pages = self._pages[id(driver)]
+        reason = self.monitor.after_page(driver, elapsed, browser=self.browser)
+        if n_pages >= self.max_pages_per_driver:
+            reason = 'pages'
+        if self._closed or reason is not None:
+            print(f'driver pool - recycling driver after {n_pages} pages ({reason})')
+            self._quit(driver)
+        else:
+            self._idle.put(driver)
+
+    def discard(self, driver):
+        '''throw away a driver that is known to be broken'''
+        self._quit(driver)
+
+    @contextmanager
+    def checkout(self):
+        driver = self._acquire()
+        start = time.perf_counter()
+        try:
+            yield driver
+        except Exception:
+            print(f"driver pool - discarding driver after error:\n", traceback.format_exc())
+            self._quit(driver)
+            raise
+        else:
+            self._release(driver, time.perf_counter() - start)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if driver is not None:
+                self._quit(driver)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
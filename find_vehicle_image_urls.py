@@ -1,27 +1,49 @@
-import selenium
-from selenium import webdriver
-from selenium.webdriver.firefox.service import Service
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
-
-from webdriver_manager.chrome import ChromeDriverManager
-from random_user_agent.user_agent import UserAgent
-from random_user_agent.params import SoftwareName, OperatingSystem
 import random
 import datetime as dt
 import time
-import matplotlib.pyplot as plt
 import re
-import cv2
 import os
+import importlib
 import numpy as np
 import pandas as pd
 import csv
 import traceback
+import functools
 from timethis import timethis
+from scraper_metrics import metrics, count_buckets
+
+## selenium, webdriver_manager and random_user_agent are imported inside the functions that drive a browser,
+## so that e.g. compiling the metadata or starting a worker does not pay for them.
+## They (and the old matplotlib / cv2 imports) are still reachable as attributes of this module, imported on first use
+lazy_imports = {
+    'selenium': ('selenium', None),
+    'webdriver': ('selenium', 'webdriver'),
+    'Service': ('selenium.webdriver.firefox.service', 'Service'),
+    'Options': ('selenium.webdriver.firefox.options', 'Options'),
+    'By': ('selenium.webdriver.common.by', 'By'),
+    'WebDriverWait': ('selenium.webdriver.support.ui', 'WebDriverWait'),
+    'Select': ('selenium.webdriver.support.ui', 'Select'),
+    'EC': ('selenium.webdriver.support.expected_conditions', None),
+    'NoSuchElementException': ('selenium.common.exceptions', 'NoSuchElementException'),
+    'TimeoutException': ('selenium.common.exceptions', 'TimeoutException'),
+    'ChromeDriverManager': ('webdriver_manager.chrome', 'ChromeDriverManager'),
+    'UserAgent': ('random_user_agent.user_agent', 'UserAgent'),
+    'SoftwareName': ('random_user_agent.params', 'SoftwareName'),
+    'OperatingSystem': ('random_user_agent.params', 'OperatingSystem'),
+    'plt': ('matplotlib.pyplot', None),
+    'cv2': ('cv2', None),
+}
+
+
+def __getattr__(name:str):
+    if name not in lazy_imports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module_name, attribute = lazy_imports[name]
+    value = importlib.import_module(module_name)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
 
 
 ####################################
@@ -32,17 +54,47 @@ chrome_path = "/Applications/chrome-mac-x64/Google Chrome for Testing.app/Conten
 browser='chrome'
 parent_directory_url_csvs='/Users/levgolod/Projects/car_classifier/data/autotrader/vehicle_metadata/'
 parent_directory_images='/Users/levgolod/Projects/car_classifier/data/autotrader/vehicle_images/'
+image_blob_dir='/Users/levgolod/Projects/car_classifier/data/autotrader/image_blobs/'
+image_store_path='/Users/levgolod/Projects/car_classifier/data/autotrader/image_store.sqlite'
+output_format='csv' # 'csv': one file per listing / search, 'jsonl': batched part files via listing_writer
+training_shards_dir='/Users/levgolod/Projects/car_classifier/data/autotrader/training_shards/'
+metadata_store_path='/Users/levgolod/Projects/car_classifier/data/autotrader/vehicle_metadata.sqlite'
+crawl_frontier_path='/Users/levgolod/Projects/car_classifier/data/autotrader/crawl_frontier.sqlite'
+search_planner_path='/Users/levgolod/Projects/car_classifier/data/autotrader/search_planner.sqlite'
+page_archive_dir='/Users/levgolod/Projects/car_classifier/data/autotrader/page_archive/'
+# zips_filepath='~/Projects/car_classifier/data/simplemaps_uszips_basicv1.90/uszips.csv'
+zips_filepath='./data/simplemaps_uszips_basicv1.90/uszips.csv'
+location_sampling_weights='uniform' # 'uniform' or 'population'
 vehicle_url_template='https://www.autotrader.com/cars-for-sale/vehicle/{vehicle_id}'
 wait_time=10
 scroll_pause_time = 0.2  # Adjust based on load time
 scroll_distance = 500 # pixels
 max_scrolls = 100
+search_page_size = 25 # listings per search results page
 # headless=True
 headless=False
+lean=False # block images / media / fonts / analytics, run headless, return from driver.get at DOMContentLoaded
+tabs_per_browser=4 # listings in flight per browser with tab_concurrency
 ####################################
 
+## request patterns a lean chrome driver never loads; image urls are still in the DOM, which is all we read
+lean_blocked_url_patterns = [
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.mp4', '*.webm', '*.m3u8', '*.mp3',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*', '*googlesyndication.com*',
+    '*facebook.net*', '*hotjar.com*', '*optimizely.com*', '*newrelic.com*', '*nr-data.net*',
+    '*demdex.net*', '*omtrdc.net*', '*adobedtm.com*', '*bat.bing.com*', '*criteo.com*', '*quantserve.com*',
+]
+
+## what a listing / search results page load came to, in df.attrs['outcome'] of what
+## process_vehicle_webpage / find_listings_for_make_model return
+page_outcomes = ['success', 'empty', 'site_unavailable', 'timeout', 'error']
+
 
 def create_random_user_agent():
+    from random_user_agent.user_agent import UserAgent
+    from random_user_agent.params import SoftwareName, OperatingSystem
     software_names = [SoftwareName.CHROME.value, SoftwareName.FIREFOX.value]
     operating_systems = [OperatingSystem.WINDOWS.value, OperatingSystem.MACOS.value]
     ua = UserAgent(software_names=software_names, operating_systems=operating_systems, limit=100)
@@ -50,29 +102,79 @@ def create_random_user_agent():
     return random_user_agent
 
 
-def firefox_driver_init(headless:bool=False, randomize:bool=True) -> webdriver.Firefox:
+def firefox_driver_init(headless:bool=False, randomize:bool=True, lean:bool=False):
+    from selenium import webdriver
+    from selenium.webdriver.firefox.service import Service
+    from selenium.webdriver.firefox.options import Options
     firefox_options = Options()
     random_user_agent = create_random_user_agent()
     firefox_options.set_preference("general.useragent.override", random_user_agent)
-    if headless:
+    if headless or lean:
         firefox_options.add_argument("--headless")
+    if lean:
+        ## firefox has no request blocking over webdriver, so only what prefs can turn off
+        firefox_options.set_preference("permissions.default.image", 2)
+        firefox_options.set_preference("media.autoplay.default", 5)
+        firefox_options.set_preference("gfx.downloadable_fonts.enabled", False)
+        firefox_options.page_load_strategy = 'eager'
     service = Service(geckodriver_path)
     driver = webdriver.Firefox(service=service, options=firefox_options)
     return driver
 
 
 
-def chrome_driver_init():
-    import webdriver_manager
+@functools.lru_cache(maxsize=None)
+def resolve_chromedriver_path() -> str:
+    '''
+    ChromeDriverManager().install() checks versions / hits the network every time it is called,
+    so only do it once per process
+    '''
+    from webdriver_manager.chrome import ChromeDriverManager
+    return ChromeDriverManager().install()
+
+
+def block_lean_urls(driver):
+    '''
+    block lean_blocked_url_patterns at the network layer, images set via css / srcset and fonts are not covered
+    by the lean prefs; applies to the tab the driver is on only, call it again for every tab opened later
+    '''
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': lean_blocked_url_patterns})
+
+
+def chrome_driver_init(warm_up:bool=True, lean:bool=False, page_load_strategy:str=None,
+                       extra_arguments:list=None):
+    '''
+    :param lean: headless, no images / media / fonts / analytics, and driver.get returns at DOMContentLoaded;
+                 the scrolling code waits for the content it needs anyway
+    :param page_load_strategy: overrides the one lean picks, e.g. 'none' for tab_concurrency
+    :param extra_arguments: more chrome command line switches
+    '''
     from selenium import webdriver
     from selenium.webdriver.chrome.service import Service
-    from webdriver_manager.chrome import ChromeDriverManager
     chrome_path = "/Applications/chrome-mac-x64/Google Chrome for Testing.app/Contents/MacOS/Google Chrome for Testing"
     options = webdriver.ChromeOptions()
     options.binary_location = chrome_path
     # options.page_load_strategy = "none" # too aggressive, not worth it
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    driver.get("https://www.google.com")
+    if lean:
+        options.page_load_strategy = 'eager'
+        options.add_argument('--headless=new')
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_argument('--mute-audio')
+        options.add_argument('--autoplay-policy=user-gesture-required')
+        options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+            'profile.default_content_setting_values.notifications': 2,
+        })
+    if page_load_strategy is not None:
+        options.page_load_strategy = page_load_strategy
+    for argument in extra_arguments or []:
+        options.add_argument(argument)
+    driver = webdriver.Chrome(service=Service(resolve_chromedriver_path()), options=options)
+    if lean:
+        block_lean_urls(driver)
+    if warm_up:
+        driver.get("https://www.google.com")
     return driver
 
 
@@ -102,14 +204,13 @@ def get_vehicle_make_model_list():
     return vehicles
 
 
-def load_geog_df() -> pd.DataFrame:
+def load_geog_df(zips_filepath:str=zips_filepath) -> pd.DataFrame:
     '''
     Source https://simplemaps.com/data/us-zips
+    NB: for picking search locations use geography_index.get_geography_index(), which does not re-read the csv
     :return:
     beverly-hills-ca
     '''
-    # zips_filepath='~/Projects/car_classifier/data/simplemaps_uszips_basicv1.90/uszips.csv'
-    zips_filepath='./data/simplemaps_uszips_basicv1.90/uszips.csv'
     zips_df = pd.read_csv(zips_filepath)
     zips_df['zip'] =zips_df['zip'].astype(str).str.zfill(5)
     zips_df['city_state_lower'] = zips_df['city'].str.lower().str.replace(' ','-') + '-' + \
@@ -127,9 +228,12 @@ def load_zipcodes() -> list:
 
 
 
+## group 1: the url without query string, group 2: the vehicle id
+vehicle_url_pattern = r'^(https?://.*?/vehicle/([a-zA-Z0-9]*))(?:\?.*)?$'
+
+
 def clean_vehicle_url(url:str) -> str:
-    pattern = r'^(https://.*?/vehicle/[a-zA-Z0-9]*)(\?.*)?$'
-    re_result = re.match(pattern, str(url))
+    re_result = re.match(vehicle_url_pattern, str(url))
     if bool(re_result):
         return re_result.group(1)
     else:
@@ -150,6 +254,7 @@ def get_clean_vin(vin_text:str) -> str:
 
 
 def get_search_result_count(driver) -> int:
+    from selenium.webdriver.common.by import By
     try:
         result_count_element = driver.find_element(By.CSS_SELECTOR, '[data-cmp="resultsCount"]')
         result_count_text = result_count_element.text
@@ -170,22 +275,11 @@ def find_image_urls(driver) -> list:
 
 def find_image_urls_v2(driver) -> list:
     # more flexible
-    image_url_prefix = 'https://images.autotrader.com/'
-    urls = list(filter(
-        lambda x: str(x).startswith(image_url_prefix),
-        str(driver.page_source).split()
-    ))
-    df_urls = pd.DataFrame({'url': urls})
-    df_urls['filename'] = df_urls['url'].apply(
-        lambda x: os.path.basename(x).split('.')[0]
-    )
     # for each unique filename, keep the url w the largest image size e.g. 500
-    df_urls = df_urls.sort_values(by=['filename', 'url'], ascending=[1, 0])
-    df_urls.reset_index(drop=True, inplace=True)
-    df_urls2 = df_urls.groupby('filename').head(1)
-    # print(len(df_urls),len(df_urls2))
-    df_urls2
-    return list(df_urls2['url'])
+    from image_url_collector import ImageUrlCollector
+    collector = ImageUrlCollector()
+    collector.add_page_source(driver.page_source)
+    return collector.urls
 
 
 
@@ -212,6 +306,10 @@ def find_vehicle_listing_links(driver) -> list:
         ),
     ]
     '''
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import NoSuchElementException, TimeoutException
     try:
         WebDriverWait(driver, wait_time).until(
             EC.visibility_of_element_located(
@@ -238,9 +336,10 @@ def wait_for_scrollbar(driver, timeout=wait_time):
     :param timeout: Maximum time (in seconds) to wait for the scrollbar
     :return: True if scrollbar exists, False otherwise
     """
+    from selenium.webdriver.support.ui import WebDriverWait
     try:
-        WebDriverWait(driver, timeout).until(
-            lambda d: driver.execute_script("return document.body.scrollHeight") > driver.execute_script("return window.innerHeight")
+        WebDriverWait(driver, timeout, poll_frequency=0.1).until(
+            lambda d: d.execute_script("return document.body.scrollHeight > window.innerHeight;")
         )
         print("Scrollbar detected!")
         return True
@@ -251,27 +350,41 @@ def wait_for_scrollbar(driver, timeout=wait_time):
 
 def get_scroll_percentage(driver):
     """Returns how far down the page is scrolled as a percentage."""
-    scroll_top = driver.execute_script("return window.scrollY;")  # Current scroll position
-    scroll_height = driver.execute_script("return document.documentElement.scrollHeight;")  # Total scroll height
-    client_height = driver.execute_script("return window.innerHeight;")  # Viewport height
+    from page_readiness import get_page_state
+    state = get_page_state(driver)  # one round-trip instead of one per measurement
 
     # Calculate percentage (0 to 100)
-    scroll_percentage = (scroll_top / (scroll_height - client_height)) * 100
+    scroll_percentage = (state['scrollTop'] / max(state['scrollHeight'] - state['clientHeight'], 1)) * 100
     return round(scroll_percentage, 2)
 
 
-def scroll_down_incrementally(driver, scroll_distance=scroll_distance, wait=0.1, verbose=False):
+def scroll_down_incrementally(driver, scroll_distance=scroll_distance, expected_count:int=None, verbose=False):
     # todo should start by scrolling all the way to the top?
-    current_pct = get_scroll_percentage(driver)
-    i=0
-    while (current_pct < 100) and (i<=max_scrolls):
-        i+=1
-        message = f'scrolling {i}, {current_pct}%'
-        if verbose:
-            print(message)
-        driver.execute_script(f"window.scrollBy(0, {scroll_distance});")
-        current_pct = get_scroll_percentage(driver)
-        time.sleep(wait)
+    # scroll until the page stops growing (or shows expected_count listings), waiting on the page instead of a fixed sleep
+    from page_readiness import scroll_until_loaded
+    n_steps = {'n': 0}
+
+    def on_step(state):
+        n_steps['n'] += 1
+
+    with metrics.timer('scroll_seconds', target='search_results'):
+        state = scroll_until_loaded(driver, expected_count=expected_count, min_distance=scroll_distance,
+                                    on_step=on_step, verbose=verbose)
+    metrics.observe('scroll_steps', n_steps['n'], buckets=count_buckets, target='search_results')
+    return state
+
+
+def get_expected_listing_count(driver) -> int:
+    '''
+    how many listings the current search results page should show, given the total result count and firstRecord
+    :return: None if the result count is not on the page
+    '''
+    result_count = get_search_result_count(driver)
+    if result_count < 0:
+        return None
+    first_record = re.search(r'[?&]firstRecord=([0-9]+)', str(driver.current_url))
+    first_record = int(first_record.group(1)) if first_record else 0
+    return max(0, min(search_page_size, result_count - first_record))
 
 
 def check_for_site_unavailable(driver):
@@ -286,6 +399,9 @@ def get_image_urls_from_view_all_media_button(driver) -> list:
     :param driver:
     :return:
     '''
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
     ## 'view all media' button to see the images
     view_all_media_element = WebDriverWait(driver, wait_time).until(
         EC.visibility_of_element_located(
@@ -303,148 +419,171 @@ def get_image_urls_from_view_all_media_button(driver) -> list:
     )
 
     ## try to scroll in a more naturalistic way    # scroll gradually until there all new image urls are captured
-    image_urls = find_image_urls_v2(driver)
-    last_length = len(image_urls)
-    i = 0
-    n_useless_scrolls=0
-    while True:
-        # Scroll down by a small amount
-        driver.execute_script(f"arguments[0].scrollTop += {scroll_distance};", scroll_panel)
-        # print(f'they see me scrollin, they hatin ({i})')
-        i += 1
-        time.sleep(scroll_pause_time)  # Wait for content to load
-        image_urls = find_image_urls_v2(driver)
-        new_length = len(image_urls)
-        n_useless_scrolls += int(new_length == last_length)
-
-        if (n_useless_scrolls >= 5):
-            print(f'the futility is unbearable {i} {n_useless_scrolls}')
-            break
+    # the collector watches the page from inside the browser, so each step only ships the urls that are new,
+    # and each step waits for the panel to settle instead of sleeping a fixed amount
+    from image_url_collector import ImageUrlCollector
+    from page_readiness import scroll_until_loaded
+    collector = ImageUrlCollector()
+    collector.install(driver)
+    progress = {'i': 0, 'n_useless_scrolls': 0}
+
+    def on_step(state):
+        progress['i'] += 1
+        n_new = collector.add(state['drained'])
+        progress['n_useless_scrolls'] += int(n_new == 0)
+        if progress['n_useless_scrolls'] >= 5:
+            print(f'the futility is unbearable {progress["i"]} {progress["n_useless_scrolls"]}')
+            return True
+        return False
 
-        if (i >= max_scrolls):
-            print(f'cant scroll anymore boss {i} {n_useless_scrolls}')
-            break
+    with metrics.timer('scroll_seconds', target='media_panel'):
+        state = scroll_until_loaded(driver, element=scroll_panel, on_step=on_step)
+    metrics.observe('scroll_steps', progress['i'], buckets=count_buckets, target='media_panel')
+    if progress['i'] >= max_scrolls:
+        print(f'cant scroll anymore boss {progress["i"]} {progress["n_useless_scrolls"]}')
+    elif state['atBottom']:
+        print(f'reached the bottom of the media panel {progress["i"]} {progress["n_useless_scrolls"]}')
 
-        last_length = new_length
+    collector.drain(driver)
+    return collector.urls
 
-    return image_urls
 
 
+def save_metadata_df(df:pd.DataFrame, kind:str, filename:str):
+    '''
+    :param kind: 'image_urls' or 'search_results'
+    :param filename: csv name, used when output_format is 'csv'
+    '''
+    with metrics.timer('csv_write_seconds', kind=kind):
+        if output_format == 'csv':
+            filepath = f'{parent_directory_url_csvs}{filename}'
+            print(f'saving to {filepath}')
+            df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+        else:
+            from listing_writer import get_listing_writer
+            get_listing_writer(kind, parent_directory_url_csvs).write(df)
 
-def driver_init(browser:str=browser):
-    if browser == 'chrome':
-        return chrome_driver_init()
-    elif browser == 'firefox':
-        return firefox_driver_init(headless=headless)
 
-    return None
+def driver_init(browser:str=browser, warm_up:bool=True, lean:bool=lean):
+    with metrics.timer('driver_init_seconds', browser=browser):
+        if browser == 'chrome':
+            return chrome_driver_init(warm_up=warm_up, lean=lean)
+        elif browser == 'firefox':
+            return firefox_driver_init(headless=headless, lean=lean)
 
+    return None
 
-def process_vehicle_webpage(url:str, quit:bool=True) -> tuple:
 
+def build_listing_df(image_urls:list, url_cleaned:str, fields) -> pd.DataFrame:
+    '''
+    the rows saved for one vehicle listing, one per image url
+    :param fields: listing_extraction.ListingFields
+    '''
+    df = pd.DataFrame({'vehicle_image_url': image_urls})
+    df['vehicle_id']= url_cleaned.split('/')[-1]
+    df['url']= url_cleaned
+    df['vin']= fields.vin
+    df['year_make_model'] = fields.year_make_model
+    df['list_price'] = fields.list_price
+    df['listing_details'] = fields.listing_detail
+    df['listing_narrative'] = fields.listing_narrative
+    return df.drop_duplicates()
+
+
+def process_vehicle_webpage(url:str, quit:bool=True, driver=None, pool=None, archive=None,
+                            recycle:bool=True) -> tuple:
+    '''
+    :param url:
+    :param quit: quit the driver when done
+    :param driver: reuse an existing browser session instead of launching a new one
+    :param pool: DriverPool to check a driver out of (and return it to); takes precedence over driver/quit
+    :param archive: PageArchive to save the final html of the page in, for replaying extraction later
+    :param recycle: with quit=False, let browser_monitor quit the driver when it is due for a restart
+                    (the returned driver is then None); a DriverPool does this itself
+    :return: (pd.DataFrame, driver); df.attrs['outcome'] is one of page_outcomes
+    '''
+    if pool is not None:
+        with pool.checkout() as pooled_driver:
+            df, pooled_driver_after = process_vehicle_webpage(url, quit=False, driver=pooled_driver, archive=archive,
+                                                              recycle=False)
+            if pooled_driver_after is None:
+                pool.discard(pooled_driver)
+        return df, None
+
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import NoSuchElementException, TimeoutException
     url_cleaned = clean_vehicle_url(url)
     vehicle_id = url_cleaned.split('/')[-1]
+    start = time.perf_counter()
 
-    ## initialize browser session
-    # driver = firefox_driver_init(headless=headless)
-    driver = driver_init()
+    ## initialize browser session - unless of course it is already initialized
+    if driver is None:
+        # driver = firefox_driver_init(headless=headless)
+        driver = driver_init()
 
     ## giant try-except because otherwise the driver will not get closed at the end
     df=pd.DataFrame()
+    outcome = 'error'
     try:
 
-        driver.get(url_cleaned)
+        with metrics.timer('page_load_seconds', page='listing'):
+            driver.get(url_cleaned)
         print(f"single vehicle listing [{url_cleaned}]- webpage initiated\n")
 
-        ## capture year make model as text
+        ## wait for the heading (year make model) to show up, as a sign that the page has rendered
         try:
-            year_make_model_element = WebDriverWait(driver, wait_time).until(
+            WebDriverWait(driver, wait_time).until(
                 EC.visibility_of_element_located(
                     (By.CSS_SELECTOR, 'h1[data-cmp="heading"]#vehicle-details-heading')
                 )
             )
-            year_make_model = year_make_model_element.text
-            print(f'year_make_model - success')
         except (NoSuchElementException, TimeoutException):
-            year_make_model = None
-            print(f'year_make_model - fail')
+            print(f'year_make_model - not visible after {wait_time} seconds')
 
-        page_unavailable = check_for_site_unavailable(driver)
+        ## one snapshot of the page, all fields parsed from it locally instead of one webdriver round-trip per field
+        # todo if list price fails can try to get it from the image gallery
+        from listing_extraction import extract_listing_fields
+        with metrics.timer('extraction_seconds'):
+            fields = extract_listing_fields(driver.page_source)
 
-        if  page_unavailable:
-            message=f' page_unavailable {page_unavailable}; that is not good!'
+        if fields.page_unavailable:
+            message=f' page_unavailable {fields.page_unavailable}; that is not good!'
             print(message)
+            metrics.inc('listings_total', outcome='site_unavailable')
+            metrics.maybe_export()
             driver.quit()
-            return pd.DataFrame(), None
-
-
-        ## listing price
-        # todo if this fails can try to get it from the image gallery
-        '''
-        <div class="modal-header"><h4 id="modal-title" class="modal-title">Used 2022 Porsche Taycan<span class="text-normal"> - $60,944</span>
-        </h4><button data-cmp="closeButton" class="close" aria-label="Close" type="button"><span class="glyphicon glyphicon-remove"></span></button></div>
-        '''
-        try:
-            list_price_element = driver.find_element(By.CSS_SELECTOR, '[data-cmp="listingPrice"]')
-            list_price = clean_text_remove_newline(list_price_element.text)
-            list_price = list_price.split('^')[-1].strip()
-            print(f'list_price - success')
-        except (NoSuchElementException, TimeoutException):
-            list_price = None
-            print(f'list_price - fail')
-
+            df.attrs['outcome'] = 'site_unavailable'
+            return df, None
 
-        ## VIN
-        try:
-            vin_element = driver.find_element(By.CSS_SELECTOR, 'span.display-block.display-sm-inline-block')
-            vin = get_clean_vin(vin_element.text)
-            print(f'vin - success')
-        except (NoSuchElementException, TimeoutException):
-            vin = None
-            print(f'vin - fail')
-
-
-        ## listing details e.g. mileage
-        try:
-            listing_detail_element = driver.find_element(By.CSS_SELECTOR, 'ul[data-cmp="listColumns"].list.columns.columns-1')
-            listing_detail = listing_detail_element.text
-            listing_detail = clean_text_remove_newline(listing_detail)
-            print(f'listing_detail - success')
-        except (NoSuchElementException, TimeoutException):
-            listing_detail = None
-            print(f'listing_detail - fail')
-
-        try:
-            listing_narrative_element = driver.find_element(By.CSS_SELECTOR, '[data-cmp="seeMore"]')
-            listing_narrative = clean_text_remove_newline(listing_narrative_element.text)
-            print(f'listing_narrative - success')
-        except (NoSuchElementException, TimeoutException):
-            listing_narrative = None
-            print(f'listing_narrative - fail')
-
-
-        ## also attempt to just get the header image
-        try:
-            header_image_url = driver.find_element(By.CSS_SELECTOR, '[data-cmp="responsiveImage"]').get_attribute('src')
-            print(f'header image - success')
-        except (NoSuchElementException, TimeoutException):
-            header_image_url = None
-            print(f'header image - fail')
+        for field_name in ['year_make_model', 'list_price', 'vin', 'listing_detail', 'listing_narrative', 'header_image_url']:
+            outcome = "fail" if getattr(fields, field_name) is None else "success"
+            print(f'{field_name} - {outcome}')
+            metrics.inc('field_extractions_total', field=field_name, outcome=outcome)
+        header_image_url = fields.header_image_url
 
         ## attept to use View ALl Media button if it exists
         try:
             image_urls = get_image_urls_from_view_all_media_button(driver)
             print(f'get_image_urls_from_view_all_media_button - success - {len(image_urls)}')
+            metrics.inc('field_extractions_total', field='view_all_media', outcome='success')
 
         except (NoSuchElementException, TimeoutException):
             image_urls=[]
             print(f'get_image_urls_from_view_all_media_button - fail')
+            metrics.inc('field_extractions_total', field='view_all_media', outcome='fail')
 
         if header_image_url is not None:
             image_urls+=[str(header_image_url)]
 
+        ## the page as it is after scrolling through the media gallery
+        if archive is not None:
+            archive.add_driver_page('listing', vehicle_id, driver)
+
         message = f'found {len(image_urls)} images'
         print(message)
+        metrics.observe('images_per_listing', len(image_urls), buckets=count_buckets)
 
         if quit:
             driver.quit()
@@ -452,38 +591,37 @@ def process_vehicle_webpage(url:str, quit:bool=True) -> tuple:
 
         ## save to disk
         if len(image_urls) >0:
-            df = pd.DataFrame({'vehicle_image_url': image_urls})
-            df['vehicle_id']= vehicle_id
-            df['url']= url_cleaned
-            df['vin']= vin
-            df['year_make_model'] = year_make_model
-            df['list_price'] = list_price
-            df['listing_details'] = listing_detail
-            df['listing_narrative'] = listing_narrative
-            df=df.drop_duplicates()
+            df = build_listing_df(image_urls, url_cleaned, fields)
             print(df.head(1).T)
-            filepath = f'{parent_directory_url_csvs}{vehicle_id}.csv'
-            message=f'saving to {filepath}'
-            print(message)
-            df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+            save_metadata_df(df, 'image_urls', f'{vehicle_id}.csv')
+            outcome = 'success'
         else:
             print(f'no images; not saving csv')
+            outcome = 'empty'
 
 
     except Exception as e:
         error_message = traceback.format_exc()
         print(f"process_vehicle_webpage [{url}] Error Traceback:\n", error_message)
-        driver.quit()
+        if driver is not None:
+            driver.quit()
         driver = None
         df = pd.DataFrame()
-
-
+        outcome = 'timeout' if isinstance(e, TimeoutException) else 'error'
+
+    if recycle and driver is not None:
+        from browser_monitor import recycle_if_needed
+        driver = recycle_if_needed(driver, time.perf_counter() - start, browser=browser)
+    metrics.inc('listings_total', outcome='success' if len(df) > 0 else 'fail')
+    metrics.maybe_export()
+    df.attrs['outcome'] = outcome
     return df, driver
 
 
-def capture_listings_from_current_page(driver) -> tuple:
+def capture_listings_from_current_page(driver, archive=None) -> tuple:
     '''
     :param driver:
+    :param archive: PageArchive to save the final html of the page in, keyed by the search url
     :return: (pd.DataFrame, driver)
     '''
 
@@ -495,10 +633,14 @@ def capture_listings_from_current_page(driver) -> tuple:
         message = f'scrollbar failed to load {not scrollbar_exists} and/or page_unavailable {page_unavailable}; that is not good!'
         print(message)
         driver.quit()
-        return pd.DataFrame(), None
+        df = pd.DataFrame()
+        df.attrs['outcome'] = 'site_unavailable' if page_unavailable else 'timeout'
+        return df, None
 
-    scroll_down_incrementally(driver)
+    scroll_down_incrementally(driver, expected_count=get_expected_listing_count(driver))
     vehicle_listing_links = find_vehicle_listing_links(driver)
+    if archive is not None:
+        archive.add_driver_page('search', driver.current_url, driver)
 
     ##  check if I got all the listings or not
     result_count_expected = get_search_result_count(driver)
@@ -517,13 +659,34 @@ def capture_listings_from_current_page(driver) -> tuple:
     df['search_url'] = current_url
     search_timestamp = int(time.time())
     df['search_timestamp'] = search_timestamp
+    df['result_count'] = result_count_expected
     print(df.head(1).T)
     return df, driver
 
 
-def find_listings_for_make_model(vehicle_info:dict, driver=None, quit:bool=True) -> tuple:
+def find_listings_for_make_model(vehicle_info:dict, driver=None, quit:bool=True, pool=None, frontier=None,
+                                 search_id:int=None, archive=None, recycle:bool=True) -> tuple:
+    '''
+    :param vehicle_info: dict with make, model and optionally zipcode, city_state_lower, first_record
+    :param driver: reuse an existing browser session instead of launching a new one
+    :param quit: quit the driver when done
+    :param pool: DriverPool to check a driver out of (and return it to); takes precedence over driver/quit
+    :param frontier: CrawlFrontier; the listings found are queued in it as listing jobs
+    :param search_id: id of the frontier search job this search is running, if any
+    :param archive: PageArchive to save the search results page in
+    :param recycle: with quit=False, let browser_monitor quit the driver when it is due for a restart
+                    (the returned driver is then None); a DriverPool does this itself
+    :return: (pd.DataFrame, driver); df.attrs['outcome'] is one of page_outcomes
+    '''
+    if pool is not None:
+        with pool.checkout() as pooled_driver:
+            df, pooled_driver_after = find_listings_for_make_model(vehicle_info, driver=pooled_driver, quit=False,
+                                                                   frontier=frontier, search_id=search_id,
+                                                                   archive=archive, recycle=False)
+            if pooled_driver_after is None:
+                pool.discard(pooled_driver)
+        return df, None
 
-    df_geog = load_geog_df()
     search_radius=0 # 0 corresponds to nationwide
     sort_by='distanceASC' # e.g. 'datelistedDESC','distanceASC'
 
@@ -533,9 +696,13 @@ def find_listings_for_make_model(vehicle_info:dict, driver=None, quit:bool=True)
     city_state = vehicle_info.get('city_state_lower')
     if zipcode is None:
         print('choose random location within USA')
-        location = list(df_geog.sample(n=1).to_dict('records'))[0]
+        from geography_index import get_geography_index
+        location = get_geography_index().sample_location(location_sampling_weights)
         zipcode = location['zip']
         city_state = location['city_state_lower']
+    elif city_state is None:
+        from geography_index import get_geography_index
+        city_state = get_geography_index().city_state_for_zip(zipcode)
 
 
     ## you can do a lot by messing with the url, you know. really quite a bit. not everyone knows that.
@@ -548,6 +715,7 @@ def find_listings_for_make_model(vehicle_info:dict, driver=None, quit:bool=True)
     #
 
     ## initialize browser session - unless of course it is already initialized
+    start = time.perf_counter()
     if driver is None:
         # driver = firefox_driver_init(headless=headless)
         # driver = chrome_driver_init()
@@ -555,12 +723,16 @@ def find_listings_for_make_model(vehicle_info:dict, driver=None, quit:bool=True)
 
     ## giant try-except because otherwise the driver will not get closed at the end
     df=pd.DataFrame()
+    outcome = 'error'
     try:
 
-        driver.get(url)
+        with metrics.timer('page_load_seconds', page='search_results'):
+            driver.get(url)
         print(f"make/model search [{url}] webpage initiated\n")
 
-        df,driver = capture_listings_from_current_page(driver)
+        df,driver = capture_listings_from_current_page(driver, archive=archive)
+        if len(df) == 0:
+            outcome = df.attrs.get('outcome', 'empty')
         assert len(df)>0
 
         df['make'] = make
@@ -568,78 +740,132 @@ def find_listings_for_make_model(vehicle_info:dict, driver=None, quit:bool=True)
         df['search_metadata'] = str(vehicle_info)
         search_timestamp = list(df['search_timestamp'])[0]
 
+        if frontier is not None:
+            n_new = frontier.add_listing_jobs(df, search_id=search_id)
+            print(f'queued {n_new} new listing jobs ({len(df) - n_new} already known)')
+
         ## prepare result DF
         if quit:
             driver.quit()
             driver = None
 
-        filename =f'search_results_{make}_{model}_{search_timestamp}'
-        filepath = f'{parent_directory_url_csvs}{filename}.csv'
-        message=f'saving to {filepath}'
-        print(message)
-        df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+        save_metadata_df(df, 'search_results', f'search_results_{make}_{model}_{search_timestamp}.csv')
+        outcome = 'success'
 
     except Exception as e:
         error_message = traceback.format_exc()
         print(f"find_listings_for_make_model [{url}] Error Traceback:\n", error_message)
-        driver.quit()
+        if driver is not None:  # capture_listings_from_current_page may have quit it already
+            driver.quit()
         driver = None
         df = pd.DataFrame()
-
+        from selenium.common.exceptions import TimeoutException
+        if isinstance(e, TimeoutException):
+            outcome = 'timeout'
+
+    if recycle and driver is not None:
+        from browser_monitor import recycle_if_needed
+        driver = recycle_if_needed(driver, time.perf_counter() - start, browser=browser)
+    metrics.inc('searches_total', outcome='success' if len(df) > 0 else 'fail')
+    metrics.maybe_export()
+    df.attrs['outcome'] = outcome
     return df, driver
 
 
-def compile_search_results_df() ->pd.DataFrame:
+def sweep_search_results(vehicle_info:dict, known_vehicle_ids:set=None, driver=None, quit:bool=True, pool=None,
+                         frontier=None, max_pages:int=None, min_new_fraction:float=0.2, patience:int=2,
+                         sleep:float=0, archive=None) -> tuple:
     '''
-    :return:
-    DF where each row represents on vehicle listing with a unique url and vehicle id
-
-    Also contains make/model of the SEARCH from which the url was captured
-    NB: This might not be the make/model of the actual vehicle;
-     The vehicle listing page is the ultimate source of truth on the make/model of the vehicle
-
+    Walk the search results pages (firstRecord=0, 25, 50, ...) of one make/model/location,
+    instead of looking at a single page.
+
+    Stops when
+    - the result count is exhausted, or
+    - `patience` pages in a row had fewer than min_new_fraction vehicle ids we did not know yet, or
+    - max_pages pages were loaded, or a page comes back empty
+
+    :param vehicle_info: like for find_listings_for_make_model; first_record is where the sweep starts
+    :param known_vehicle_ids: vehicle ids already collected e.g. set(compile_search_results_df()['vehicle_id']);
+                              updated in place with everything the sweep finds
+    :return: (pd.DataFrame of all pages, driver)
     '''
-    ## compile search results from multiple csvs intoo one df
-    # folder="/Users/levgolod/Projects/car_classifier/data/autotrader/vehicle_metadata/"
-    folder=parent_directory_url_csvs
-    pattern=r'search_results_.*[0-9]*csv'
-    usecols=['listing_header',
-     'url',
-     'search_url',
-     'make',
-     'model',
-     'search_timestamp',
-     'search_metadata']
-    # bigdf= pd.DataFrame(columns=usecols)
-    bigdf= None
-
-    files = [x for x in os.listdir(folder) if bool(re.search(pattern, x))]
-    for file in files:
-        # print(file)
-        try:
-            df=pd.read_csv(folder+file, usecols=usecols)
-            df=df[usecols]
-            df['filename']=file
-        except ValueError:
-            print(f'File {file} wrong columns, skipping')
-            continue
+    known_vehicle_ids = set() if known_vehicle_ids is None else known_vehicle_ids
+    vehicle_info = dict(vehicle_info)
+    if vehicle_info.get('zipcode') is None:
+        ## stay in one location for the whole sweep
+        from geography_index import get_geography_index
+        location = get_geography_index().sample_location(location_sampling_weights)
+        vehicle_info['zipcode'] = location['zip']
+        vehicle_info['city_state_lower'] = location['city_state_lower']
+
+    first_record = int(vehicle_info.get('first_record', 0))
+    dfs = []
+    n_pages = 0
+    n_mostly_known_pages = 0
+    while True:
+        page_info = {**vehicle_info, 'first_record': first_record}
+        if pool is not None:
+            df, _ = find_listings_for_make_model(page_info, pool=pool, frontier=frontier, archive=archive)
+        else:
+            df, driver = find_listings_for_make_model(page_info, driver=driver, quit=False, frontier=frontier,
+                                                      archive=archive)
+        n_pages += 1
+        if len(df) == 0:
+            print(f'sweep - page {n_pages} (firstRecord={first_record}) came back empty, stopping')
+            break
 
+        df = add_vehicle_id_columns(df)
+        page_vehicle_ids = set(df['vehicle_id'])
+        new_vehicle_ids = page_vehicle_ids - known_vehicle_ids
+        known_vehicle_ids |= page_vehicle_ids
+        dfs.append(df)
+        new_fraction = len(new_vehicle_ids) / max(len(page_vehicle_ids), 1)
+        result_count = int(df['result_count'].iloc[0])
+        print(f'sweep - page {n_pages} (firstRecord={first_record}): {len(new_vehicle_ids)} / {len(page_vehicle_ids)} '
+              f'vehicles are new; {result_count} results in total')
+
+        n_mostly_known_pages = n_mostly_known_pages + 1 if new_fraction < min_new_fraction else 0
+        first_record += search_page_size
+        if n_mostly_known_pages >= patience:
+            print(f'sweep - {n_mostly_known_pages} pages in a row of mostly known vehicles, stopping')
+            break
+        if 0 <= result_count <= first_record:
+            print(f'sweep - reached the end of the {result_count} results')
+            break
+        if max_pages is not None and n_pages >= max_pages:
+            break
+        if sleep:
+            time.sleep(sleep)
 
-        bigdf = pd.concat([bigdf, df], ignore_index=True) if bigdf is not None else df
-        # bigdf=bigdf.drop_duplicates(subset=['url'])
-        # print(bigdf.shape)
+    if quit and driver is not None:
+        driver.quit()
+        driver = None
 
-    bigdf['url_clean'] = bigdf['url'].apply(clean_vehicle_url)
-    bigdf['vehicle_id'] = bigdf['url_clean'].apply(lambda x: str(x).split('/')[-1] )
+    df = pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+    return df, driver
 
-    bigdf.head()
-    return bigdf
 
+def add_vehicle_id_columns(df:pd.DataFrame) -> pd.DataFrame:
+    '''
+    add url_clean and vehicle_id columns based on the url column
+    (one vectorized regex pass; urls that do not look like a vehicle listing get NaN in both)
+    '''
+    extracted = df['url'].astype(str).str.extract(vehicle_url_pattern)
+    df['url_clean'] = extracted[0]
+    df['vehicle_id'] = extracted[1]
+    return df
 
-def compile_image_urls_df():
-    folder=parent_directory_url_csvs
-    pattern=r'^[0-9]*\.csv'
-    dtypes={'vehicle_image_url': 'str',
+
+search_results_file_pattern = r'search_results_.*[0-9]*csv'
+search_results_dtypes = {'listing_header': 'str',
+    'url': 'str',
+    'search_url': 'str',
+    'make': 'str',
+    'model': 'str',
+    'search_timestamp': 'Int64',
+    'search_metadata': 'str'}
+image_urls_file_pattern = r'^[0-9]*\.csv'
+image_urls_dtypes = {'vehicle_image_url': 'str',
     'vehicle_id': 'int',
     'url': 'str',
     'vin': 'str',
@@ -647,14 +873,16 @@ def compile_image_urls_df():
     'list_price': 'str',
     'listing_details': 'str',
     'listing_narrative': 'str'}
-    bigdf=None
-    usecols = list(dtypes.keys())
-    1
 
-    files = [x for x in os.listdir(folder) if bool(re.search(pattern, x))]
 
+def read_metadata_csvs(folder:str, files:list, dtypes:dict) -> pd.DataFrame:
+    '''
+    read a bunch of csvs with the same columns and stack them, with a column saying which file each row came from
+    files with the wrong columns are skipped
+    '''
+    usecols = list(dtypes.keys())
+    dfs = []
     for file in files:
-        # print(file)
         try:
             df=pd.read_csv(folder+file, usecols=usecols, dtype=dtypes)
             df=df[usecols]
@@ -662,12 +890,70 @@ def compile_image_urls_df():
         except ValueError:
             print(f'File {file} wrong columns, skipping')
             continue
+        dfs.append(df)
+
+    ## one concat at the end, not one per file
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=usecols + ['filename'])
+    return pd.concat(dfs, ignore_index=True)
+
+
+def concat_metadata_dfs(dfs:list) -> pd.DataFrame:
+    '''
+    stack the outputs of read_metadata_csvs / read_listing_parts; empty ones are left out so they do not upcast dtypes
+    '''
+    non_empty = [df for df in dfs if len(df) > 0]
+    return pd.concat(non_empty, ignore_index=True) if len(non_empty) > 0 else dfs[0]
+
+
+def compile_search_results_df(use_store:bool=True) ->pd.DataFrame:
+    '''
+    :param use_store: go through the consolidated metadata store, only reading csvs that have not been ingested yet
+    :return:
+    DF where each row represents on vehicle listing with a unique url and vehicle id
 
+    Also contains make/model of the SEARCH from which the url was captured
+    NB: This might not be the make/model of the actual vehicle;
+     The vehicle listing page is the ultimate source of truth on the make/model of the vehicle
+
+    '''
+    ## compile search results from multiple csvs intoo one df
+    from listing_writer import flush_listing_writers, read_listing_parts
+    flush_listing_writers()
+    if use_store:
+        from metadata_store import MetadataStore
+        with MetadataStore(metadata_store_path, parent_directory_url_csvs) as store:
+            bigdf = store.compile('search_results')
+    else:
+        folder=parent_directory_url_csvs
+        files = [x for x in os.listdir(folder) if bool(re.search(search_results_file_pattern, x))]
+        bigdf = concat_metadata_dfs([read_metadata_csvs(folder, files, search_results_dtypes),
+                                     read_listing_parts('search_results', folder=folder)])
+
+    return add_vehicle_id_columns(bigdf)
+
+
+def compile_image_urls_df(use_store:bool=True) -> pd.DataFrame:
+    '''
+    :param use_store: go through the consolidated metadata store, only reading csvs that have not been ingested yet
+    :return: DF where each row is one image url of one vehicle listing
+    '''
+    from listing_writer import flush_listing_writers, read_listing_parts
+    flush_listing_writers()
+    if use_store:
+        from metadata_store import MetadataStore
+        with MetadataStore(metadata_store_path, parent_directory_url_csvs) as store:
+            return store.compile('image_urls')
+
+    folder=parent_directory_url_csvs
+    files = [x for x in os.listdir(folder) if bool(re.search(image_urls_file_pattern, x))]
+    return concat_metadata_dfs([read_metadata_csvs(folder, files, image_urls_dtypes),
+                                read_listing_parts('image_urls', folder=folder)])
 
-        bigdf = pd.concat([bigdf, df], ignore_index=True) if bigdf is not None else df
-        # print(bigdf.shape)
 
-    return bigdf
+## without __all__, `from find_vehicle_image_urls import *` (notebooks 01-04) only copies what is in globals()
+## and misses the lazy names; listed here, they are imported through __getattr__ like they always were
+__all__ = [name for name in globals() if not name.startswith('_')] + list(lazy_imports)
 
 
 if __name__ == '__main__':
@@ -716,8 +1002,7 @@ if __name__ == '__main__':
     
     IP 98.176.105.96
     
-    ## todo think about a way to navigate to page 2, page3 of search results
-    # this can be done by clicking or it can be done by pre-populating the url in a certain way e.g. ?firstRecord=50
+    ## page 2, page3 of search results: see sweep_search_results, which pre-populates the url e.g. ?firstRecord=50
     # https://www.autotrader.com/cars-for-sale/ford/taurus/san-diego-ca?firstRecord=50&searchRadius=0&sortBy=distanceASC&zip=92101
     '''
 
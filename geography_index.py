@@ -0,0 +1,166 @@
+import os
+import json
+import functools
+
+import numpy as np
+
+from find_vehicle_image_urls import zips_filepath, load_geog_df
+
+
+####################################
+### Settings
+geography_index_dir = os.path.join(os.path.dirname(zips_filepath), 'uszips_index')
+####################################
+
+index_version = 1
+n_possible_zips = 100000  # 00000-99999
+
+
+def build_alias_table(weights:np.ndarray) -> tuple:
+    '''
+    Vose's alias method: after O(n) setup, a weighted draw is one uniform index + one coin flip.
+    :return: (prob float32 array, alias int32 array)
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = np.where(np.isfinite(weights) & (weights > 0), weights, 0.0)
+    n = len(weights)
+    if weights.sum() == 0:
+        weights = np.ones(n)
+    scaled = weights * n / weights.sum()
+
+    prob = np.zeros(n, dtype=np.float32)
+    alias = np.arange(n, dtype=np.int32)
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1
+        (small if scaled[l] < 1 else large).append(l)
+    for i in small + large:
+        prob[i] = 1
+    return prob, alias
+
+
+class GeographyIndex:
+    '''
+    Compact, array-backed version of uszips.csv for picking search locations.
+
+    Built from the csv once and saved as .npy files that are memory-mapped on load:
+    - zip: int32
+    - city_state_code: int32 codes into city_state_categories (e.g. 'beverly-hills-ca')
+    - population: float32
+    - population_prob / population_alias: alias table for O(1) population-weighted sampling
+    - row_by_zip: dense int32 array, zip -> row (-1 if unknown), for O(1) lookups
+    '''
+
+    array_names = ['zip', 'city_state_code', 'population', 'population_prob', 'population_alias', 'row_by_zip']
+
+    def __init__(self, arrays:dict, city_state_categories:np.ndarray):
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+        self.city_state_categories = city_state_categories
+        self._samplers = {}
+
+    def __len__(self) -> int:
+        return len(self.zip)
+
+    @classmethod
+    def build(cls, zips_filepath:str=zips_filepath) -> 'GeographyIndex':
+        zips_df = load_geog_df(zips_filepath)
+        zip_codes = zips_df['zip'].astype(int).to_numpy(dtype=np.int32)
+        city_state = zips_df['city_state_lower'].astype('category')
+        population = zips_df['population'].fillna(0).to_numpy(dtype=np.float32) \
+            if 'population' in zips_df else np.ones(len(zips_df), dtype=np.float32)
+        prob, alias = build_alias_table(population)
+        row_by_zip = np.full(n_possible_zips, -1, dtype=np.int32)
+        row_by_zip[zip_codes] = np.arange(len(zip_codes), dtype=np.int32)
+        arrays = {
+            'zip': zip_codes,
+            'city_state_code': city_state.cat.codes.to_numpy().astype(np.int32),
+            'population': population,
+            'population_prob': prob,
+            'population_alias': alias,
+            'row_by_zip': row_by_zip,
+        }
+        categories = city_state.cat.categories.to_numpy().astype(str)
+        return cls(arrays, categories)
+
+    def save(self, directory:str=geography_index_dir, source_mtime:float=None):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.array_names:
+            np.save(os.path.join(directory, f'{name}.npy'), np.asarray(getattr(self, name)))
+        np.save(os.path.join(directory, 'city_state_categories.npy'), self.city_state_categories)
+        ## meta last, so a half-written index is never considered valid
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump({'version': index_version, 'n_rows': len(self), 'source_mtime': source_mtime}, f)
+
+    @classmethod
+    def load(cls, directory:str=geography_index_dir) -> 'GeographyIndex':
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in cls.array_names}
+        categories = np.load(os.path.join(directory, 'city_state_categories.npy'))
+        return cls(arrays, categories)
+
+    @staticmethod
+    def is_up_to_date(directory:str=geography_index_dir, zips_filepath:str=zips_filepath) -> bool:
+        try:
+            with open(os.path.join(directory, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta.get('version') == index_version and meta.get('source_mtime') == os.path.getmtime(zips_filepath)
+
+    def location(self, row:int) -> dict:
+        return {
+            'zip': str(int(self.zip[row])).zfill(5),
+            'city_state_lower': str(self.city_state_categories[self.city_state_code[row]]),
+        }
+
+    def city_state_for_zip(self, zipcode) -> str:
+        '''
+        :return: e.g. 'san-diego-ca' for '92101', None for an unknown zip
+        '''
+        try:
+            row = self.row_by_zip[int(zipcode)]
+        except (ValueError, IndexError):
+            return None
+        return None if row < 0 else self.location(row)['city_state_lower']
+
+    def set_weights(self, name:str, weights:np.ndarray):
+        '''
+        register another weighting for sample_location, e.g. historical listing yield per zip
+        :param weights: one non-negative weight per row of the index
+        '''
+        if len(weights) != len(self):
+            raise ValueError(f'expected {len(self)} weights, got {len(weights)}')
+        self._samplers[name] = build_alias_table(weights)
+
+    def sample_row(self, weights:str='uniform') -> int:
+        if weights == 'uniform':
+            return int(np.random.randint(len(self)))
+        if weights == 'population':
+            prob, alias = self.population_prob, self.population_alias
+        else:
+            prob, alias = self._samplers[weights]
+        i = int(np.random.randint(len(prob)))
+        return i if np.random.random_sample() < prob[i] else int(alias[i])
+
+    def sample_location(self, weights:str='uniform') -> dict:
+        '''
+        :param weights: 'uniform' (every zip equally likely, like df_geog.sample(n=1)), 'population',
+                        or a name registered with set_weights
+        :return: {'zip': '92101', 'city_state_lower': 'san-diego-ca'}
+        '''
+        return self.location(self.sample_row(weights))
+
+
+@functools.lru_cache(maxsize=None)
+def get_geography_index(directory:str=geography_index_dir, zips_filepath:str=zips_filepath) -> GeographyIndex:
+    '''
+    process-wide geography index; built from the csv (and saved) only when the on-disk copy is missing or stale
+    '''
+    if not GeographyIndex.is_up_to_date(directory, zips_filepath):
+        print(f'building geography index in {directory}')
+        GeographyIndex.build(zips_filepath).save(directory, source_mtime=os.path.getmtime(zips_filepath))
+    return GeographyIndex.load(directory)
@@ -0,0 +1,158 @@
+import json
+import time
+import asyncio
+import traceback
+
+import httpx
+import lxml.html
+import pandas as pd
+
+from find_vehicle_image_urls import clean_vehicle_url, create_random_user_agent, build_listing_df, save_metadata_df, \
+    get_clean_vin
+from listing_extraction import ListingFields, extract_listing_fields
+from image_url_collector import ImageUrlCollector
+from scraper_metrics import metrics, count_buckets
+
+
+####################################
+### Settings
+http_concurrency = 16  # listing pages in flight at once
+http_timeout = 30  # seconds
+required_fields = ['year_make_model', 'vin']  # without these (or without any image) fall back to the browser
+####################################
+
+
+def find_vehicle_json_ld(tree) -> dict:
+    '''
+    the schema.org Vehicle / Car / Product block that listing pages embed for search engines, if there is one
+    '''
+    for script in tree.xpath('//script[@type="application/ld+json"]'):
+        try:
+            data = json.loads(script.text or '')
+        except ValueError:
+            continue
+        candidates = data if isinstance(data, list) else data.get('@graph', [data])
+        for candidate in candidates:
+            if not isinstance(candidate, dict):
+                continue
+            types = candidate.get('@type')
+            types = types if isinstance(types, list) else [types]
+            if any(t in ('Vehicle', 'Car', 'Product') for t in types):
+                return candidate
+    return {}
+
+
+def extract_listing_fields_http(html:str) -> tuple:
+    '''
+    fields and image urls from the server-rendered html of a vehicle listing page:
+    the same selectors as the browser path, topped up from the embedded json-ld where those come up empty
+    :return: (ListingFields, image urls)
+    '''
+    fields = extract_listing_fields(html)
+    collector = ImageUrlCollector()
+    if not str(html).strip() or fields.page_unavailable:
+        return fields, []
+    collector.add_text(html)
+
+    vehicle = find_vehicle_json_ld(lxml.html.fromstring(html))
+    if vehicle:
+        if fields.year_make_model is None and vehicle.get('name'):
+            fields.year_make_model = str(vehicle['name']).strip()
+        if fields.vin is None and vehicle.get('vehicleIdentificationNumber'):
+            fields.vin = get_clean_vin(str(vehicle['vehicleIdentificationNumber']))
+        offers = vehicle.get('offers') or {}
+        offers = offers[0] if isinstance(offers, list) and offers else offers
+        if fields.list_price is None and isinstance(offers, dict) and offers.get('price') is not None:
+            fields.list_price = f"${float(offers['price']):,.0f}"
+        if fields.listing_narrative is None and vehicle.get('description'):
+            fields.listing_narrative = str(vehicle['description']).strip()
+        images = vehicle.get('image') or []
+        collector.add(images if isinstance(images, list) else [images])
+
+    image_urls = collector.urls
+    if fields.header_image_url is not None:
+        image_urls += [str(fields.header_image_url)]
+    return fields, image_urls
+
+
+def needs_browser(fields:ListingFields, image_urls:list) -> bool:
+    return fields.page_unavailable or len(image_urls) == 0 or \
+        any(getattr(fields, name) is None for name in required_fields)
+
+
+async def fetch_listing(client:httpx.AsyncClient, url:str, semaphore:asyncio.Semaphore, save:bool=True) -> tuple:
+    '''
+    :return: (DF like process_vehicle_webpage returns, True if the page has to go through the browser instead)
+    '''
+    url_cleaned = clean_vehicle_url(url)
+    try:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get(url_cleaned)
+            metrics.observe('page_load_seconds', time.perf_counter() - start, page='listing_http',
+                            outcome=str(response.status_code))
+        response.raise_for_status()
+        start = time.perf_counter()
+        fields, image_urls = extract_listing_fields_http(response.text)
+        metrics.observe('extraction_seconds', time.perf_counter() - start, outcome='success')
+    except Exception:
+        print(f'fetch_listing [{url}] Error Traceback:\n', traceback.format_exc(limit=1))
+        return pd.DataFrame(), True
+
+    if needs_browser(fields, image_urls):
+        return pd.DataFrame(), True
+    metrics.observe('images_per_listing', len(image_urls), buckets=count_buckets)
+    df = build_listing_df(image_urls, url_cleaned, fields)
+    if save:
+        save_metadata_df(df, 'image_urls', f'{df["vehicle_id"].iloc[0]}.csv')
+    return df, False
+
+
+async def process_vehicle_webpages_async(urls:list, concurrency:int=http_concurrency, save:bool=True) -> tuple:
+    '''
+    Fetch vehicle listing pages with one pooled http client instead of a browser.
+    In a notebook: df, fallback_urls = await process_vehicle_webpages_async(urls)
+    :return: (DF of all listings that worked, urls that need the browser)
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {'User-Agent': create_random_user_agent(), 'Accept': 'text/html,application/xhtml+xml',
+               'Accept-Language': 'en-US,en;q=0.9'}
+    async with httpx.AsyncClient(limits=limits, headers=headers, timeout=http_timeout,
+                                 follow_redirects=True) as client:
+        results = await asyncio.gather(*[fetch_listing(client, url, semaphore, save=save) for url in urls])
+
+    dfs = [df for df, _ in results if len(df) > 0]
+    fallback_urls = [url for url, (_, fallback) in zip(urls, results) if fallback]
+    for df, fallback in results:
+        metrics.inc('listings_total', outcome='fallback' if fallback else 'success', backend='http')
+    metrics.export()
+    df = pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+    print(f'http extraction - {len(urls) - len(fallback_urls)} / {len(urls)} listings, '
+          f'{len(fallback_urls)} left for the browser')
+    return df, fallback_urls
+
+
+def process_vehicle_webpages(urls:list, pool=None, concurrency:int=http_concurrency, fallback:bool=True) -> pd.DataFrame:
+    '''
+    http first, then process_vehicle_webpage (through the DriverPool if given) for the listings
+    where required fields or images were missing
+    :return: DF with the same columns process_vehicle_webpage returns, for all listings
+    '''
+    from find_vehicle_image_urls import process_vehicle_webpage
+    df, fallback_urls = asyncio.run(process_vehicle_webpages_async(urls, concurrency=concurrency))
+    dfs = [df]
+    if fallback:
+        for url in fallback_urls:
+            df_browser, _ = process_vehicle_webpage(url, quit=pool is None, pool=pool)
+            dfs.append(df_browser)
+    return pd.concat(dfs, ignore_index=True)
+
+
+if __name__ == '__main__':
+    urls = [
+        'https://www.autotrader.com/cars-for-sale/vehicle/725617155',
+    ]
+    df, fallback_urls = asyncio.run(process_vehicle_webpages_async(urls, save=False))
+    print(df.head(1).T)
+    print(fallback_urls)
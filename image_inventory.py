@@ -0,0 +1,286 @@
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from find_vehicle_image_urls import parent_directory_images, get_vehicle_make_model_list
+from image_store import image_relpath_pattern
+
+
+####################################
+### Settings
+image_inventory_filename = '.image_inventory.sqlite'  # kept in the images directory, next to the download manifest
+header_bytes = 64 * 1024  # read this much of a file to find its dimensions; enough unless the EXIF block is huge
+scan_workers = 16  # threads walking model directories / reading headers during a rebuild
+####################################
+
+inventory_columns = ['relpath', 'vehicle_id', 'make', 'model', 'body_style', 'filename', 'bytes', 'width', 'height',
+                     'mtime']
+size_buckets_kb = (10, 25, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+## start-of-frame markers carry the image size; C4 (huffman tables), C8 (reserved) and CC (arithmetic coding) do not
+jpeg_sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_dimensions(data:bytes) -> tuple:
+    '''
+    (width, height) from the frame header of a jpeg, without decoding it
+    :return: (None, None) if data is not a jpeg or ends before the frame header
+    '''
+    if data[:2] != b'\xff\xd8':
+        return None, None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None, None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # markers without a length
+            i += 2
+            continue
+        if marker in jpeg_sof_markers:
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return width, height
+        if marker == 0xDA:  # start of scan, no frame header before the image data
+            return None, None
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None, None
+
+
+def read_image_dimensions(filepath:str) -> tuple:
+    '''
+    :return: (width, height), reading only the first header_bytes of the file unless the header is longer
+    '''
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read(header_bytes)
+            width, height = jpeg_dimensions(data)
+            if width is None and len(data) == header_bytes:
+                width, height = jpeg_dimensions(data + f.read())
+    except OSError:
+        return None, None
+    return width, height
+
+
+def inventory_record(images_dir:str, relpath:str, body_styles:dict=None) -> tuple:
+    '''
+    one row of the inventory for the file at images_dir/relpath, in inventory_columns order; None if it is gone
+    '''
+    filepath = os.path.join(images_dir, relpath)
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    match = image_relpath_pattern.match(relpath)
+    make, model, vehicle_id = (match['make'], match['model'], int(match['vehicle_id'])) if match else (None,) * 3
+    body_style = (body_styles or {}).get((make, model))
+    width, height = read_image_dimensions(filepath)
+    return (relpath, vehicle_id, make, model, body_style, os.path.basename(relpath), stat.st_size, width, height,
+            stat.st_mtime)
+
+
+def get_body_styles() -> dict:
+    return {(v['make'], v['model']): v['body_style'] for v in get_vehicle_make_model_list()}
+
+
+def scan_model_directory(directory:str, images_dir:str) -> list:
+    '''
+    :return: (relpath, bytes, mtime) of every image file in the vehicle_id-* folders of one model directory
+    '''
+    found = []
+    with os.scandir(directory) as vehicles:
+        for vehicle_entry in vehicles:
+            if not (vehicle_entry.is_dir() and vehicle_entry.name.startswith('vehicle_id-')):
+                continue
+            prefix = os.path.relpath(vehicle_entry.path, images_dir) + '/'
+            with os.scandir(vehicle_entry.path) as images:
+                for entry in images:
+                    if entry.name.endswith('.tmp') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    found.append((prefix + entry.name, stat.st_size, stat.st_mtime))
+    return found
+
+
+class ImageInventory:
+    '''
+    What is in the image tree, one row per file: vehicle_id, make, model, body_style, filename, bytes,
+    width / height (from the jpeg header) and mtime, in SQLite next to the images.
+
+    Kept up to date by ImageDownloader as it writes files; rebuild() walks the whole tree (model directories
+    in parallel) and only reads headers of files that are new or changed, e.g. after files were moved or deleted
+    by hand. Replaces find | cut | sort | uniq -c for dataset statistics.
+
+    usage:
+        with ImageInventory() as inventory:
+            inventory.class_balance()
+            inventory.size_distribution()
+    '''
+
+    def __init__(self, images_dir:str=parent_directory_images, path:str=None):
+        self.images_dir = images_dir
+        self.path = os.path.join(images_dir, image_inventory_filename) if path is None else path
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                relpath TEXT PRIMARY KEY,
+                vehicle_id INTEGER,
+                make TEXT,
+                model TEXT,
+                body_style TEXT,
+                filename TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                mtime REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS images_make_model ON images (make, model)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS images_vehicle_id ON images (vehicle_id)')
+        self.conn.commit()
+        self.body_styles = get_body_styles()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def add(self, records:list) -> int:
+        '''
+        :param records: rows from inventory_record; None entries are skipped
+        '''
+        records = [record for record in records if record is not None]
+        self.conn.executemany(f'INSERT OR REPLACE INTO images ({", ".join(inventory_columns)}) '
+                              f'VALUES ({", ".join("?" * len(inventory_columns))})', records)
+        self.conn.commit()
+        return len(records)
+
+    def add_files(self, relpaths:list) -> int:
+        return self.add([inventory_record(self.images_dir, relpath, self.body_styles) for relpath in relpaths])
+
+    def remove(self, relpaths:list):
+        self.conn.executemany('DELETE FROM images WHERE relpath = ?', [(relpath,) for relpath in relpaths])
+        self.conn.commit()
+
+    def scan(self, n_workers:int=scan_workers) -> pd.DataFrame:
+        '''
+        :return: DF with relpath, bytes, mtime of every image file, one os.scandir walk per model directory in parallel
+        '''
+        model_directories = []
+        with os.scandir(self.images_dir) as makes:
+            for make_entry in makes:
+                if make_entry.is_dir() and make_entry.name.startswith('make-'):
+                    with os.scandir(make_entry.path) as models:
+                        model_directories += [entry.path for entry in models
+                                              if entry.is_dir() and entry.name.startswith('model-')]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            found = executor.map(scan_model_directory, model_directories, [self.images_dir] * len(model_directories))
+            rows = [row for rows in found for row in rows]
+        return pd.DataFrame(rows, columns=['relpath', 'bytes', 'mtime'])
+
+    def rebuild(self, n_workers:int=scan_workers) -> dict:
+        '''
+        bring the inventory in line with the tree: add new files, refresh changed ones (bytes / mtime differ),
+        drop the ones that are gone
+        :return: counts
+        '''
+        start = time.time()
+        on_disk = self.scan(n_workers)
+        known = pd.read_sql_query('SELECT relpath, bytes, mtime FROM images', self.conn)
+        merged = on_disk.merge(known, on='relpath', how='outer', suffixes=('', '_known'), indicator=True)
+        changed = merged[(merged['_merge'] == 'left_only') |
+                         ((merged['_merge'] == 'both') &
+                          ((merged['bytes'] != merged['bytes_known']) | (merged['mtime'] != merged['mtime_known'])))]
+        gone = merged.loc[merged['_merge'] == 'right_only', 'relpath'].tolist()
+
+        relpaths = changed['relpath'].tolist()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            records = list(executor.map(inventory_record, [self.images_dir] * len(relpaths), relpaths,
+                                        [self.body_styles] * len(relpaths)))
+        n_added = self.add(records)
+        self.remove(gone)
+        counts = {'files': len(on_disk), 'added_or_changed': n_added, 'removed': len(gone),
+                  'seconds': round(time.time() - start, 1)}
+        print(f'image inventory - {counts}')
+        return counts
+
+    def query(self, sql:str, params:tuple=()) -> pd.DataFrame:
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def stats(self) -> dict:
+        row = self.conn.execute('''
+            SELECT COUNT(*), COUNT(DISTINCT vehicle_id), COUNT(DISTINCT make || '/' || model), SUM(bytes),
+                   SUM(width IS NULL)
+            FROM images
+        ''').fetchone()
+        return {'images': row[0], 'vehicles': row[1], 'make_models': row[2], 'bytes': row[3] or 0,
+                'unknown_dimensions': row[4] or 0}
+
+    def class_balance(self, by:list=('make', 'model')) -> pd.DataFrame:
+        '''
+        :param by: any of make, model, body_style
+        :return: DF with vehicles, images, images_per_vehicle, share of images and MB per group, largest first
+        '''
+        by = [column for column in by if column in ('make', 'model', 'body_style')]
+        group = ', '.join(by)
+        df = self.query(f'''
+            SELECT {group}, COUNT(DISTINCT vehicle_id) AS vehicles, COUNT(*) AS images, SUM(bytes) AS bytes
+            FROM images GROUP BY {group} ORDER BY images DESC
+        ''')
+        df['images_per_vehicle'] = (df['images'] / df['vehicles'].clip(lower=1)).round(1)
+        df['share'] = (df['images'] / max(df['images'].sum(), 1)).round(4)
+        df['mb'] = (df['bytes'] / 2 ** 20).round(1)
+        return df.drop(columns=['bytes'])
+
+    def per_vehicle(self, vehicle_id:int=None) -> pd.DataFrame:
+        '''
+        :return: the images of vehicle_id, or with vehicle_id=None: image count and bytes of every vehicle
+        '''
+        if vehicle_id is not None:
+            return self.query('SELECT * FROM images WHERE vehicle_id = ? ORDER BY filename', (int(vehicle_id),))
+        return self.query('''
+            SELECT vehicle_id, make, model, body_style, COUNT(*) AS images, SUM(bytes) AS bytes,
+                   MIN(width) AS min_width, MAX(width) AS max_width
+            FROM images GROUP BY vehicle_id ORDER BY images DESC
+        ''')
+
+    def size_distribution(self, buckets_kb:tuple=size_buckets_kb) -> dict:
+        '''
+        :return: file size histogram (images per size bucket, in KB), size quantiles, and the most common dimensions
+        '''
+        sizes = np.asarray([row[0] for row in self.conn.execute('SELECT bytes FROM images')], dtype=np.int64)
+        edges = np.asarray(buckets_kb, dtype=np.int64) * 1024
+        counts = np.bincount(np.searchsorted(edges, sizes, side='left'), minlength=len(edges) + 1)
+        labels = [f'<={kb}KB' for kb in buckets_kb] + [f'>{buckets_kb[-1]}KB']
+        quantiles = np.percentile(sizes, [5, 25, 50, 75, 95]) if len(sizes) > 0 else [None] * 5
+        dimensions = self.query('''
+            SELECT width, height, COUNT(*) AS images FROM images GROUP BY width, height ORDER BY images DESC LIMIT 10
+        ''')
+        return {
+            'histogram': dict(zip(labels, counts.tolist())),
+            'quantiles_kb': {q: None if v is None else round(float(v) / 1024, 1)
+                             for q, v in zip(['p5', 'p25', 'p50', 'p75', 'p95'], quantiles)},
+            'dimensions': dimensions,
+        }
+
+
+if __name__ == '__main__':
+    with ImageInventory() as inventory:
+        inventory.rebuild()
+        print(inventory.stats())
+        print(inventory.class_balance())
+        print(inventory.size_distribution())
@@ -0,0 +1,321 @@
+import os
+import re
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from find_vehicle_image_urls import parent_directory_images, image_store_path, image_blob_dir
+
+
+####################################
+### Settings
+hash_batch_size = 256  # files per task sent to a hashing process
+near_duplicate_distance = 6  # max hamming distance between dHashes for two images to count as near-duplicates
+max_band_bucket = 2000  # band values shared by more distinct dHashes than this (blank / placeholder images) are skipped
+####################################
+
+dhash_bands = 4  # the 64 bit dHash is split into this many 16 bit bands for candidate lookup
+image_relpath_pattern = re.compile(r'^make-(?P<make>[^/]*)/model-(?P<model>[^/]*)/vehicle_id-(?P<vehicle_id>[0-9]+)/')
+
+
+def dhash(image:np.ndarray) -> int:
+    '''
+    64 bit difference hash: shrink to 9x8 grayscale, one bit per pixel for "brighter than its left neighbour"
+    '''
+    import cv2
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hash_band(value:int, band:int) -> int:
+    return (value >> (16 * band)) & 0xFFFF
+
+
+def hamming_distance(a:int, b:int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def hash_files(filepaths:list) -> list:
+    '''
+    runs in a worker process: content hash, perceptual hash and dimensions of each file (one read per file)
+    :return: list of (filepath, sha256, dhash hex or None, width, height)
+    '''
+    import cv2
+    results = []
+    for filepath in filepaths:
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        sha256 = hashlib.sha256(data).hexdigest()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:  # truncated or not an image
+            results.append((filepath, sha256, None, None, None))
+        else:
+            results.append((filepath, sha256, f'{dhash(image):016x}', image.shape[1], image.shape[0]))
+    return results
+
+
+class ImageStore:
+    '''
+    Content-addressed index of the downloaded images.
+
+    - every distinct file content is one blob, stored once in blob_dir as {sha256[:2]}/{sha256}.jpg
+    - the make-{make}/model-{model}/vehicle_id-{vehicle_id}/ folders keep their files, but as hard links to the blob,
+      so everything that reads those paths keeps working while identical photos only take disk space once
+    - each blob has a dHash, so near-identical photos (re-encoded, resized stock / placeholder pictures)
+      can be found across listings, makes and models
+
+    Hashing only looks at files whose (size, mtime) changed since the last update, in batches across processes.
+
+    usage:
+        with ImageStore() as store:
+            store.update()
+            store.consolidate()
+            store.stats()
+    '''
+
+    def __init__(self, path:str=image_store_path, images_dir:str=parent_directory_images, blob_dir:str=image_blob_dir):
+        self.path = path
+        self.images_dir = images_dir
+        self.blob_dir = blob_dir
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                relpath TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                make TEXT,
+                model TEXT,
+                vehicle_id INTEGER
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+        band_columns = ', '.join(f'band{i} INTEGER' for i in range(dhash_bands))
+        self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                dhash TEXT,
+                width INTEGER,
+                height INTEGER,
+                {band_columns}
+            )
+        ''')
+        for i in range(dhash_bands):
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS blobs_band{i} ON blobs (band{i})')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def blob_path(self, sha256:str) -> str:
+        return os.path.join(self.blob_dir, sha256[:2], f'{sha256}.jpg')
+
+    def scan(self) -> list:
+        '''
+        :return: (relpath, size, mtime) of every jpg under images_dir
+        '''
+        found = []
+        folders = [self.images_dir]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.name.endswith('.jpg'):
+                        stat = entry.stat()
+                        found.append((os.path.relpath(entry.path, self.images_dir), stat.st_size, stat.st_mtime))
+        return found
+
+    def update(self, n_workers:int=None, batch_size:int=hash_batch_size) -> dict:
+        '''
+        hash new / changed files and record them; files that disappeared are dropped from the index
+        '''
+        found = self.scan()
+        known = {relpath: (size, mtime) for relpath, size, mtime in
+                 self.conn.execute('SELECT relpath, size, mtime FROM files')}
+        changed = [(relpath, size, mtime) for relpath, size, mtime in found if known.get(relpath) != (size, mtime)]
+        removed = set(known) - set(relpath for relpath, _, _ in found)
+        print(f'image store - {len(found)} files, {len(changed)} new or changed, {len(removed)} removed')
+
+        stat_by_path = {os.path.join(self.images_dir, relpath): (relpath, size, mtime) for relpath, size, mtime in changed}
+        filepaths = list(stat_by_path)
+        batches = [filepaths[i:i + batch_size] for i in range(0, len(filepaths), batch_size)]
+        n_hashed = 0
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            ## record each batch as it comes back, so an interrupted update keeps what it has done
+            for results in executor.map(hash_files, batches):
+                self._record(results, stat_by_path)
+                n_hashed += len(results)
+        with self.conn:
+            self.conn.executemany('DELETE FROM files WHERE relpath = ?', [(relpath,) for relpath in removed])
+            self.conn.execute('DELETE FROM blobs WHERE sha256 NOT IN (SELECT sha256 FROM files)')
+        return {'files': len(found), 'hashed': n_hashed, 'removed': len(removed)}
+
+    def _record(self, results:list, stat_by_path:dict):
+        file_rows, blob_rows = [], []
+        for filepath, sha256, dhash_hex, width, height in results:
+            relpath, size, mtime = stat_by_path[filepath]
+            match = image_relpath_pattern.match(relpath)
+            make, model, vehicle_id = (match['make'], match['model'], int(match['vehicle_id'])) if match else (None,) * 3
+            file_rows.append((relpath, sha256, size, mtime, make, model, vehicle_id))
+            bands = [None] * dhash_bands if dhash_hex is None else \
+                [hash_band(int(dhash_hex, 16), i) for i in range(dhash_bands)]
+            blob_rows.append((sha256, size, dhash_hex, width, height, *bands))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', file_rows)
+            self.conn.executemany(f'INSERT OR IGNORE INTO blobs VALUES ({", ".join("?" * (5 + dhash_bands))})',
+                                  blob_rows)
+
+    def consolidate(self, dry_run:bool=False) -> dict:
+        '''
+        move every distinct content into the blob directory once and turn the per-vehicle files into hard links to it
+        :return: how many files were linked and how many bytes that freed
+        '''
+        stats = {'linked': 0, 'bytes_freed': 0}
+        rows = self.conn.execute('SELECT relpath, sha256, size FROM files ORDER BY sha256').fetchall()
+        updates = []
+        for relpath, sha256, size in rows:
+            filepath = os.path.join(self.images_dir, relpath)
+            blob_path = self.blob_path(sha256)
+            try:
+                if not os.path.exists(blob_path):
+                    ## the first file with this content becomes the blob
+                    if not dry_run:
+                        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                        os.link(filepath, blob_path)
+                    continue
+                if os.path.samefile(filepath, blob_path):
+                    continue
+                stats['linked'] += 1
+                stats['bytes_freed'] += size
+                if dry_run:
+                    continue
+                ## link next to the file, then rename over it, so the file is never missing
+                tmp_path = f'{filepath}.{os.getpid()}.link'
+                os.link(blob_path, tmp_path)
+                os.replace(tmp_path, filepath)
+                updates.append((os.stat(filepath).st_mtime, relpath))
+            except OSError as e:
+                print(f'image store - could not consolidate {relpath}: {e}')
+        with self.conn:
+            self.conn.executemany('UPDATE files SET mtime = ? WHERE relpath = ?', updates)
+        print(f'image store - {"would link" if dry_run else "linked"} {stats["linked"]} files, '
+              f'{stats["bytes_freed"] / 2 ** 20:.1f} MB freed')
+        return stats
+
+    def files_df(self) -> pd.DataFrame:
+        return pd.read_sql_query('SELECT * FROM files', self.conn)
+
+    def exact_duplicates(self) -> pd.DataFrame:
+        '''
+        :return: one row per blob that appears in more than one file, with how many vehicles / models share it
+        '''
+        return pd.read_sql_query('''
+            SELECT sha256, COUNT(*) AS n_files, COUNT(DISTINCT vehicle_id) AS n_vehicles,
+                   COUNT(DISTINCT make || '/' || model) AS n_make_models, MAX(size) AS size
+            FROM files GROUP BY sha256 HAVING COUNT(*) > 1 ORDER BY n_files DESC
+        ''', self.conn)
+
+    def near_duplicates(self, max_distance:int=near_duplicate_distance, max_bucket:int=max_band_bucket) -> pd.DataFrame:
+        '''
+        pairs of distinct blobs whose dHashes are within max_distance bits of each other
+
+        Blobs with the same dHash are paired with the first of them (distance 0) rather than with each other,
+        and only one dHash per group goes on to the band lookup.
+        Candidates come from dHashes that share at least one 16 bit band, so not every pair is compared;
+        with 4 bands, pairs up to 3 bits apart are always found, and most pairs further apart still are.
+        A band value shared by more than max_bucket distinct dHashes (e.g. band 0x0000 of flat, blank images)
+        says little about similarity and would cost max_bucket^2 comparisons, so such buckets are skipped.
+        :return: DF with sha256_a, sha256_b, distance
+        '''
+        blobs = pd.read_sql_query('SELECT * FROM blobs WHERE dhash IS NOT NULL', self.conn)
+        blobs = blobs.drop_duplicates('sha256').sort_values('sha256')
+        pairs = {}
+
+        ## same dHash: a star around the first blob, instead of every pair
+        first_sha256 = blobs.groupby('dhash')['sha256'].transform('first')
+        repeated = first_sha256 != blobs['sha256']
+        for a, b in zip(first_sha256[repeated], blobs['sha256'][repeated]):
+            pairs[(a, b)] = 0
+
+        distinct = blobs[~repeated]
+        hashes = dict(zip(distinct['sha256'], (int(h, 16) for h in distinct['dhash'])))
+        n_skipped = 0
+        for i in range(dhash_bands):
+            for _, group in distinct.groupby(f'band{i}')['sha256']:
+                if len(group) < 2:
+                    continue
+                if len(group) > max_bucket:
+                    n_skipped += 1
+                    continue
+                members = group.tolist()
+                for j, a in enumerate(members):
+                    for b in members[j + 1:]:
+                        if (a, b) not in pairs:
+                            distance = hamming_distance(hashes[a], hashes[b])
+                            if distance <= max_distance:
+                                pairs[(a, b)] = distance
+        if n_skipped > 0:
+            print(f'image store - skipped {n_skipped} band buckets with more than {max_bucket} dHashes')
+        return pd.DataFrame([(a, b, d) for (a, b), d in pairs.items()], columns=['sha256_a', 'sha256_b', 'distance'])
+
+    def duplicate_groups(self, max_distance:int=near_duplicate_distance) -> pd.DataFrame:
+        '''
+        :return: DF of files with a dup_group column: files in the same group are the same or near-identical photos
+        '''
+        parent = {}
+
+        def find(x):
+            while parent.get(x, x) != x:
+                parent[x] = parent.get(parent[x], parent[x])
+                x = parent[x]
+            return x
+
+        for a, b in self.near_duplicates(max_distance)[['sha256_a', 'sha256_b']].itertuples(index=False):
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+        df = self.files_df()
+        df['dup_group'] = df['sha256'].map(find)
+        return df
+
+    def stats(self, max_distance:int=near_duplicate_distance) -> dict:
+        '''
+        dataset statistics counting every group of duplicate photos once
+        '''
+        df = self.duplicate_groups(max_distance)
+        n_make_models = df.groupby('dup_group')[['make', 'model']].apply(lambda x: len(x.drop_duplicates()))
+        logical_bytes = int(df['size'].sum())
+        stored_bytes = int(df.drop_duplicates('sha256')['size'].sum())
+        stats = {
+            'files': len(df),
+            'distinct_files': int(df['sha256'].nunique()),
+            'distinct_images': int(df['dup_group'].nunique()),
+            'groups_across_make_models': int((n_make_models > 1).sum()),
+            'logical_mb': round(logical_bytes / 2 ** 20, 1),
+            'stored_mb': round(stored_bytes / 2 ** 20, 1),
+        }
+        print(stats)
+        return stats
+
+
+if __name__ == '__main__':
+    with ImageStore() as store:
+        store.update()
+        store.consolidate()
+        store.stats()
@@ -0,0 +1,123 @@
+import os
+import re
+
+
+image_url_prefix = 'https://images.autotrader.com/'
+
+## Installed once per page. Scans the DOM that is already there, then a MutationObserver picks up image urls
+## from nodes / attributes as they are added, and keeps them in a buffer until python drains it.
+install_observer_js = '''
+var prefix = arguments[0];
+if (!window.__imageUrlCollector) {
+    var pending = [];
+    var seen = new Set();
+    var attrs = ['src', 'srcset', 'data-src', 'data-srcset', 'href', 'style', 'content'];
+    var grab = function (value) {
+        if (!value) { return; }
+        var tokens = String(value).split(/[\\s"'()]+/);
+        for (var i = 0; i < tokens.length; i++) {
+            var token = tokens[i].replace(/[,;]+$/, '');
+            if (token.indexOf(prefix) === 0 && !seen.has(token)) {
+                seen.add(token);
+                pending.push(token);
+            }
+        }
+    };
+    var scanElement = function (el) {
+        for (var i = 0; i < attrs.length; i++) { grab(el.getAttribute(attrs[i])); }
+    };
+    var scan = function (node) {
+        if (node.nodeType !== 1) { return; }
+        scanElement(node);
+        var descendants = node.querySelectorAll('img, source, a, meta, [style], [data-src]');
+        for (var i = 0; i < descendants.length; i++) { scanElement(descendants[i]); }
+    };
+    scan(document.documentElement);
+    var observer = new MutationObserver(function (mutations) {
+        for (var i = 0; i < mutations.length; i++) {
+            var m = mutations[i];
+            if (m.type === 'attributes') {
+                grab(m.target.getAttribute(m.attributeName));
+            } else {
+                for (var j = 0; j < m.addedNodes.length; j++) { scan(m.addedNodes[j]); }
+            }
+        }
+    });
+    observer.observe(document.documentElement, {subtree: true, childList: true, attributes: true, attributeFilter: attrs});
+    window.__imageUrlCollector = {
+        observer: observer,
+        drain: function () { return pending.splice(0, pending.length); }
+    };
+}
+return window.__imageUrlCollector.drain();
+'''
+
+drain_js = '''
+return window.__imageUrlCollector ? window.__imageUrlCollector.drain() : [];
+'''
+
+
+def image_filename(url:str) -> str:
+    return os.path.basename(url).split('.')[0]
+
+
+class ImageUrlCollector:
+    '''
+    Running map of image filename -> best url for that filename.
+    The same image is served in multiple sizes e.g. /scaler/500/375/... and /scaler/100/75/...;
+    like find_image_urls_v2 always did, the url that sorts last (the largest size) wins.
+
+    Adding urls costs O(new urls), unlike re-scanning the whole page source on every scroll step.
+    '''
+
+    def __init__(self, prefix:str=image_url_prefix):
+        self.prefix = prefix
+        self.best = {}
+
+    def __len__(self) -> int:
+        return len(self.best)
+
+    def add(self, urls) -> int:
+        '''
+        :return: how many new filenames were seen
+        '''
+        n_new = 0
+        for url in urls:
+            url = str(url)
+            if not url.startswith(self.prefix):
+                continue
+            filename = image_filename(url)
+            if not filename:  # a bare prefix / folder, e.g. from a url being put together in a script
+                continue
+            best = self.best.get(filename)
+            if best is None:
+                n_new += 1
+                self.best[filename] = url
+            elif url > best:
+                self.best[filename] = url
+        return n_new
+
+    def add_page_source(self, page_source:str) -> int:
+        return self.add(str(page_source).split())
+
+    def add_text(self, text:str) -> int:
+        '''
+        every url with the prefix anywhere in the text, e.g. inside quoted attributes or embedded json,
+        which the whitespace split of add_page_source only catches when the url stands on its own
+        '''
+        pattern = re.escape(self.prefix) + r'''[^\s"'<>(),\\]+'''
+        return self.add(re.findall(pattern, str(text)))
+
+    @property
+    def urls(self) -> list:
+        return [self.best[filename] for filename in sorted(self.best)]
+
+    def install(self, driver) -> int:
+        '''
+        start watching the page in the browser; picks up everything that is already on the page
+        :return: how many new filenames were seen
+        '''
+        return self.add(driver.execute_script(install_observer_js, self.prefix) or [])
+
+    def drain(self, driver) -> int:
+        return self.add(driver.execute_script(drain_js) or [])
@@ -0,0 +1,176 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from find_vehicle_image_urls import get_vehicle_make_model_list
+
+
+## makes that are more than one word in a listing header, e.g. 'Used 2019 Land Rover Range Rover Sport HSE'
+multi_word_makes = ['Alfa Romeo', 'Aston Martin', 'Land Rover', 'Mercedes-Benz', 'Rolls-Royce', 'Lucid Motors']
+
+year_make_model_pattern = (
+    r'^\s*(?:(?P<condition>New|Used|Certified|Certified Pre-Owned)\s+)?'
+    r'(?P<year>(?:19|20)\d{2})\s+'
+    r'(?P<make>' + '|'.join(re.escape(make) for make in multi_word_makes) + r'|\S+)\s*'
+    r'(?P<model_trim>.*?)\s*$'
+)
+mileage_pattern = r'(?i)([\d,]+)\s*mi(?:les|\.)?\b'
+drivetrain_pattern = r'(?i)\b(4WD|AWD|FWD|RWD|2WD|4x4|4x2|Four[- ]Wheel Drive|All[- ]Wheel Drive|' \
+                     r'Front[- ]Wheel Drive|Rear[- ]Wheel Drive)\b'
+transmission_pattern = r'(?i)\b(Automatic|Manual|CVT)\b'
+## colors come as their own detail line, e.g. '...^Black exterior^Gray interior^...' or 'Black exterior, Gray interior'
+exterior_color_pattern = r'(?i)(?:^|\^|,)\s*([a-z][a-z /-]*?)\s+exterior\b'
+interior_color_pattern = r'(?i)(?:^|\^|,)\s*([a-z][a-z /-]*?)\s+interior\b'
+
+drivetrain_names = {
+    '4wd': '4WD', '4x4': '4WD', 'four-wheel drive': '4WD', 'four wheel drive': '4WD',
+    'awd': 'AWD', 'all-wheel drive': 'AWD', 'all wheel drive': 'AWD',
+    'fwd': 'FWD', 'front-wheel drive': 'FWD', 'front wheel drive': 'FWD',
+    'rwd': 'RWD', 'rear-wheel drive': 'RWD', 'rear wheel drive': 'RWD',
+    '2wd': '2WD', '4x2': '2WD',
+}
+
+listing_columns = ['vehicle_id', 'url', 'vin', 'year_make_model', 'list_price', 'listing_details', 'listing_narrative']
+categorical_columns = ['condition', 'make', 'model', 'trim', 'drivetrain', 'transmission', 'exterior_color',
+                       'interior_color', 'search_make', 'search_model', 'body_style']
+
+
+def normalize_model_name(x:str) -> str:
+    '''
+    'F-150' / 'f150' -> 'f150', '3 Series' / '3-series' -> '3series'
+    '''
+    return re.sub(r'[^a-z0-9]', '', str(x).lower())
+
+
+def split_model_trim(model_trim:str, known_models:list) -> tuple:
+    '''
+    'F-150 XLT' -> ('F-150', 'XLT') when 'f150' is a known model, otherwise the first word is the model
+    '''
+    words = str(model_trim).split()
+    if len(words) == 0:
+        return None, None
+    for n in range(len(words), 0, -1):
+        if normalize_model_name(' '.join(words[:n])) in known_models:
+            return ' '.join(words[:n]), ' '.join(words[n:]) or None
+    return words[0], ' '.join(words[1:]) or None
+
+
+def parse_integer(s:pd.Series, dtype:str) -> pd.Series:
+    '''
+    the first number in the text: '$31,995' / '$31,995.00' / 'Was $35,995 Now $31,995' -> 31995 / 31995 / 35995;
+    anything without digits, or too large for dtype -> <NA>
+    '''
+    digits = s.astype('string').str.extract(r'(\d[\d,]*)', expand=False).str.replace(',', '', regex=False)
+    values = pd.to_numeric(digits, errors='coerce')
+    limits = np.iinfo(dtype.lower())
+    return values.where(values.between(limits.min, limits.max)).astype(dtype)
+
+
+def parse_year_make_model(year_make_model:pd.Series) -> pd.DataFrame:
+    '''
+    :return: condition, year (Int16), make, model, trim
+    '''
+    parts = year_make_model.astype('string').str.extract(year_make_model_pattern)
+    parts['year'] = pd.to_numeric(parts['year'], errors='coerce').astype('Int16')
+
+    ## model vs trim can only be told apart with a list of models; work on the distinct values, not every row
+    known_models = set(normalize_model_name(v['model']) for v in get_vehicle_make_model_list())
+    model_trim = parts['model_trim'].astype('category')
+    splits = [split_model_trim(value, known_models) for value in model_trim.cat.categories]
+    codes = model_trim.cat.codes.to_numpy()
+    model_values = np.array([model for model, _ in splits] + [None], dtype=object)
+    trim_values = np.array([trim for _, trim in splits] + [None], dtype=object)
+    parts['model'] = model_values[codes]  # code -1 (missing) picks the None at the end
+    parts['trim'] = trim_values[codes]
+    return parts.drop(columns=['model_trim'])
+
+
+def parse_listing_details(listing_details:pd.Series) -> pd.DataFrame:
+    '''
+    :param listing_details: the '^'-joined detail lines from clean_text_remove_newline
+    :return: mileage (Int32), drivetrain, transmission, exterior_color, interior_color
+    '''
+    details = listing_details.astype('string')
+    parsed = pd.DataFrame(index=listing_details.index)
+    parsed['mileage'] = parse_integer(details.str.extract(mileage_pattern)[0], 'Int32')
+    parsed['drivetrain'] = details.str.extract(drivetrain_pattern)[0].str.lower().map(drivetrain_names)
+    parsed['transmission'] = details.str.extract(transmission_pattern)[0].str.title()
+    parsed['transmission'] = parsed['transmission'].replace('Cvt', 'CVT')
+    parsed['exterior_color'] = details.str.extract(exterior_color_pattern)[0].str.strip().str.title()
+    parsed['interior_color'] = details.str.extract(interior_color_pattern)[0].str.strip().str.title()
+    return parsed
+
+
+def build_listing_catalog(image_urls_df:pd.DataFrame=None, search_results_df:pd.DataFrame=None) -> pd.DataFrame:
+    '''
+    One typed row per vehicle listing, parsed from the raw strings the scraper saves.
+
+    :param image_urls_df: e.g. compile_image_urls_df(); default: compile it
+    :param search_results_df: e.g. compile_search_results_df(); default: compile it. Pass an empty DF to skip
+                              the search make/model and body_style columns
+    :return: DF with vehicle_id (int64), price (Int32), year (Int16), mileage (Int32), n_images (int16),
+             and categorical condition / make / model / trim / drivetrain / transmission / colors
+    '''
+    if image_urls_df is None:
+        from find_vehicle_image_urls import compile_image_urls_df
+        image_urls_df = compile_image_urls_df()
+    if search_results_df is None:
+        from find_vehicle_image_urls import compile_search_results_df
+        search_results_df = compile_search_results_df()
+
+    n_images = image_urls_df.groupby('vehicle_id').size()
+    listings = image_urls_df[listing_columns].drop_duplicates(subset=['vehicle_id'], keep='last')
+    listings = listings.set_index('vehicle_id')
+
+    catalog = pd.DataFrame(index=listings.index)
+    catalog['vin'] = listings['vin']
+    catalog['url'] = listings['url']
+    catalog['price'] = parse_integer(listings['list_price'], 'Int32')
+    catalog = catalog.join(parse_year_make_model(listings['year_make_model']))
+    catalog = catalog.join(parse_listing_details(listings['listing_details']))
+    catalog['n_images'] = n_images.reindex(catalog.index).fillna(0).astype('int16')
+
+    if len(search_results_df) > 0:
+        body_styles = {(v['make'], v['model']): v['body_style'] for v in get_vehicle_make_model_list()}
+        search = search_results_df.assign(vehicle_id=pd.to_numeric(search_results_df['vehicle_id'], errors='coerce'))
+        search = search.dropna(subset=['vehicle_id']).drop_duplicates(subset=['vehicle_id'], keep='last')
+        search = search.set_index(search['vehicle_id'].astype('int64'))[['make', 'model']]
+        search.columns = ['search_make', 'search_model']
+        search['body_style'] = [body_styles.get(key) for key in zip(search['search_make'], search['search_model'])]
+        catalog = catalog.join(search, how='left')
+
+    for column in categorical_columns:
+        if column in catalog:
+            catalog[column] = catalog[column].astype('category')
+    catalog.index = catalog.index.astype('int64')
+    return catalog.reset_index()
+
+
+def compact_image_urls_df(image_urls_df:pd.DataFrame) -> pd.DataFrame:
+    '''
+    just the image url and vehicle_id per image; the listing fields repeated on every image row live in the catalog,
+    join on vehicle_id when they are needed
+    '''
+    df = image_urls_df[['vehicle_image_url', 'vehicle_id']].copy()
+    df['vehicle_id'] = df['vehicle_id'].astype('int64')
+    return df
+
+
+def memory_mb(df:pd.DataFrame) -> float:
+    return round(df.memory_usage(deep=True).sum() / 2 ** 20, 1)
+
+
+if __name__ == '__main__':
+    import time
+    from find_vehicle_image_urls import compile_image_urls_df, compile_search_results_df
+
+    image_urls_df = compile_image_urls_df()
+    search_results_df = compile_search_results_df()
+    start = time.time()
+    catalog = build_listing_catalog(image_urls_df, search_results_df)
+    images = compact_image_urls_df(image_urls_df)
+    print(f'catalog built in {time.time() - start:.1f}s')
+    print(f'raw image urls {memory_mb(image_urls_df)} MB -> compact {memory_mb(images)} MB + catalog {memory_mb(catalog)} MB')
+    print(catalog.dtypes)
+    print(catalog.head().T)
@@ -0,0 +1,166 @@
+import re
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import lxml.html
+
+from find_vehicle_image_urls import clean_text_remove_newline, get_clean_vin
+
+
+site_unavailable_text = 'site is currently unavailable'
+
+## roughly the elements a browser renders on their own line, so that text comes out like selenium's element.text
+block_tags = {'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'fieldset', 'figcaption',
+              'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav',
+              'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'}
+invisible_tags = {'script', 'style', 'noscript', 'template', 'head'}
+whitespace_pattern = re.compile(r'\s+')
+
+
+def _has_class(*classes) -> str:
+    return ' and '.join(f'contains(concat(" ", normalize-space(@class), " "), " {c} ")' for c in classes)
+
+
+## same selectors process_vehicle_webpage used to look up one by one over the webdriver protocol
+listing_xpaths = {
+    'year_make_model': '//h1[@data-cmp="heading" and @id="vehicle-details-heading"]',
+    'list_price': '//*[@data-cmp="listingPrice"]',
+    'vin': f'//span[{_has_class("display-block", "display-sm-inline-block")}]',
+    'listing_detail': f'//ul[@data-cmp="listColumns" and {_has_class("list", "columns", "columns-1")}]',
+    'listing_narrative': '//*[@data-cmp="seeMore"]',
+    'header_image_url': '//*[@data-cmp="responsiveImage"]',
+}
+
+
+@dataclass
+class ListingFields:
+    year_make_model: Optional[str] = None
+    list_price: Optional[str] = None
+    vin: Optional[str] = None
+    listing_detail: Optional[str] = None
+    listing_narrative: Optional[str] = None
+    header_image_url: Optional[str] = None
+    page_unavailable: bool = False
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def is_hidden(element) -> bool:
+    if element.get('hidden') is not None or element.get('aria-hidden') == 'true':
+        return True
+    style = (element.get('style') or '').replace(' ', '').lower()
+    return 'display:none' in style or 'visibility:hidden' in style
+
+
+def element_text(element) -> str:
+    '''
+    approximation of selenium's element.text: visible text only, one line per block element (and <br>);
+    newlines in the html source are just whitespace, like in the browser
+    '''
+    chunks = []
+
+    def add_text(text):
+        if text:
+            chunks.append(whitespace_pattern.sub(' ', text))
+
+    def walk(el):
+        tag = el.tag if isinstance(el.tag, str) else None  # comments, processing instructions
+        if tag is None or tag in invisible_tags or is_hidden(el):
+            add_text(el.tail)
+            return
+        if tag in block_tags:
+            chunks.append('\n')
+        add_text(el.text)
+        for child in el:
+            walk(child)
+        if tag in block_tags:
+            chunks.append('\n')
+        add_text(el.tail)
+
+    tail = element.tail
+    element.tail = None
+    try:
+        walk(element)
+    finally:
+        element.tail = tail
+
+    lines = [' '.join(line.split()) for line in ''.join(chunks).split('\n')]
+    return '\n'.join(line for line in lines if line)
+
+
+def is_site_unavailable(page_source:str) -> bool:
+    return site_unavailable_text in str(page_source)
+
+
+def extract_listing_fields(page_source:str) -> ListingFields:
+    '''
+    Parse every field we want from a vehicle listing page in one go, from one snapshot of the page source.
+
+    :param page_source: driver.page_source, or a saved html file
+    :return: ListingFields; fields that could not be found are None
+    '''
+    fields = ListingFields(page_unavailable=is_site_unavailable(page_source))
+    if not str(page_source).strip():
+        return fields
+    tree = lxml.html.fromstring(page_source)
+
+    def first(name):
+        found = tree.xpath(listing_xpaths[name])
+        return found[0] if len(found) > 0 else None
+
+    element = first('year_make_model')
+    if element is not None:
+        fields.year_make_model = element_text(element)
+
+    element = first('list_price')
+    if element is not None:
+        fields.list_price = clean_text_remove_newline(element_text(element)).split('^')[-1].strip()
+
+    element = first('vin')
+    if element is not None:
+        fields.vin = get_clean_vin(element_text(element))
+
+    element = first('listing_detail')
+    if element is not None:
+        fields.listing_detail = clean_text_remove_newline(element_text(element))
+
+    element = first('listing_narrative')
+    if element is not None:
+        fields.listing_narrative = clean_text_remove_newline(element_text(element))
+
+    element = first('header_image_url')
+    if element is not None:
+        fields.header_image_url = element.get('src')
+
+    return fields
+
+
+def extract_vehicle_listing_links(page_source:str, base_url:str=None) -> list:
+    '''
+    like find_vehicle_listing_links, but from a snapshot of a search results page
+    :param base_url: url of the page, to make the hrefs absolute like selenium's get_attribute("href") does
+    :return: list of (listing_header, url) tuples
+    '''
+    if not str(page_source).strip():
+        return []
+    tree = lxml.html.fromstring(page_source)
+    if base_url is not None:
+        tree.make_links_absolute(base_url)
+    return [(element_text(element), element.get('href'))
+            for element in tree.xpath('//a[contains(@href, "/cars-for-sale/vehicle/")]')]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    ## benchmark extraction against saved html files, e.g. python listing_extraction.py page1.html page2.html
+    for filepath in sys.argv[1:]:
+        with open(filepath, encoding='utf-8') as f:
+            page_source = f.read()
+        start = time.perf_counter()
+        fields = extract_listing_fields(page_source)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f'{filepath} - {elapsed_ms:.1f} ms')
+        print(fields)
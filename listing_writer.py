@@ -0,0 +1,170 @@
+import os
+import json
+import gzip
+import time
+import atexit
+import threading
+
+import pandas as pd
+
+from find_vehicle_image_urls import parent_directory_url_csvs, search_results_dtypes, image_urls_dtypes
+
+
+####################################
+### Settings
+parts_subdirectory = 'parts'  # part files go in {parent_directory_url_csvs}parts/{kind}/
+max_records_per_part = 50000
+max_seconds_per_part = 300  # flush at least this often, so a crash loses at most a few minutes of records
+####################################
+
+part_suffix = '.jsonl.gz'
+part_dtypes = {
+    'search_results': search_results_dtypes,
+    'image_urls': image_urls_dtypes,
+}
+
+
+def parts_directory(kind:str, folder:str=parent_directory_url_csvs) -> str:
+    return os.path.join(folder, parts_subdirectory, kind)
+
+
+class ListingWriter:
+    '''
+    Buffers the rows that used to become one csv per listing / per search, and writes them in batches
+    to gzipped JSONL part files: parts/{kind}/part-{timestamp}-{pid}-{seq}.jsonl.gz
+
+    A part is written to a hidden temp file and renamed into place once complete,
+    so readers only ever see whole parts. Parts are never appended to after that.
+
+    The buffer is flushed once it holds max_records rows, and by a timer max_seconds after the first buffered row,
+    whether or not anything else is written. Crawl workers also flush before they mark a job done
+    (see crawl_frontier.run_job), since forked workers leave without running atexit hooks.
+
+    usage:
+        writer = ListingWriter('image_urls')
+        writer.write(df)
+        ...
+        writer.close()  # flushes whatever is still buffered
+    '''
+
+    def __init__(self, kind:str, folder:str=parent_directory_url_csvs, max_records:int=max_records_per_part,
+                 max_seconds:float=max_seconds_per_part):
+        if kind not in part_dtypes:
+            raise ValueError(f'unknown kind {kind}, expected one of {list(part_dtypes)}')
+        self.kind = kind
+        self.directory = parts_directory(kind, folder)
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self._buffer = []
+        self._first_buffered_at = None
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, df:pd.DataFrame):
+        if len(df) == 0:
+            return
+        records = json.loads(df.to_json(orient='records'))
+        with self._lock:
+            if self._first_buffered_at is None:
+                self._first_buffered_at = time.time()
+                self._start_timer()
+            self._buffer += records
+            due = len(self._buffer) >= self.max_records or time.time() - self._first_buffered_at >= self.max_seconds
+        if due:
+            self.flush()
+
+    def _start_timer(self):
+        '''
+        flush max_seconds from now, even if write() is never called again; called holding the lock
+        '''
+        if self.max_seconds is None or (self._timer is not None and self._timer.is_alive()):
+            return
+        self._timer = threading.Timer(self.max_seconds, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self) -> str:
+        '''
+        :return: path of the part that was written, None if there was nothing to write
+        '''
+        with self._lock:
+            records, self._buffer = self._buffer, []
+            self._first_buffered_at = None
+            if self._timer is not None and self._timer is not threading.current_thread():
+                self._timer.cancel()
+            self._timer = None
+            if len(records) == 0:
+                return None
+            self._seq += 1
+            filename = f'part-{int(time.time())}-{os.getpid()}-{self._seq:05d}{part_suffix}'
+
+        filepath = os.path.join(self.directory, filename)
+        tmp_filepath = os.path.join(self.directory, f'.{filename}.tmp')
+        with gzip.open(tmp_filepath, 'wt', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_filepath, filepath)
+        print(f'saved {len(records)} {self.kind} records to {filepath}')
+        return filepath
+
+    def close(self):
+        self.flush()
+
+
+_writers = {}  # (kind, folder) -> process-wide ListingWriter
+
+
+def get_listing_writer(kind:str, folder:str=parent_directory_url_csvs) -> ListingWriter:
+    '''
+    process-wide writer per kind; flushed when the interpreter exits
+    '''
+    key = (kind, folder)
+    if key not in _writers:
+        _writers[key] = ListingWriter(kind, folder)
+        atexit.register(_writers[key].close)
+    return _writers[key]
+
+
+def flush_listing_writers():
+    '''
+    write out everything buffered so far, e.g. before compiling in the same notebook
+    '''
+    for writer in _writers.values():
+        writer.flush()
+
+
+def list_parts(kind:str, folder:str=parent_directory_url_csvs) -> list:
+    '''
+    :return: committed part files of this kind, as paths relative to folder
+    '''
+    directory = parts_directory(kind, folder)
+    if not os.path.isdir(directory):
+        return []
+    with os.scandir(directory) as entries:
+        return sorted(os.path.relpath(entry.path, folder) for entry in entries
+                      if entry.name.startswith('part-') and entry.name.endswith(part_suffix))
+
+
+def read_listing_parts(kind:str, files:list=None, folder:str=parent_directory_url_csvs) -> pd.DataFrame:
+    '''
+    counterpart of read_metadata_csvs for part files: same columns and dtypes, plus the part filename
+    :param files: part paths relative to folder, default all of them
+    '''
+    dtypes = part_dtypes[kind]
+    usecols = list(dtypes.keys())
+    files = list_parts(kind, folder) if files is None else files
+    dfs = []
+    for file in files:
+        df = pd.read_json(os.path.join(folder, file), lines=True, compression='gzip', dtype=False,
+                          convert_dates=False)
+        if len(df) == 0:
+            continue
+        ## like read_csv(dtype=...): missing strings stay NaN rather than becoming 'nan'
+        df = df.reindex(columns=usecols).astype({c: t for c, t in dtypes.items() if t != 'str'})
+        df['filename'] = file
+        dfs.append(df)
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=usecols + ['filename'])
+    return pd.concat(dfs, ignore_index=True)
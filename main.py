@@ -1,16 +1,279 @@
-# This is a sample Python script.
+'''
+Command line entry point for the scraper.
 
-# Press ⌃R to execute it or replace it with your code.
-# Press Double ⇧ to search everywhere for classes, files, tool windows, actions, and settings.
+    python main.py search --make ford --model f150 --pages 5 --frontier
+    python main.py search --planned 100 --frontier
+    python main.py listings --frontier --workers 3
+    python main.py listings https://www.autotrader.com/cars-for-sale/vehicle/725617155 --backend http
+    python main.py listings https://www.autotrader.com/cars-for-sale/vehicle/725617155 --backend tabs --tabs 4
+    python main.py download
+    python main.py compile --catalog
+    python main.py stats
+    python main.py inventory --rebuild --by body_style
 
+Only argparse is imported up front; each subcommand imports what it needs when it runs,
+so `python main.py compile` never loads selenium.
+'''
+import sys
+import time
+import argparse
 
-def print_hi(name):
-    # Use a breakpoint in the code line below to debug your script.
-    print(f'Hi, {name}')  # Press ⌘F8 to toggle the breakpoint.
 
+def cmd_search(args) -> int:
+    from find_vehicle_image_urls import get_vehicle_make_model_list, sweep_search_results, compile_search_results_df
+    from driver_pool import DriverPool
 
-# Press the green button in the gutter to run the script.
-if __name__ == '__main__':
-    print_hi('PyCharm')
+    vehicles = get_vehicle_make_model_list()
+    if args.make is not None:
+        vehicles = [v for v in vehicles if v['make'] == args.make]
+    if args.model is not None:
+        vehicles = [v for v in vehicles if v['model'] == args.model]
+    if len(vehicles) == 0:
+        ## not in the list, search for it anyway
+        vehicles = [{'make': args.make, 'model': args.model}]
+    if any(v.get('make') is None or v.get('model') is None for v in vehicles):
+        print('search needs --make and --model, or a make/model from get_vehicle_make_model_list')
+        return 2
+
+    ## the planner always needs them, to tell which listings a search found are new
+    known_vehicle_ids = set(compile_search_results_df()['vehicle_id'].dropna()) \
+        if args.skip_known or args.planned else set()
+    frontier = None
+    if args.frontier:
+        from crawl_frontier import CrawlFrontier
+        frontier = CrawlFrontier()
+
+    n_listings = 0
+    try:
+        with DriverPool(size=1, lean=args.lean) as pool:
+            if args.planned:
+                from search_planner import SearchPlanner, run_planned_searches
+                with SearchPlanner(vehicles=vehicles) as planner:
+                    df = run_planned_searches(args.planned, planner=planner, pool=pool, frontier=frontier,
+                                              known_vehicle_ids=known_vehicle_ids, sleep=args.sleep)
+                n_listings += len(df)
+            else:
+                for vehicle in vehicles:
+                    vehicle_info = {**vehicle, 'first_record': args.first_record}
+                    if args.zipcode is not None:
+                        vehicle_info['zipcode'] = args.zipcode
+                    df, _ = sweep_search_results(vehicle_info, known_vehicle_ids=known_vehicle_ids, pool=pool,
+                                                 frontier=frontier, max_pages=args.pages, sleep=args.sleep)
+                    n_listings += len(df)
+    finally:
+        if frontier is not None:
+            frontier.close()
+    print(f'search - {n_listings} listings found')
+    return 0
+
+
+def cmd_listings(args) -> int:
+    if args.frontier and args.workers > 1:
+        from crawl_scheduler import CrawlScheduler
+        CrawlScheduler(n_workers=args.workers, kind='listing', max_jobs_per_worker=args.max_jobs).run()
+        return 0
+
+    from driver_pool import DriverPool
+    if args.frontier:
+        from crawl_frontier import CrawlFrontier, run_listing_jobs
+        with CrawlFrontier() as frontier, DriverPool(size=1, lean=args.lean) as pool:
+            n_done = run_listing_jobs(frontier, pool=pool, max_jobs=args.max_jobs, sleep=args.sleep)
+            print(f'listings - {n_done} done, frontier: {frontier.counts("listing")}')
+        return 0
+
+    if len(args.urls) == 0:
+        print('listings needs urls, or --frontier')
+        return 2
+    if args.backend == 'tabs':
+        from tab_concurrency import process_vehicle_webpages_in_tabs
+        from find_vehicle_image_urls import tabs_per_browser
+        df = process_vehicle_webpages_in_tabs(args.urls, n_tabs=args.tabs or tabs_per_browser, lean=args.lean)
+    elif args.backend == 'http':
+        from http_extraction import process_vehicle_webpages
+        with DriverPool(size=1, lean=args.lean) as pool:
+            df = process_vehicle_webpages(args.urls, pool=pool)
+    else:
+        import pandas as pd
+        from find_vehicle_image_urls import process_vehicle_webpage
+        dfs = []
+        with DriverPool(size=1, lean=args.lean) as pool:
+            for url in args.urls:
+                df, _ = process_vehicle_webpage(url, pool=pool)
+                dfs.append(df)
+                if args.sleep:
+                    time.sleep(args.sleep)
+        df = pd.concat(dfs, ignore_index=True)
+    print(f'listings - {len(df)} image urls from {len(args.urls)} listings')
+    return 0
+
+
+def cmd_download(args) -> int:
+    from find_vehicle_image_urls import parent_directory_images
+    from download_images import ImageDownloader
+    from download_manifest import build_download_manifest, pending_downloads, iter_download_chunks
+    dest_dir = args.dest or parent_directory_images
+    df = build_download_manifest()
+    if args.make is not None:
+        df = df[df['make'] == args.make]
+    pending = pending_downloads(df, images_dir=dest_dir)
+    print(f'download - {len(df)} image urls, {len(pending)} not downloaded yet')
+    kwargs = {'max_workers': args.workers, 'requests_per_second': args.rps}
+    downloader = ImageDownloader(dest_dir=dest_dir, **{k: v for k, v in kwargs.items() if v is not None})
+    downloader.run_chunks(iter_download_chunks(pending))
+    return 0
+
+
+def cmd_compile(args) -> int:
+    from find_vehicle_image_urls import compile_search_results_df, compile_image_urls_df
+    start = time.time()
+    search_results_df = compile_search_results_df(use_store=not args.no_store)
+    image_urls_df = compile_image_urls_df(use_store=not args.no_store)
+    print(f'compile - {len(search_results_df)} search results, {image_urls_df["vehicle_id"].nunique()} listings, '
+          f'{len(image_urls_df)} image urls in {time.time() - start:.1f}s')
+    if args.catalog:
+        from listing_catalog import build_listing_catalog
+        catalog = build_listing_catalog(image_urls_df, search_results_df)
+        print(catalog.describe(include='all').T)
+        if args.output:
+            catalog.to_pickle(args.output)
+            print(f'saved catalog to {args.output}')
+    return 0
+
+
+def cmd_stats(args) -> int:
+    import os
+    from find_vehicle_image_urls import crawl_frontier_path, page_archive_dir, parent_directory_images, \
+        metadata_store_path
+    if os.path.exists(crawl_frontier_path):
+        from crawl_frontier import CrawlFrontier
+        with CrawlFrontier() as frontier:
+            print(f'frontier - search jobs {frontier.counts("search")}')
+            print(f'frontier - listing jobs {frontier.counts("listing")}')
+    if os.path.exists(metadata_store_path):
+        import sqlite3
+        conn = sqlite3.connect(metadata_store_path)
+        for table in ['search_results', 'image_urls']:
+            try:
+                print(f'metadata store - {table}: {conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]} rows')
+            except sqlite3.OperationalError:
+                pass
+        conn.close()
+    if os.path.exists(os.path.join(page_archive_dir, 'index.sqlite')):
+        from page_archive import PageArchive
+        with PageArchive() as archive:
+            print(f'page archive - {archive.stats()}')
+    from download_images import download_manifest_filename
+    manifest_path = os.path.join(parent_directory_images, download_manifest_filename)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            print(f'images - {sum(1 for line in f if line.strip())} downloaded')
+    from image_inventory import image_inventory_filename
+    if os.path.exists(os.path.join(parent_directory_images, image_inventory_filename)):
+        from image_inventory import ImageInventory
+        with ImageInventory() as inventory:
+            print(f'image inventory - {inventory.stats()}')
+    return 0
+
+
+def cmd_inventory(args) -> int:
+    from find_vehicle_image_urls import parent_directory_images
+    from image_inventory import ImageInventory
+    with ImageInventory(images_dir=args.dest or parent_directory_images) as inventory:
+        if args.rebuild or len(inventory) == 0:
+            inventory.rebuild(**({} if args.workers is None else {'n_workers': args.workers}))
+        if args.vehicle_id is not None:
+            print(inventory.per_vehicle(args.vehicle_id).to_string(index=False))
+            return 0
+        print(f'image inventory - {inventory.stats()}')
+        print(inventory.class_balance(by=args.by).to_string(index=False))
+        distribution = inventory.size_distribution()
+        print(f'file sizes - {distribution["histogram"]}')
+        print(f'file size quantiles (KB) - {distribution["quantiles_kb"]}')
+        print(distribution['dimensions'].to_string(index=False))
+    return 0
 
-# See PyCharm help at https://www.jetbrains.com/help/pycharm/
+
+def handler_modules(command:str) -> list:
+    '''
+    the modules the handler of a subcommand imports when it runs, read from its source;
+    for checking what each subcommand costs to start, see tests/test_cli_startup.py
+    '''
+    import ast
+    import inspect
+    handler = build_parser().parse_args([command]).func
+    modules = []
+    for node in ast.walk(ast.parse(inspect.getsource(handler))):
+        if isinstance(node, ast.ImportFrom):
+            modules.append(node.module)
+        elif isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+    return list(dict.fromkeys(modules))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search = subparsers.add_parser('search', help='scrape search results pages for make/models')
+    search.add_argument('--make')
+    search.add_argument('--model')
+    search.add_argument('--zipcode', help='default: a random location, see location_sampling_weights')
+    search.add_argument('--first-record', type=int, default=0)
+    search.add_argument('--pages', type=int, default=1, help='max search results pages per make/model')
+    search.add_argument('--skip-known', action='store_true',
+                        help='stop sweeping once pages are mostly vehicles already collected')
+    search.add_argument('--planned', type=int, metavar='N',
+                        help='instead of sweeping, load N search results pages picked by the search planner')
+    search.add_argument('--frontier', action='store_true', help='queue the listings found as frontier jobs')
+    search.add_argument('--sleep', type=float, default=0, help='seconds between pages')
+    search.add_argument('--lean', action='store_true', help='lean browser, see find_vehicle_image_urls.lean')
+    search.set_defaults(func=cmd_search)
+
+    listings = subparsers.add_parser('listings', help='scrape vehicle listing pages')
+    listings.add_argument('urls', nargs='*')
+    listings.add_argument('--frontier', action='store_true', help='run the pending listing jobs of the frontier')
+    listings.add_argument('--workers', type=int, default=1, help='with --frontier, browser processes in parallel')
+    listings.add_argument('--max-jobs', type=int)
+    listings.add_argument('--backend', choices=['browser', 'http', 'tabs'], default='browser',
+                          help='http: plain http first, the browser only for pages that need it; '
+                               'tabs: several listings at once in one browser')
+    listings.add_argument('--tabs', type=int, help='with --backend tabs, default: tabs_per_browser')
+    listings.add_argument('--sleep', type=float, default=0, help='seconds between pages')
+    listings.add_argument('--lean', action='store_true')
+    listings.set_defaults(func=cmd_listings)
+
+    download = subparsers.add_parser('download', help='download the image files of the compiled listings')
+    download.add_argument('--make')
+    download.add_argument('--dest', help='default: parent_directory_images')
+    download.add_argument('--workers', type=int, help='default: download_images.max_workers')
+    download.add_argument('--rps', type=float, help='requests per second over all workers, '
+                                                    'default: download_images.requests_per_second')
+    download.set_defaults(func=cmd_download)
+
+    compile_ = subparsers.add_parser('compile', help='compile the scraped metadata')
+    compile_.add_argument('--no-store', action='store_true', help='read every csv instead of the metadata store')
+    compile_.add_argument('--catalog', action='store_true', help='also build the typed listing catalog')
+    compile_.add_argument('--output', help='with --catalog, save it to this pickle')
+    compile_.set_defaults(func=cmd_compile)
+
+    stats = subparsers.add_parser('stats', help='progress of the crawl so far')
+    stats.set_defaults(func=cmd_stats)
+
+    inventory = subparsers.add_parser('inventory', help='class balance and file sizes of the downloaded images')
+    inventory.add_argument('--rebuild', action='store_true',
+                           help='walk the image tree and bring the inventory up to date first')
+    inventory.add_argument('--by', nargs='+', choices=['make', 'model', 'body_style'], default=['make', 'model'])
+    inventory.add_argument('--vehicle-id', type=int, help='list the images of one vehicle instead')
+    inventory.add_argument('--dest', help='default: parent_directory_images')
+    inventory.add_argument('--workers', type=int, help='default: image_inventory.scan_workers')
+    inventory.set_defaults(func=cmd_inventory)
+    return parser
+
+
+def main(argv:list=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import os
+import re
+import sqlite3
+
+import pandas as pd
+
+from find_vehicle_image_urls import parent_directory_url_csvs, metadata_store_path, read_metadata_csvs, \
+    concat_metadata_dfs, search_results_file_pattern, search_results_dtypes, image_urls_file_pattern, image_urls_dtypes
+from listing_writer import list_parts, read_listing_parts
+
+
+## kind -> (filename pattern, column dtypes)
+metadata_kinds = {
+    'search_results': (search_results_file_pattern, search_results_dtypes),
+    'image_urls': (image_urls_file_pattern, image_urls_dtypes),
+}
+
+
+class MetadataStore:
+    '''
+    Consolidated copy of all the per-search / per-vehicle csvs (and ListingWriter part files) in one SQLite database.
+
+    Alongside the data, the store keeps a manifest of which csvs have been ingested (by name, mtime and size).
+    Compiling only reads csvs that are new or have changed since the last compile, and then loads everything
+    with a single query, so compile time no longer grows with the number of csv files.
+    '''
+
+    def __init__(self, path:str=metadata_store_path, folder:str=parent_directory_url_csvs):
+        self.path = path
+        self.folder = folder
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingested_files (
+                filename TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                n_rows INTEGER NOT NULL
+            )
+        ''')
+        for kind, (_, dtypes) in metadata_kinds.items():
+            columns = ', '.join(f'{column} {"INTEGER" if dtype.lower().startswith("int") else "TEXT"}'
+                                for column, dtype in dtypes.items())
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS {kind} ({columns}, filename TEXT NOT NULL)')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {kind}_filename ON {kind} (filename)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def find_new_files(self, kind:str) -> list:
+        '''
+        :return: csvs of this kind that are not in the manifest yet, or whose mtime/size changed since ingestion
+        '''
+        pattern, _ = metadata_kinds[kind]
+        ingested = {
+            filename: (mtime, size) for filename, mtime, size in
+            self.conn.execute('SELECT filename, mtime, size FROM ingested_files WHERE kind = ?', (kind,))
+        }
+        new_files = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not re.search(pattern, entry.name):
+                    continue
+                stat = entry.stat()
+                if ingested.get(entry.name) != (stat.st_mtime, stat.st_size):
+                    new_files.append((entry.name, stat.st_mtime, stat.st_size))
+        ## batched part files from the ListingWriter, keyed by their path relative to the folder
+        for part in list_parts(kind, self.folder):
+            stat = os.stat(os.path.join(self.folder, part))
+            if ingested.get(part) != (stat.st_mtime, stat.st_size):
+                new_files.append((part, stat.st_mtime, stat.st_size))
+        return new_files
+
+    def ingest(self, kind:str) -> int:
+        '''
+        read any new csvs of this kind into the store
+        :return: number of files ingested
+        '''
+        _, dtypes = metadata_kinds[kind]
+        new_files = self.find_new_files(kind)
+        if len(new_files) == 0:
+            return 0
+
+        print(f'metadata store - ingesting {len(new_files)} new {kind} files')
+        filenames = [filename for filename, _, _ in new_files]
+        parts = [filename for filename in filenames if os.sep in filename]
+        csvs = [filename for filename in filenames if os.sep not in filename]
+        df = concat_metadata_dfs([read_metadata_csvs(self.folder, csvs, dtypes),
+                                  read_listing_parts(kind, parts, self.folder)])
+        n_rows = df.groupby('filename').size().to_dict()
+
+        with self.conn:
+            ## changed files get replaced, not duplicated
+            self.conn.executemany(f'DELETE FROM {kind} WHERE filename = ?', [(filename,) for filename, _, _ in new_files])
+            df.to_sql(kind, self.conn, if_exists='append', index=False, chunksize=10000)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO ingested_files (filename, kind, mtime, size, n_rows) VALUES (?, ?, ?, ?, ?)',
+                [(filename, kind, mtime, size, int(n_rows.get(filename, 0))) for filename, mtime, size in new_files]
+            )
+        return len(new_files)
+
+    def load(self, kind:str) -> pd.DataFrame:
+        _, dtypes = metadata_kinds[kind]
+        columns = list(dtypes.keys()) + ['filename']
+        return pd.read_sql_query(f'SELECT {", ".join(columns)} FROM {kind}', self.conn, dtype=dtypes)
+
+    def compile(self, kind:str) -> pd.DataFrame:
+        self.ingest(kind)
+        return self.load(kind)
@@ -0,0 +1,269 @@
+import os
+import time
+import uuid
+import zlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from find_vehicle_image_urls import page_archive_dir
+
+
+####################################
+### Settings
+max_segment_bytes = 256 * 2 ** 20  # start a new segment file after this many (compressed) bytes
+compression_level = 6
+####################################
+
+
+class PageArchive:
+    '''
+    Append-only archive of the final html of every page the scraper visited (after scrolling),
+    so that extraction can be fixed and re-run over the archive instead of re-crawling the site.
+
+    Layout of the archive directory:
+    - segment-{started}-{pid}-{random}.zz: one zlib-compressed record per page, appended back to back;
+      every PageArchive instance writes its own segment (created exclusively), so concurrent crawl workers,
+      or two archives in one process, never interleave bytes
+    - index.sqlite: one row per page with kind ('listing' / 'search'), key (vehicle_id / search url),
+      url, archived_at, and where the record lives (segment, offset, length)
+
+    Records are never rewritten; a page that is visited again is simply archived again with a newer archived_at.
+
+    usage:
+        with PageArchive() as archive:
+            process_vehicle_webpage(url, archive=archive)
+        df = replay_listings()
+    '''
+
+    def __init__(self, directory:str=page_archive_dir, max_segment_bytes:int=max_segment_bytes):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                url TEXT,
+                archived_at REAL NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                raw_length INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_key ON pages (kind, key, archived_at)')
+        self.conn.commit()
+        self._segment = None
+        self._segment_file = None
+
+    def close(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._segment_file = None
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _open_segment(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment = f'segment-{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:8]}.zz'
+        ## 'x': fail rather than share a segment with another writer, whose offsets would not match ours
+        self._segment_file = open(os.path.join(self.directory, self._segment), 'xb')
+
+    def add(self, kind:str, key, html:str, url:str=None, archived_at:float=None) -> int:
+        '''
+        :param kind: 'listing' (key: vehicle_id) or 'search' (key: search url)
+        :return: id of the archived page
+        '''
+        if self._segment_file is None or self._segment_file.tell() >= self.max_segment_bytes:
+            self._open_segment()
+        raw = str(html).encode('utf-8')
+        record = zlib.compress(raw, compression_level)
+        offset = self._segment_file.tell()
+        self._segment_file.write(record)
+        ## the bytes must be on disk before the index points at them
+        self._segment_file.flush()
+        cursor = self.conn.execute(
+            'INSERT INTO pages (kind, key, url, archived_at, segment, offset, length, raw_length) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (kind, str(key), url, archived_at or time.time(), self._segment, offset, len(record), len(raw))
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def add_driver_page(self, kind:str, key, driver) -> int:
+        '''
+        archive whatever the browser is currently showing; never raises, archiving is best-effort
+        '''
+        try:
+            return self.add(kind, key, driver.page_source, url=driver.current_url)
+        except Exception as e:
+            print(f'could not archive {kind} page {key}: {e}')
+            return None
+
+    def entries(self, kind:str=None, latest_only:bool=True) -> pd.DataFrame:
+        '''
+        :param latest_only: one row per key, the most recently archived version
+        :return: index rows, sorted by segment / offset so reading them back is sequential
+        '''
+        where = 'WHERE kind = ?' if kind is not None else ''
+        params = (kind,) if kind is not None else ()
+        df = pd.read_sql_query(f'SELECT * FROM pages {where}', self.conn, params=params)
+        if latest_only and len(df) > 0:
+            df = df.sort_values('archived_at').drop_duplicates(['kind', 'key'], keep='last')
+        return df.sort_values(['segment', 'offset']).reset_index(drop=True)
+
+    def read(self, page_id:int) -> str:
+        row = self.conn.execute('SELECT segment, offset, length FROM pages WHERE id = ?', (page_id,)).fetchone()
+        if row is None:
+            raise KeyError(page_id)
+        return read_record(self.directory, *row)
+
+    def latest(self, kind:str, key) -> str:
+        '''
+        :return: html of the most recent version of this page, or None
+        '''
+        row = self.conn.execute(
+            'SELECT segment, offset, length FROM pages WHERE kind = ? AND key = ? ORDER BY archived_at DESC LIMIT 1',
+            (kind, str(key))
+        ).fetchone()
+        return None if row is None else read_record(self.directory, *row)
+
+    def stats(self) -> dict:
+        n_pages, n_bytes, n_raw_bytes = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(length), 0), COALESCE(SUM(raw_length), 0) FROM pages'
+        ).fetchone()
+        return {
+            'pages': n_pages,
+            'compressed_mb': round(n_bytes / 2 ** 20, 1),
+            'raw_mb': round(n_raw_bytes / 2 ** 20, 1),
+            'by_kind': dict(self.conn.execute('SELECT kind, COUNT(*) FROM pages GROUP BY kind').fetchall()),
+        }
+
+
+def read_record(directory:str, segment:str, offset:int, length:int, segment_file=None) -> str:
+    if segment_file is None:
+        with open(os.path.join(directory, segment), 'rb') as f:
+            return read_record(directory, segment, offset, length, f)
+    segment_file.seek(offset)
+    return zlib.decompress(segment_file.read(length)).decode('utf-8')
+
+
+def iter_records(directory:str, entries:list):
+    '''
+    yield (entry, html) for index rows, keeping one segment file open at a time
+    '''
+    segment, segment_file = None, None
+    try:
+        for entry in entries:
+            if entry['segment'] != segment:
+                if segment_file is not None:
+                    segment_file.close()
+                segment = entry['segment']
+                segment_file = open(os.path.join(directory, segment), 'rb')
+            yield entry, read_record(directory, entry['segment'], entry['offset'], entry['length'], segment_file)
+    finally:
+        if segment_file is not None:
+            segment_file.close()
+
+
+def extract_listing_rows(directory:str, entries:list) -> list:
+    '''
+    the same rows process_vehicle_webpage writes to {vehicle_id}.csv, from archived listing pages
+    '''
+    from listing_extraction import extract_listing_fields
+    from image_url_collector import ImageUrlCollector
+    rows = []
+    for entry, html in iter_records(directory, entries):
+        fields = extract_listing_fields(html)
+        if fields.page_unavailable:
+            continue
+        collector = ImageUrlCollector()
+        collector.add_page_source(html)
+        image_urls = collector.urls
+        if fields.header_image_url is not None:
+            image_urls += [str(fields.header_image_url)]
+        for image_url in dict.fromkeys(image_urls):
+            rows.append({
+                'vehicle_image_url': image_url,
+                'vehicle_id': entry['key'],
+                'url': entry['url'],
+                'vin': fields.vin,
+                'year_make_model': fields.year_make_model,
+                'list_price': fields.list_price,
+                'listing_details': fields.listing_detail,
+                'listing_narrative': fields.listing_narrative,
+                'archived_at': entry['archived_at'],
+            })
+    return rows
+
+
+def extract_search_rows(directory:str, entries:list) -> list:
+    '''
+    the listing links capture_listings_from_current_page finds, from archived search results pages
+    '''
+    from listing_extraction import extract_vehicle_listing_links
+    rows = []
+    for entry, html in iter_records(directory, entries):
+        for listing_header, url in extract_vehicle_listing_links(html, base_url=entry['url']):
+            rows.append({
+                'listing_header': listing_header,
+                'url': url,
+                'search_url': entry['key'],
+                'search_timestamp': int(entry['archived_at']),
+            })
+    return rows
+
+
+def replay(extract_function, kind:str, directory:str=page_archive_dir, n_workers:int=None, chunk_size:int=200,
+           latest_only:bool=True) -> pd.DataFrame:
+    '''
+    run extract_function over every archived page of one kind, in chunks spread over all cores
+    '''
+    with PageArchive(directory) as archive:
+        entries = archive.entries(kind, latest_only=latest_only).to_dict('records')
+    chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+    print(f'replaying {len(entries)} archived {kind} pages in {len(chunks)} chunks')
+
+    start = time.time()
+    rows = []
+    if n_workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            rows += extract_function(directory, chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for chunk_rows in executor.map(extract_function, [directory] * len(chunks), chunks):
+                rows += chunk_rows
+    print(f'replayed {len(entries)} pages in {time.time() - start:.1f}s')
+    return pd.DataFrame(rows)
+
+
+def replay_listings(directory:str=page_archive_dir, **kwargs) -> pd.DataFrame:
+    '''
+    :return: DF like compile_image_urls_df, re-extracted from the archived listing pages
+    '''
+    return replay(extract_listing_rows, 'listing', directory, **kwargs)
+
+
+def replay_search_pages(directory:str=page_archive_dir, **kwargs) -> pd.DataFrame:
+    '''
+    :return: DF like compile_search_results_df (without make/model), re-extracted from the archived search pages
+    '''
+    return replay(extract_search_rows, 'search', directory, **kwargs)
+
+
+if __name__ == '__main__':
+    with PageArchive() as archive:
+        print(archive.stats())
+    df = replay_listings()
+    print(df.head(1).T)
@@ -0,0 +1,145 @@
+from find_vehicle_image_urls import wait_time, scroll_distance, max_scrolls
+
+
+####################################
+### Settings
+quiet_period = 0.15  # seconds without DOM mutations / network activity before we consider the page settled
+step_timeout = 2.0  # seconds, upper bound on how long one scroll step waits for the page to settle
+####################################
+
+
+## Installed once per page (idempotent). Tracks the last time anything happened on the page
+## (DOM mutation, finished resource download, fetch/xhr start or end) and how many fetch/xhr are in flight.
+readiness_probe_js = '''
+var w = window;
+if (!w.__readiness) {
+    var r = {lastActivity: performance.now(), inflight: 0};
+    var touch = function () { r.lastActivity = performance.now(); };
+    new MutationObserver(touch).observe(document.documentElement,
+        {subtree: true, childList: true, attributes: true, characterData: true});
+    try { new PerformanceObserver(touch).observe({entryTypes: ['resource']}); } catch (e) {}
+    if (w.fetch) {
+        var originalFetch = w.fetch;
+        w.fetch = function () {
+            r.inflight++; touch();
+            return originalFetch.apply(this, arguments).finally(function () { r.inflight--; touch(); });
+        };
+    }
+    var originalSend = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        r.inflight++; touch();
+        this.addEventListener('loadend', function () { r.inflight--; touch(); });
+        return originalSend.apply(this, arguments);
+    };
+    w.__readiness = r;
+}
+var r = w.__readiness;
+var pageState = function (el) {
+    var s = el ? {scrollTop: el.scrollTop, scrollHeight: el.scrollHeight, clientHeight: el.clientHeight}
+               : {scrollTop: w.scrollY, scrollHeight: document.documentElement.scrollHeight, clientHeight: w.innerHeight};
+    s.atBottom = s.scrollTop + s.clientHeight >= s.scrollHeight - 2;
+    s.quietMs = performance.now() - r.lastActivity;
+    s.inflight = r.inflight;
+    s.readyState = document.readyState;
+    // a search card links to its listing more than once (image, title), so count distinct vehicle ids
+    var links = document.querySelectorAll('a[href^="/cars-for-sale/vehicle/"]');
+    var vehicleIds = new Set();
+    for (var i = 0; i < links.length; i++) { vehicleIds.add(links[i].pathname.split('/')[3]); }
+    s.listingCount = vehicleIds.size;
+    return s;
+};
+'''
+
+page_state_js = readiness_probe_js + '''
+return pageState(arguments[0]);
+'''
+
+## Scroll (optionally), then wait *inside the browser* until the page has been quiet for quietMs, or timeoutMs passes.
+## One webdriver round-trip per step, and no time wasted once the page has settled.
+scroll_step_js = readiness_probe_js + '''
+var el = arguments[0], distance = arguments[1], quietMs = arguments[2], timeoutMs = arguments[3];
+var done = arguments[arguments.length - 1];
+if (distance) {
+    if (el) { el.scrollTop += distance; } else { w.scrollBy(0, distance); }
+}
+var start = performance.now();
+var check = function () {
+    var now = performance.now();
+    // lazy loading usually kicks in a moment after the scroll, so the quiet window starts at the scroll at the earliest
+    var quiet = Math.min(now - r.lastActivity, now - start) >= quietMs && r.inflight === 0;
+    if (quiet || now - start >= timeoutMs) {
+        var s = pageState(el);
+        s.waitedMs = now - start;
+        s.timedOut = !quiet;
+        s.drained = w.__imageUrlCollector ? w.__imageUrlCollector.drain() : [];
+        done(s);
+    } else {
+        setTimeout(check, 25);
+    }
+};
+check();
+'''
+
+
+def get_page_state(driver, element=None) -> dict:
+    '''
+    scroll position, readiness and listing count of the page (or of a scrollable element) in one call
+    '''
+    return driver.execute_script(page_state_js, element)
+
+
+def scroll_step(driver, distance:int, element=None, quiet_period:float=quiet_period, timeout:float=step_timeout) -> dict:
+    '''
+    scroll the window (or element) by distance pixels and wait until the page settles
+    :return: page state after the step, plus waitedMs, timedOut and any image urls drained from the ImageUrlCollector
+    '''
+    return driver.execute_async_script(scroll_step_js, element, int(distance), quiet_period * 1000, timeout * 1000)
+
+
+def wait_until_quiet(driver, element=None, quiet_period:float=quiet_period, timeout:float=wait_time) -> dict:
+    return scroll_step(driver, 0, element=element, quiet_period=quiet_period, timeout=timeout)
+
+
+def scroll_until_loaded(driver, element=None, expected_count:int=None, min_distance:int=scroll_distance,
+                        max_steps:int=max_scrolls, quiet_period:float=quiet_period, step_timeout:float=step_timeout,
+                        on_step=None, verbose:bool=False) -> dict:
+    '''
+    Scroll the page (or a scrollable element) until everything has loaded.
+
+    Stops when
+    - the bottom is reached and the last step did not load anything that made the page grow, or
+    - the page links to expected_count distinct listings, or
+    - on_step(state) returns True, or
+    - max_steps is reached.
+
+    The scroll distance adapts: if the page settles right away we take bigger steps (up to a few screens),
+    if it has to load we take smaller ones (down to min_distance).
+
+    :return: the last page state
+    '''
+    state = get_page_state(driver, element)
+    viewport = max(int(state['clientHeight'] or 0), min_distance)
+    distance = viewport
+    for i in range(max_steps):
+        if expected_count is not None and state['listingCount'] >= expected_count:
+            if verbose:
+                print(f'scrolling {i} - found {state["listingCount"]} / {expected_count} listings')
+            break
+
+        last_height = state['scrollHeight']
+        state = scroll_step(driver, distance, element=element, quiet_period=quiet_period, timeout=step_timeout)
+        grew = state['scrollHeight'] > last_height
+        if verbose:
+            print(f'scrolling {i}, distance {distance}, waited {state["waitedMs"]:.0f}ms, '
+                  f'{state["scrollTop"]}/{state["scrollHeight"]}')
+
+        if on_step is not None and on_step(state):
+            break
+        if state['atBottom'] and not grew:
+            break
+
+        if state['waitedMs'] <= 1.5 * quiet_period * 1000:
+            distance = min(2 * distance, 4 * viewport)
+        else:
+            distance = max(distance // 2, min_distance)
+    return state
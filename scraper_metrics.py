@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+
+####################################
+### Settings
+# kept here rather than in find_vehicle_image_urls, which imports this module
+metrics_jsonl_path='/Users/levgolod/Projects/car_classifier/data/autotrader/scraper_metrics.jsonl'
+metrics_prometheus_path='/Users/levgolod/Projects/car_classifier/data/autotrader/scraper_metrics.prom'
+export_interval = 60  # seconds between exports from the hot path, see maybe_export
+####################################
+
+latency_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)  # seconds
+count_buckets = (0, 1, 5, 10, 20, 30, 40, 60, 80, 100, 150)  # e.g. images per listing
+
+metric_help = {
+    'driver_init_seconds': 'time to launch a browser session',
+    'page_load_seconds': 'time spent in driver.get',
+    'scroll_seconds': 'time spent scrolling a page or panel until it has loaded',
+    'scroll_steps': 'scroll steps per page or panel',
+    'extraction_seconds': 'time to parse the listing fields from a page snapshot',
+    'field_extractions_total': 'listing field extractions, by field and outcome',
+    'images_per_listing': 'image urls found per vehicle listing',
+    'csv_write_seconds': 'time to write (or, with output_format jsonl, buffer) one listing or search result',
+    'listings_total': 'vehicle listing pages processed, by outcome',
+    'searches_total': 'search results pages processed, by outcome',
+    'browser_rss_mb': 'resident memory of the driver + browser process tree at the last page',
+    'browser_cpu_percent': 'cpu of the driver + browser process tree at the last page, summed over processes',
+    'browser_open_fds': 'open file descriptors of the driver + browser process tree at the last page',
+    'browser_n_processes': 'processes in the driver + browser process tree at the last page',
+    'driver_recycles_total': 'browser sessions recycled by the browser monitor, by reason',
+}
+
+
+class Histogram:
+    def __init__(self, buckets:tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value:float):
+        self.count += 1
+        self.sum += value
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+
+
+class ScraperMetrics:
+    '''
+    Counters, gauges and histograms for the scraper's hot path.
+
+    Every observation is also kept as an event, and export() appends the events to a JSONL file
+    and rewrites a Prometheus textfile (for node_exporter's textfile collector) with the running totals.
+    Per-page code calls maybe_export(), which exports at most every export_interval seconds;
+    whatever is left is exported at the end of a run, and when the interpreter exits.
+    A file whose directory does not exist is skipped (once, with a message) and its events are dropped.
+    Each export is appended to the JSONL file with a single write, so processes sharing the file do not interleave
+    lines; event_labels (e.g. {'worker': 3}) are added to every event, to tell the processes apart.
+
+    usage:
+        with metrics.timer('page_load_seconds', page='listing'):
+            driver.get(url)
+        metrics.inc('field_extractions_total', field='vin', outcome='success')
+        metrics.set('browser_rss_mb', 812.5)
+        metrics.maybe_export()
+    '''
+
+    def __init__(self, jsonl_path:str=metrics_jsonl_path, prometheus_path:str=metrics_prometheus_path):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.event_labels = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._last_export = time.time()
+        self._skipped_paths = set()
+
+    @staticmethod
+    def _key(name:str, labels:dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name:str, value:float=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.events.append({'ts': time.time(), 'metric': name, 'value': value, **self.event_labels, **labels})
+
+    def set(self, name:str, value:float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+            self.events.append({'ts': time.time(), 'metric': name, 'value': value, **self.event_labels, **labels})
+
+    def observe(self, name:str, value:float, buckets:tuple=latency_buckets, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+            self.events.append({'ts': time.time(), 'metric': name, 'value': value, **self.event_labels, **labels})
+
+    @contextmanager
+    def timer(self, name:str, **labels):
+        '''
+        time the block; the observation gets an outcome label of success or error
+        '''
+        start = time.perf_counter()
+        outcome = 'success'
+        try:
+            yield
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, outcome=outcome, **labels)
+
+    def _can_write(self, path:str) -> bool:
+        '''
+        False (and say so once) when the directory of path does not exist, e.g. the default paths on another machine
+        '''
+        if os.path.isdir(os.path.dirname(path) or '.'):
+            return True
+        if path not in self._skipped_paths:
+            self._skipped_paths.add(path)
+            print(f'metrics - {os.path.dirname(path)} does not exist, not exporting to {path}')
+        return False
+
+    def write_jsonl(self, path:str=None):
+        path = path or self.jsonl_path
+        with self._lock:
+            events, self.events = self.events, []
+        if len(events) == 0 or not self._can_write(path):
+            return
+        data = ''.join(json.dumps(event) + '\n' for event in events).encode()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def prometheus_text(self) -> str:
+        def fmt_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+        lines = []
+        with self._lock:
+            names_done = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in names_done:
+                    lines.append(f'# HELP scraper_{name} {metric_help.get(name, name)}')
+                    lines.append(f'# TYPE scraper_{name} counter')
+                    names_done.add(name)
+                lines.append(f'scraper_{name}{fmt_labels(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in names_done:
+                    lines.append(f'# HELP scraper_{name} {metric_help.get(name, name)}')
+                    lines.append(f'# TYPE scraper_{name} gauge')
+                    names_done.add(name)
+                lines.append(f'scraper_{name}{fmt_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda x: x[0]):
+                if name not in names_done:
+                    lines.append(f'# HELP scraper_{name} {metric_help.get(name, name)}')
+                    lines.append(f'# TYPE scraper_{name} histogram')
+                    names_done.add(name)
+                for upper, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'scraper_{name}_bucket{fmt_labels(labels, [("le", upper)])} {count}')
+                lines.append(f'scraper_{name}_bucket{fmt_labels(labels, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'scraper_{name}_sum{fmt_labels(labels)} {histogram.sum}')
+                lines.append(f'scraper_{name}_count{fmt_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path:str=None):
+        path = path or self.prometheus_path
+        if not (self.counters or self.gauges or self.histograms) or not self._can_write(path):
+            return
+        ## write + rename so the collector never reads a half-written file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def export(self):
+        self._last_export = time.time()
+        try:
+            self.write_jsonl()
+            self.write_prometheus()
+        except OSError as e:
+            print(f'could not export metrics: {e}')
+
+    def maybe_export(self, interval:float=export_interval):
+        '''
+        export() if the last export was more than interval seconds ago
+        '''
+        if time.time() - self._last_export >= interval:
+            self.export()
+
+    def summary(self) -> dict:
+        '''
+        mean latency / totals per metric, handy in a notebook
+        '''
+        with self._lock:
+            summary = {}
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                summary[name + fmt_key(labels)] = value
+            for (name, labels), histogram in self.histograms.items():
+                summary[name + fmt_key(labels)] = {
+                    'count': histogram.count,
+                    'mean': histogram.sum / histogram.count if histogram.count else None,
+                }
+        return summary
+
+
+def fmt_key(labels:tuple) -> str:
+    return '' if len(labels) == 0 else '[' + ','.join(f'{k}={v}' for k, v in labels) + ']'
+
+
+## process-wide instance used by the scraper
+metrics = ScraperMetrics()
+atexit.register(metrics.export)
@@ -0,0 +1,256 @@
+import time
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from find_vehicle_image_urls import search_planner_path, search_page_size, get_vehicle_make_model_list
+
+
+####################################
+### Settings
+pages_per_offset_bucket = 10  # offsets are grouped into buckets of this many search results pages
+max_first_record = 5000  # deepest offset tried while a make/model's result count is not known yet
+prior_strength = 2.0  # pseudo page loads behind the prior of an arm that has never been searched
+####################################
+
+n_regions = 10  # first digit of the zip code, roughly northeast (0) to west coast (9)
+
+
+def zip_region(zipcode) -> int:
+    return int(str(zipcode).zfill(5)[0])
+
+
+class SearchPlanner:
+    '''
+    Chooses the next search results pages to load by how many vehicle ids we have not seen yet they are expected
+    to produce, instead of a random make/model, zip and offset.
+
+    An arm is make/model/region/offset bucket, where region is the first digit of the zip code
+    (search results are sorted by distance from the zip, so the region decides which listings come first)
+    and an offset bucket is pages_per_offset_bucket consecutive pages.
+
+    Every page load is recorded with how many listings it returned, how many of those were new,
+    and the make/model's result count. New listings per page load of an arm is modelled as Poisson with a
+    Gamma prior centred on the make/model's average (or the overall average, or a full page for a fresh start),
+    and plan() does Thompson sampling: draw a rate per arm from its posterior, take the arms with the highest draws.
+    Arms that have run dry lose out, and arms that were rarely tried still get picked now and then.
+
+    Offsets at or beyond the last known result count of a make/model are never planned.
+
+    usage:
+        with SearchPlanner() as planner:
+            for vehicle_info in planner.plan(5):
+                df, _ = find_listings_for_make_model(vehicle_info, pool=pool)
+                planner.record_results(vehicle_info, df, known_vehicle_ids)
+    '''
+
+    def __init__(self, path:str=search_planner_path, vehicles:list=None, seed:int=None):
+        '''
+        :param vehicles: make/model dicts to plan over, default get_vehicle_make_model_list()
+        '''
+        self.path = path
+        self.vehicles = get_vehicle_make_model_list() if vehicles is None else vehicles
+        self.rng = np.random.default_rng(seed)
+        self._region_rows = {}
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS search_yield (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                make TEXT NOT NULL,
+                model TEXT NOT NULL,
+                zipcode TEXT,
+                region INTEGER NOT NULL,
+                first_record INTEGER NOT NULL,
+                offset_bucket INTEGER NOT NULL,
+                n_listings INTEGER NOT NULL,
+                n_new INTEGER NOT NULL,
+                result_count INTEGER,
+                searched_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS search_yield_arm ON search_yield (make, model, region, offset_bucket)
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @staticmethod
+    def offset_bucket(first_record:int) -> int:
+        return int(first_record) // (search_page_size * pages_per_offset_bucket)
+
+    def record(self, vehicle_info:dict, n_listings:int, n_new:int, result_count:int=None):
+        '''
+        one search results page load and what it produced
+        :param result_count: get_search_result_count of the page, None / negative if unknown
+        '''
+        first_record = int(vehicle_info.get('first_record', 0))
+        zipcode = vehicle_info.get('zipcode')
+        result_count = None if result_count is None or result_count < 0 else int(result_count)
+        self.conn.execute('''
+            INSERT INTO search_yield (make, model, zipcode, region, first_record, offset_bucket, n_listings, n_new,
+                                      result_count, searched_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (vehicle_info['make'], vehicle_info['model'], None if zipcode is None else str(zipcode),
+              zip_region(zipcode) if zipcode is not None else 0, first_record, self.offset_bucket(first_record),
+              int(n_listings), int(n_new), result_count, time.time()))
+
+    def record_results(self, vehicle_info:dict, df:pd.DataFrame, known_vehicle_ids:set) -> int:
+        '''
+        record what find_listings_for_make_model returned for vehicle_info
+        :param known_vehicle_ids: vehicle ids collected so far; updated in place
+        :return: number of new vehicle ids
+        '''
+        if len(df) == 0:
+            self.record(vehicle_info, 0, 0)
+            return 0
+        from find_vehicle_image_urls import add_vehicle_id_columns
+        vehicle_ids = set(add_vehicle_id_columns(df.copy())['vehicle_id'].dropna())
+        n_new = len(vehicle_ids - known_vehicle_ids)
+        known_vehicle_ids |= vehicle_ids
+        self.record(vehicle_info, len(vehicle_ids), n_new, int(df['result_count'].iloc[0]))
+        return n_new
+
+    def result_counts(self) -> dict:
+        '''
+        :return: (make, model) -> latest known result count
+        '''
+        rows = self.conn.execute('''
+            SELECT make, model, result_count FROM search_yield
+            WHERE id IN (SELECT MAX(id) FROM search_yield WHERE result_count IS NOT NULL GROUP BY make, model)
+        ''').fetchall()
+        return {(make, model): result_count for make, model, result_count in rows}
+
+    def arm_stats(self) -> pd.DataFrame:
+        '''
+        :return: DF with make, model, region, offset_bucket, pages, listings, new per searched arm
+        '''
+        return pd.read_sql_query('''
+            SELECT make, model, region, offset_bucket, COUNT(*) AS pages, SUM(n_listings) AS listings,
+                   SUM(n_new) AS new
+            FROM search_yield GROUP BY make, model, region, offset_bucket
+        ''', self.conn)
+
+    def candidate_arms(self) -> pd.DataFrame:
+        '''
+        every make/model/region/offset bucket that can still return listings, with its posterior
+        Gamma(alpha, beta) over new listings per page load; the posterior mean is alpha / beta
+        '''
+        result_counts = self.result_counts()
+        max_buckets = self.offset_bucket(max_first_record - 1) + 1
+        arms = []
+        for vehicle in self.vehicles:
+            result_count = result_counts.get((vehicle['make'], vehicle['model']))
+            if result_count is None:
+                n_buckets = max_buckets
+            else:
+                n_buckets = self.offset_bucket(result_count - 1) + 1 if result_count > 0 else 0
+            for bucket in range(n_buckets):
+                arms.append((vehicle['make'], vehicle['model'], bucket, result_count))
+        arms = pd.DataFrame(arms, columns=['make', 'model', 'offset_bucket', 'result_count'])
+        arms = arms.merge(pd.DataFrame({'region': np.arange(n_regions)}), how='cross')
+
+        stats = self.arm_stats().astype({'region': 'int64', 'offset_bucket': 'int64'})
+        arms = arms.merge(stats, on=['make', 'model', 'region', 'offset_bucket'], how='left')
+        arms[['pages', 'listings', 'new']] = arms[['pages', 'listings', 'new']].fillna(0).astype('float64')
+
+        ## prior: the make/model's new listings per page so far, else everybody's, else an optimistic full page
+        overall = stats['new'].sum() / stats['pages'].sum() if len(stats) > 0 else float(search_page_size)
+        by_model = stats.groupby(['make', 'model'])[['new', 'pages']].sum()
+        by_model = (by_model['new'] / by_model['pages']).rename('prior_mean').reset_index()
+        arms = arms.merge(by_model, on=['make', 'model'], how='left')
+        prior_mean = arms['prior_mean'].astype('float64').fillna(overall).clip(lower=0.5)
+        arms['alpha'] = prior_strength * prior_mean + arms['new']
+        arms['beta'] = prior_strength + arms['pages']
+        arms['expected_new'] = arms['alpha'] / arms['beta']
+        return arms.drop(columns=['prior_mean'])
+
+    def sample_location(self, region:int) -> dict:
+        '''
+        a random zip in the region
+        :return: {'zip': '92101', 'city_state_lower': 'san-diego-ca'}
+        '''
+        from geography_index import get_geography_index
+        index = get_geography_index()
+        if region not in self._region_rows:
+            self._region_rows[region] = np.flatnonzero(np.asarray(index.zip) // 10000 == region)
+        rows = self._region_rows[region]
+        if len(rows) == 0:
+            return index.sample_location()
+        return index.location(int(self.rng.choice(rows)))
+
+    def plan(self, n:int=1) -> list:
+        '''
+        :return: up to n vehicle_info dicts for find_listings_for_make_model, from n different arms
+        '''
+        arms = self.candidate_arms()
+        if len(arms) == 0:
+            return []
+        draws = self.rng.gamma(arms['alpha'].to_numpy(), 1 / arms['beta'].to_numpy())
+        chosen = arms.iloc[np.argsort(-draws)[:n]]
+
+        vehicle_infos = []
+        for arm in chosen.itertuples(index=False):
+            first_page = arm.offset_bucket * pages_per_offset_bucket
+            last_page = first_page + pages_per_offset_bucket
+            if not pd.isna(arm.result_count):
+                last_page = min(last_page, -(-int(arm.result_count) // search_page_size))
+            page = int(self.rng.integers(first_page, max(last_page, first_page + 1)))
+            location = self.sample_location(int(arm.region))
+            vehicle_infos.append({'make': arm.make, 'model': arm.model, 'zipcode': location['zip'],
+                                  'city_state_lower': location['city_state_lower'],
+                                  'first_record': page * search_page_size})
+        return vehicle_infos
+
+
+def run_planned_searches(n_searches:int, planner:SearchPlanner=None, pool=None, frontier=None,
+                         known_vehicle_ids:set=None, batch_size:int=5, sleep:float=0) -> pd.DataFrame:
+    '''
+    load n_searches search results pages picked by the planner, and feed what they return back into it
+    :param known_vehicle_ids: default every vehicle id in compile_search_results_df(); updated in place
+    :return: pd.DataFrame of all pages
+    '''
+    from find_vehicle_image_urls import find_listings_for_make_model, compile_search_results_df
+    if known_vehicle_ids is None:
+        known_vehicle_ids = set(compile_search_results_df()['vehicle_id'].dropna())
+    close = planner is None
+    planner = SearchPlanner() if planner is None else planner
+    dfs = []
+    n_done, n_new = 0, 0
+    try:
+        while n_done < n_searches:
+            vehicle_infos = planner.plan(min(batch_size, n_searches - n_done))
+            if len(vehicle_infos) == 0:
+                print('search planner - nothing left to search')
+                break
+            for vehicle_info in vehicle_infos:
+                df, _ = find_listings_for_make_model(vehicle_info, quit=pool is None, pool=pool, frontier=frontier)
+                n_new_page = planner.record_results(vehicle_info, df, known_vehicle_ids)
+                n_new += n_new_page
+                n_done += 1
+                dfs.append(df)
+                print(f'search planner - {n_done}/{n_searches} {vehicle_info["make"]} {vehicle_info["model"]} '
+                      f'zip {vehicle_info["zipcode"]} firstRecord={vehicle_info["first_record"]}: '
+                      f'{n_new_page} / {len(df)} new ({n_new} new so far)')
+                if sleep:
+                    time.sleep(sleep)
+    finally:
+        if close:
+            planner.close()
+    dfs = [df for df in dfs if len(df) > 0]
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+
+
+if __name__ == '__main__':
+    with SearchPlanner() as planner:
+        arms = planner.candidate_arms()
+        print(arms.sort_values('expected_new', ascending=False).head(20))
+        print(planner.plan(5))
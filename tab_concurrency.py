@@ -0,0 +1,310 @@
+import time
+import asyncio
+import traceback
+
+import pandas as pd
+
+from find_vehicle_image_urls import clean_vehicle_url, chrome_driver_init, block_lean_urls, build_listing_df, \
+    save_metadata_df, wait_time, scroll_distance, max_scrolls, tabs_per_browser, lean
+from image_url_collector import ImageUrlCollector
+from driver_pool import DriverPool
+from page_readiness import readiness_probe_js, quiet_period, step_timeout
+from scraper_metrics import metrics, count_buckets
+
+
+####################################
+### Settings
+poll_interval = 0.1  # seconds between checks on a tab that is still loading / settling
+max_useless_scrolls = 5  # like get_image_urls_from_view_all_media_button: stop after this many steps without new images
+####################################
+
+## tabs that are not in front must keep loading, running timers and lazy loading images like the one that is
+background_tab_arguments = [
+    '--headless=new',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+]
+
+listing_state_js = '''
+var heading = document.querySelector('h1[data-cmp="heading"]#vehicle-details-heading');
+return {
+    url: location.href,
+    readyState: document.readyState,
+    hasHeading: !!(heading && heading.offsetParent !== null)
+};
+'''
+
+click_view_all_media_js = '''
+var ps = document.querySelectorAll('p');
+for (var i = 0; i < ps.length; i++) {
+    if (ps[i].textContent.trim() === 'View All Media' && ps[i].offsetParent !== null) {
+        ps[i].click();
+        return true;
+    }
+}
+return false;
+'''
+
+## the same probe as page_readiness.scroll_step, but it returns right away instead of waiting inside the browser,
+## so the waiting can happen in python while the other tabs get their turn
+media_panel_step_js = readiness_probe_js + '''
+var el = document.querySelector("div[data-cmp='modalScrollPanel']");
+if (!el || el.offsetParent === null) { return null; }
+if (arguments[0]) { el.scrollTop += arguments[0]; }
+var s = pageState(el);
+s.drained = w.__imageUrlCollector ? w.__imageUrlCollector.drain() : [];
+return s;
+'''
+
+
+class TabBrowser:
+    '''
+    One chrome instance with n_tabs tabs, each working on its own vehicle listing.
+
+    The tabs are window handles of one classic webdriver session, not CDP targets or BiDi browsing contexts.
+    Webdriver talks to one tab at a time, so every command is a short critical section: take the lock,
+    switch to the tab, run one quick script, let go. Everything slow - page loads, lazy loading in the media panel,
+    waiting for it to settle - happens in the browser while the lock is free, so the tabs overlap.
+    With page_load_strategy 'none', driver.get returns as soon as navigation starts instead of blocking every tab.
+
+    process_listing gives the same DF (and saved output, and df.attrs['outcome']) as
+    find_vehicle_image_urls.process_vehicle_webpage. When a listing fails and the browser no longer answers
+    (DriverPool.is_healthy), it is restarted with fresh tabs before the next listing.
+
+    usage:
+        with TabBrowser(n_tabs=4) as tab_browser:
+            df = tab_browser.process_listings(urls)
+    '''
+
+    def __init__(self, n_tabs:int=tabs_per_browser, lean:bool=lean, archive=None):
+        if n_tabs < 1:
+            raise ValueError(f'n_tabs must be at least 1, got {n_tabs}')
+        self.n_tabs = n_tabs
+        self.lean = lean
+        self.archive = archive
+        self.driver = None
+        self.handles = []
+        self._launch()
+        self._lock = None  # created inside the event loop that uses it
+
+    def _launch(self):
+        with metrics.timer('driver_init_seconds', browser='chrome_tabs'):
+            self.driver = chrome_driver_init(warm_up=False, lean=self.lean, page_load_strategy='none',
+                                             extra_arguments=background_tab_arguments)
+        for _ in range(self.n_tabs - 1):
+            self.driver.switch_to.new_window('tab')
+            if self.lean:
+                block_lean_urls(self.driver)  # chrome_driver_init only set it up for the first tab
+        self.handles = list(self.driver.window_handles)
+
+    async def _restart_if_dead(self):
+        '''
+        after a failed listing: relaunch the browser if it crashed, so the remaining urls do not all fail against
+        a dead session. Tabs still working on a listing in the old browser fail on their stale handle.
+        '''
+        async with self._lock:
+            if DriverPool.is_healthy(self.driver):
+                return
+            print('tab browser - browser failed health check, restarting it')
+            metrics.inc('driver_recycles_total', reason='unhealthy', browser='chrome_tabs')
+            self.close()
+            self._launch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+            self.driver = None
+
+    async def _run(self, handle:str, function, *args):
+        '''
+        run function(driver, *args) with the driver switched to this tab, holding the lock
+        '''
+        async with self._lock:
+            if self.driver.current_window_handle != handle:
+                self.driver.switch_to.window(handle)
+            return function(self.driver, *args)
+
+    async def _wait_for(self, handle:str, script:str, condition, timeout:float, *args,
+                        collector:ImageUrlCollector=None):
+        '''
+        poll the tab with script until condition(result) holds
+        :param collector: add the image urls every poll drains to it
+        :return: the last result, and whether the condition held before timeout
+        '''
+        deadline = time.perf_counter() + timeout
+        while True:
+            result = await self._run(handle, lambda driver: driver.execute_script(script, *args))
+            if collector is not None and result is not None:
+                collector.add(result['drained'])
+            if condition(result):
+                return result, True
+            if time.perf_counter() >= deadline:
+                return result, False
+            await asyncio.sleep(poll_interval)
+
+    async def _scroll_media_panel(self, handle:str, collector:ImageUrlCollector) -> int:
+        '''
+        get_image_urls_from_view_all_media_button, one step at a time
+        :return: number of steps taken
+        '''
+        state, visible = await self._wait_for(handle, media_panel_step_js, lambda s: s is not None, wait_time, 0,
+                                              collector=collector)
+        if not visible:
+            raise TimeoutError(f'media panel not visible after {wait_time} seconds')
+        n_useless_scrolls = 0
+        i = 0
+        while i < max_scrolls:
+            i += 1
+            last_height = state['scrollHeight']
+            n_before = len(collector)
+            state = await self._run(handle, lambda driver: driver.execute_script(media_panel_step_js, scroll_distance))
+            if state is None:
+                break
+            collector.add(state['drained'])
+            ## wait for the panel to settle, without holding up the other tabs
+            await asyncio.sleep(quiet_period)
+            settled, _ = await self._wait_for(
+                handle, media_panel_step_js,
+                lambda s: s is None or (s['quietMs'] >= quiet_period * 1000 and s['inflight'] == 0),
+                step_timeout, 0, collector=collector)
+            if settled is None:
+                break
+            state = settled
+            n_useless_scrolls += int(len(collector) == n_before)
+            if n_useless_scrolls >= max_useless_scrolls:
+                print(f'the futility is unbearable {i} {n_useless_scrolls}')
+                break
+            if state['atBottom'] and state['scrollHeight'] <= last_height:
+                break
+        return i
+
+    async def process_listing(self, handle:str, url:str) -> pd.DataFrame:
+        '''
+        process_vehicle_webpage in one tab
+        '''
+        from listing_extraction import extract_listing_fields
+        url_cleaned = clean_vehicle_url(url)
+        vehicle_id = url_cleaned.split('/')[-1]
+        df = pd.DataFrame()
+        outcome = 'error'
+        try:
+            start = time.perf_counter()
+            await self._run(handle, lambda driver: driver.get(url_cleaned))
+            _, rendered = await self._wait_for(
+                handle, listing_state_js,
+                ## the tab shows the previous listing until the new one commits
+                lambda s: vehicle_id in s['url'] and s['hasHeading'] and s['readyState'] != 'loading', wait_time)
+            metrics.observe('page_load_seconds', time.perf_counter() - start, page='listing_tab')
+            if not rendered:
+                print(f'year_make_model - not visible after {wait_time} seconds [{url_cleaned}]')
+
+            page_source = await self._run(handle, lambda driver: driver.page_source)
+            with metrics.timer('extraction_seconds'):
+                fields = extract_listing_fields(page_source)
+            if fields.page_unavailable:
+                print(f' page_unavailable {fields.page_unavailable}; that is not good! [{url_cleaned}]')
+                metrics.inc('listings_total', outcome='site_unavailable', backend='tabs')
+                df.attrs['outcome'] = 'site_unavailable'
+                return df
+            for field_name in ['year_make_model', 'list_price', 'vin', 'listing_detail', 'listing_narrative',
+                               'header_image_url']:
+                field_outcome = "fail" if getattr(fields, field_name) is None else "success"
+                metrics.inc('field_extractions_total', field=field_name, outcome=field_outcome)
+
+            collector = ImageUrlCollector()
+            await self._run(handle, collector.install)
+            clicked = await self._run(handle, lambda driver: driver.execute_script(click_view_all_media_js))
+            try:
+                if not clicked:
+                    raise TimeoutError('no View All Media button')
+                start = time.perf_counter()
+                n_steps = await self._scroll_media_panel(handle, collector)
+                metrics.observe('scroll_seconds', time.perf_counter() - start, target='media_panel')
+                metrics.observe('scroll_steps', n_steps, buckets=count_buckets, target='media_panel')
+                await self._run(handle, collector.drain)
+                image_urls = collector.urls
+                metrics.inc('field_extractions_total', field='view_all_media', outcome='success')
+            except TimeoutError:
+                image_urls = []
+                metrics.inc('field_extractions_total', field='view_all_media', outcome='fail')
+
+            if fields.header_image_url is not None:
+                image_urls += [str(fields.header_image_url)]
+            if self.archive is not None:
+                await self._run(handle, lambda driver: self.archive.add_driver_page('listing', vehicle_id, driver))
+            metrics.observe('images_per_listing', len(image_urls), buckets=count_buckets)
+            print(f'[{url_cleaned}] found {len(image_urls)} images')
+
+            if len(image_urls) > 0:
+                df = build_listing_df(image_urls, url_cleaned, fields)
+                save_metadata_df(df, 'image_urls', f'{vehicle_id}.csv')
+                outcome = 'success'
+            else:
+                print(f'no images; not saving csv')
+                outcome = 'empty'
+            metrics.inc('listings_total', outcome='success' if len(df) > 0 else 'fail', backend='tabs')
+
+        except Exception as e:
+            from selenium.common.exceptions import TimeoutException
+            print(f"process_listing [{url}] Error Traceback:\n", traceback.format_exc())
+            metrics.inc('listings_total', outcome='fail', backend='tabs')
+            df = pd.DataFrame()
+            outcome = 'timeout' if isinstance(e, TimeoutException) else 'error'
+            await self._restart_if_dead()
+        df.attrs['outcome'] = outcome
+        return df
+
+    async def _tab_worker(self, index:int, queue:asyncio.Queue, dfs:list):
+        while True:
+            try:
+                url = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            ## look the handle up for every listing, the browser may have been restarted with new tabs
+            dfs.append(await self.process_listing(self.handles[index], url))
+
+    async def process_listings_async(self, urls:list) -> pd.DataFrame:
+        '''
+        In a notebook: df = await tab_browser.process_listings_async(urls)
+        '''
+        self._lock = asyncio.Lock()
+        queue = asyncio.Queue()
+        for url in urls:
+            queue.put_nowait(url)
+        dfs = []
+        await asyncio.gather(*[self._tab_worker(index, queue, dfs) for index in range(self.n_tabs)])
+        metrics.export()
+        dfs = [df for df in dfs if len(df) > 0]
+        return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+
+    def process_listings(self, urls:list) -> pd.DataFrame:
+        return asyncio.run(self.process_listings_async(urls))
+
+
+def process_vehicle_webpages_in_tabs(urls:list, n_tabs:int=tabs_per_browser, lean:bool=lean,
+                                     archive=None) -> pd.DataFrame:
+    '''
+    process_vehicle_webpage for many urls, n_tabs at a time in one browser
+    :return: DF with the same columns process_vehicle_webpage returns, for all listings
+    '''
+    with TabBrowser(n_tabs=n_tabs, lean=lean, archive=archive) as tab_browser:
+        return tab_browser.process_listings(urls)
+
+
+if __name__ == '__main__':
+    urls = [
+        'https://www.autotrader.com/cars-for-sale/vehicle/725617155',
+    ]
+    df = process_vehicle_webpages_in_tabs(urls, n_tabs=2)
+    print(df.head(1).T)
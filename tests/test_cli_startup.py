@@ -0,0 +1,52 @@
+'''
+What each main.py subcommand imports before it does any work. --help exits in argparse before a handler runs,
+so this imports the modules each handler imports, in a fresh interpreter.
+'''
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import main
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavy_modules = ['selenium', 'cv2']
+commands = ['search', 'listings', 'download', 'compile', 'stats', 'inventory']
+
+
+def loaded_heavy_modules(command:str) -> list:
+    script = f'''
+import sys, json, importlib
+import main
+for module in main.handler_modules({command!r}):
+    importlib.import_module(module)
+print(json.dumps([m for m in {heavy_modules!r} if m in sys.modules]))
+'''
+    result = subprocess.run([sys.executable, '-c', script], cwd=repo_dir, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_every_subcommand_has_a_handler():
+    for command in commands:
+        assert main.build_parser().parse_args([command]).func.__name__ == f'cmd_{command}'
+        assert len(main.handler_modules(command)) > 0
+
+
+def test_importing_main_is_cheap():
+    result = subprocess.run([sys.executable, '-c', 'import sys, main; print(sorted(set(sys.modules) & {"selenium", '
+                                                   '"cv2", "pandas"}))'],
+                            cwd=repo_dir, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+
+
+@pytest.mark.parametrize('command', ['compile', 'stats', 'inventory'])
+def test_offline_subcommands_do_not_load_the_browser(command):
+    assert loaded_heavy_modules(command) == []
+
+
+def test_star_import_keeps_the_lazy_names():
+    import find_vehicle_image_urls
+    assert set(find_vehicle_image_urls.lazy_imports) <= set(find_vehicle_image_urls.__all__)
+    assert 'process_vehicle_webpage' in find_vehicle_image_urls.__all__
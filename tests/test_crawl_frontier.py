@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from crawl_frontier import CrawlFrontier
+
+
+@pytest.fixture
+def frontier(tmp_path):
+    with CrawlFrontier(str(tmp_path / 'frontier.sqlite'), max_attempts=2) as frontier:
+        frontier._add('listing', [{'vehicle_id': '1', 'url_clean': 'https://example.com/vehicle/1'}])
+        yield frontier
+
+
+def test_stale_lease_cannot_finish_the_job(frontier):
+    stale = frontier.lease('listing', lease_seconds=0.01)
+    time.sleep(0.05)
+    current = frontier.lease('listing')
+    assert current['id'] == stale['id']
+
+    assert not frontier.complete('listing', stale)
+    assert not frontier.fail('listing', stale, 'too late')
+    assert frontier.counts('listing')['leased'] == 1
+    assert frontier.complete('listing', current)
+    assert frontier.counts('listing')['done'] == 1
+
+
+def test_expired_leases_count_towards_max_attempts(frontier):
+    for _ in range(2):
+        assert frontier.lease('listing', lease_seconds=0.01) is not None
+        time.sleep(0.05)
+    assert frontier.lease('listing') is None
+    assert frontier.counts('listing')['failed'] == 1
+
+
+def test_requeue_does_not_use_up_attempts(frontier):
+    for _ in range(5):
+        frontier.requeue('listing', frontier.lease('listing'), 'site_unavailable')
+    job = frontier.lease('listing')
+    assert job['attempts'] == 1
+    frontier.fail('listing', job, 'no images found')
+    assert frontier.counts('listing')['pending'] == 1
@@ -0,0 +1,118 @@
+'''
+ImageDownloader against a local http.server stand-in that serves fixture jpegs
+'''
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from benchmark_scraper import jpeg_bytes
+from download_images import ImageDownloader, DownloadManifest, download_manifest_filename
+
+
+class FixtureImageServer:
+    '''
+    /img/{name}.jpg -> a jpeg, after delay seconds; /broken/{name}.jpg -> half a jpeg, then the connection drops.
+    Counts requests and the most requests in flight at once.
+    '''
+
+    def __init__(self, delay:float=0):
+        self.delay = delay
+        self.n_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with server._lock:
+                    server.n_requests += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    time.sleep(server.delay)
+                    body = jpeg_bytes + self.path.encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    if self.path.startswith('/broken/'):
+                        self.wfile.write(body[:len(body) // 2])
+                        self.wfile.flush()
+                        self.close_connection = True
+                    else:
+                        self.wfile.write(body)
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def jobs(base_url:str, n:int, path:str='img') -> list:
+    return [(f'{base_url}/{path}/{k}.jpg', f'make-ford/model-f150/vehicle_id-{700000000 + k}/{k}.jpg')
+            for k in range(n)]
+
+
+def leftover_tmp_files(directory:str) -> list:
+    return [name for _, _, names in os.walk(directory) for name in names if name.endswith('.tmp')]
+
+
+@pytest.fixture
+def dest_dir(tmp_path):
+    return str(tmp_path)
+
+
+def test_downloads_every_file(dest_dir):
+    with FixtureImageServer() as server:
+        stats = ImageDownloader(dest_dir, requests_per_second=1000).run(jobs(server.base_url, 10))
+    assert stats['downloaded'] == 10 and stats['failed'] == 0
+    for url, relpath in jobs(server.base_url, 10):
+        with open(os.path.join(dest_dir, relpath), 'rb') as f:
+            assert f.read() == jpeg_bytes + url[len(server.base_url):].encode()
+    assert leftover_tmp_files(dest_dir) == []
+
+
+def test_failed_download_leaves_no_partial_file(dest_dir):
+    with FixtureImageServer() as server:
+        stats = ImageDownloader(dest_dir, requests_per_second=1000).run(jobs(server.base_url, 3, path='broken'))
+    assert stats['failed'] == 3
+    manifest = DownloadManifest(os.path.join(dest_dir, download_manifest_filename))
+    for _, relpath in jobs(server.base_url, 3, path='broken'):
+        assert not os.path.exists(os.path.join(dest_dir, relpath))
+        assert relpath not in manifest
+    manifest.close()
+    assert leftover_tmp_files(dest_dir) == []
+
+
+def test_rerun_skips_what_the_manifest_has(dest_dir):
+    with FixtureImageServer() as server:
+        ImageDownloader(dest_dir, requests_per_second=1000).run(jobs(server.base_url, 5))
+        n_requests = server.n_requests
+        stats = ImageDownloader(dest_dir, requests_per_second=1000).run(jobs(server.base_url, 8))
+    assert stats['skipped'] == 5 and stats['downloaded'] == 3
+    assert server.n_requests == n_requests + 3
+
+
+def test_connections_per_host_are_capped(dest_dir):
+    with FixtureImageServer(delay=0.1) as server:
+        downloader = ImageDownloader(dest_dir, max_workers=8, max_connections_per_host=2, requests_per_second=1000)
+        stats = downloader.run(jobs(server.base_url, 12))
+    assert stats['downloaded'] == 12
+    assert server.max_in_flight == 2
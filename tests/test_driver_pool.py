@@ -0,0 +1,48 @@
+import time
+import threading
+
+import driver_pool
+from driver_pool import DriverPool
+
+
+class FakeDriver:
+    def execute_script(self, script):
+        return 1
+
+    def quit(self):
+        pass
+
+
+class FakeMonitor:
+    def after_page(self, driver, elapsed=None, browser=None):
+        return None
+
+    def forget(self, driver):
+        pass
+
+
+def test_waiting_thread_launches_driver_after_recycle(monkeypatch):
+    monkeypatch.setattr(driver_pool, 'driver_init', lambda *args, **kwargs: FakeDriver())
+    pool = DriverPool(size=1, max_pages_per_driver=1, monitor=FakeMonitor())
+    checked_out = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with pool.checkout():
+            checked_out.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    checked_out.wait()
+
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool._acquire()), daemon=True)
+    waiter.start()
+    time.sleep(0.2)  # let the waiter block on the idle queue
+    release.set()  # the holder's driver is recycled after its one page, no driver goes back to the idle queue
+    holder.join()
+    waiter.join(timeout=5)
+    assert not waiter.is_alive()
+    assert len(got) == 1 and pool._n_live == 1
+    pool.close()
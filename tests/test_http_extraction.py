@@ -0,0 +1,56 @@
+'''
+The browser-free http backend against the benchmark fixture site: it has to give the same fields
+that process_vehicle_webpage gave with selenium before the extraction was rewritten
+(one find_element(...).text per field, cleaned with clean_text_remove_newline).
+'''
+import asyncio
+
+import pytest
+
+from benchmark_scraper import FixtureSite, fixture_image_hash
+
+## what the original selenium code returned for a fixture listing page; element.text renders the two price spans
+## on one line, the list items of listColumns on one line each, and the source newline in seeMore as a space
+def selenium_fields(vehicle_id:int) -> dict:
+    return {
+        'vin': f'1FTFW1E5{vehicle_id:09d}'[:17],
+        'year_make_model': 'Used 2021 Ford F150 XLT',
+        'list_price': 'Price $31,995',
+        'listing_details': '31,207 miles^4WD^Black exterior^Gray interior',
+        'listing_narrative': 'One owner. Clean title. Tow package.',
+    }
+
+
+def selenium_image_urls(site:FixtureSite, vehicle_id:int) -> set:
+    '''
+    the 500px urls get_image_urls_from_view_all_media_button collected from the media panel, plus the header image
+    '''
+    return {f'https://images.autotrader.com/scaler/500/375/hn/c/{fixture_image_hash(vehicle_id, k)}.jpg'
+            for k in range(site.n_images)} | {f'{site.base_url}/img/header-{vehicle_id}.jpg'}
+
+
+@pytest.fixture(scope='module')
+def site():
+    with FixtureSite(n_listings=3, n_images=5) as site:
+        yield site
+
+
+def test_http_fields_match_selenium(site):
+    from http_extraction import process_vehicle_webpages_async
+    urls = [site.vehicle_url(vehicle_id) for vehicle_id in site.vehicle_ids]
+    df, fallback_urls = asyncio.run(process_vehicle_webpages_async(urls, save=False))
+
+    assert fallback_urls == []
+    for vehicle_id in site.vehicle_ids:
+        df_page = df[df['vehicle_id'] == str(vehicle_id)]
+        assert len(df_page) > 0
+        for column, expected in selenium_fields(vehicle_id).items():
+            assert df_page[column].unique().tolist() == [expected], column
+        assert set(df_page['vehicle_image_url']) == selenium_image_urls(site, vehicle_id)
+
+
+def test_unavailable_page_falls_back_to_the_browser():
+    from http_extraction import extract_listing_fields_http, needs_browser
+    fields, image_urls = extract_listing_fields_http('<html><body>The site is currently unavailable</body></html>')
+    assert fields.page_unavailable
+    assert needs_browser(fields, image_urls)
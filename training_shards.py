@@ -0,0 +1,238 @@
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from find_vehicle_image_urls import parent_directory_images, training_shards_dir, get_vehicle_make_model_list
+
+
+####################################
+### Settings
+image_size = 224  # shards hold image_size x image_size RGB images
+images_per_shard = 1024
+####################################
+
+shards_version = 1
+label_columns = ['make', 'model', 'body_style']
+
+
+def list_image_files(images_dir:str=parent_directory_images) -> pd.DataFrame:
+    '''
+    :return: DF with relpath, make, model, vehicle_id for every jpg in the make-*/model-*/vehicle_id-* tree
+    '''
+    rows = []
+    with os.scandir(images_dir) as makes:
+        for make_entry in makes:
+            if not (make_entry.is_dir() and make_entry.name.startswith('make-')):
+                continue
+            with os.scandir(make_entry.path) as models:
+                for model_entry in models:
+                    if not (model_entry.is_dir() and model_entry.name.startswith('model-')):
+                        continue
+                    with os.scandir(model_entry.path) as vehicles:
+                        for vehicle_entry in vehicles:
+                            if not (vehicle_entry.is_dir() and vehicle_entry.name.startswith('vehicle_id-')):
+                                continue
+                            with os.scandir(vehicle_entry.path) as images:
+                                for image_entry in images:
+                                    if image_entry.name.endswith('.jpg'):
+                                        rows.append((os.path.relpath(image_entry.path, images_dir),
+                                                     make_entry.name[len('make-'):],
+                                                     model_entry.name[len('model-'):],
+                                                     int(vehicle_entry.name[len('vehicle_id-'):])))
+    return pd.DataFrame(rows, columns=['relpath', 'make', 'model', 'vehicle_id'])
+
+
+def load_image(filepath:str, size:int=image_size) -> np.ndarray:
+    '''
+    :return: size x size x 3 uint8 RGB array, or None if the file can not be decoded
+    '''
+    import cv2
+    image = cv2.imread(filepath, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def write_shard(shard_path:str, filepaths:list, size:int=image_size) -> dict:
+    '''
+    runs in a worker process: decode and resize filepaths into one .npy shard
+    Images that fail to decode are left out, the shard only holds the ones that worked.
+    :return: which files made it in, plus per-channel sums for the dataset mean / std
+    '''
+    tmp_path = f'{shard_path}.{os.getpid()}.tmp.npy'
+    shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(filepaths), size, size, 3))
+    ok = np.zeros(len(filepaths), dtype=bool)
+    channel_sum = np.zeros(3, dtype=np.float64)
+    channel_sum_sq = np.zeros(3, dtype=np.float64)
+    n = 0
+    for i, filepath in enumerate(filepaths):
+        image = load_image(filepath, size)
+        if image is None:
+            continue
+        shard[n] = image
+        pixels = image.reshape(-1, 3).astype(np.float64)
+        channel_sum += pixels.sum(axis=0)
+        channel_sum_sq += (pixels ** 2).sum(axis=0)
+        ok[i] = True
+        n += 1
+    shard.flush()
+    if n < len(filepaths):
+        ## rare: rewrite without the empty slots at the end
+        np.save(shard_path, np.asarray(shard[:n]))
+        del shard
+        os.remove(tmp_path)
+    else:
+        del shard
+        os.replace(tmp_path, shard_path)
+    return {'ok': ok, 'channel_sum': channel_sum, 'channel_sum_sq': channel_sum_sq, 'n_pixels': n * size * size}
+
+
+def build_shards(output_dir:str=training_shards_dir, images_dir:str=parent_directory_images, size:int=image_size,
+                 images_per_shard:int=images_per_shard, n_workers:int=None, seed:int=0) -> dict:
+    '''
+    Decode every image once, into fixed-shape uint8 shards that training can memory-map.
+
+    Images are shuffled before being split into shards, so that contiguous reads from a shard are already
+    a mix of makes / models / vehicles.
+
+    output_dir gets:
+    - shard-00000.npy, ...: uint8 arrays of shape (n, size, size, 3), RGB
+    - one .npy per label: make, model, body_style (int32 codes), vehicle_id (int64),
+      shard, offset (int32); row i of the labels is image `offset` of shard `shard`
+    - index.csv: the same, readable, with the source relpath
+    - meta.json: categories for each label, image size, per-channel mean / std (0-255 scale)
+    '''
+    df = list_image_files(images_dir)
+    body_styles = {(v['make'], v['model']): v['body_style'] for v in get_vehicle_make_model_list()}
+    df['body_style'] = [body_styles.get(key, 'unknown') for key in zip(df['make'], df['model'])]
+    df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    df['shard'] = (np.arange(len(df)) // images_per_shard).astype(np.int32)
+    print(f'training shards - {len(df)} images into {df["shard"].nunique()} shards of {images_per_shard}')
+
+    os.makedirs(output_dir, exist_ok=True)
+    shard_names = [f'shard-{shard:05d}.npy' for shard in range(df['shard'].nunique())]
+    filepaths = [[os.path.join(images_dir, relpath) for relpath in group['relpath']]
+                 for _, group in df.groupby('shard', sort=True)]
+
+    start = time.time()
+    ok = []
+    channel_sum, channel_sum_sq, n_pixels = np.zeros(3), np.zeros(3), 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(write_shard, [os.path.join(output_dir, name) for name in shard_names], filepaths,
+                               [size] * len(shard_names))
+        for shard_name, result in zip(shard_names, results):
+            ok.append(result['ok'])
+            channel_sum += result['channel_sum']
+            channel_sum_sq += result['channel_sum_sq']
+            n_pixels += result['n_pixels']
+            print(f'{shard_name} - {int(result["ok"].sum())} images, {time.time() - start:.0f}s')
+
+    df = df[np.concatenate(ok) if len(ok) > 0 else np.zeros(0, dtype=bool)].reset_index(drop=True)
+    df['offset'] = df.groupby('shard').cumcount().astype(np.int32)
+    mean = channel_sum / max(n_pixels, 1)
+    std = np.sqrt(np.maximum(channel_sum_sq / max(n_pixels, 1) - mean ** 2, 0))
+
+    categories = {}
+    for column in label_columns:
+        codes = df[column].astype('category')
+        categories[column] = codes.cat.categories.tolist()
+        np.save(os.path.join(output_dir, f'{column}.npy'), codes.cat.codes.to_numpy().astype(np.int32))
+    np.save(os.path.join(output_dir, 'vehicle_id.npy'), df['vehicle_id'].to_numpy(dtype=np.int64))
+    np.save(os.path.join(output_dir, 'shard.npy'), df['shard'].to_numpy(dtype=np.int32))
+    np.save(os.path.join(output_dir, 'offset.npy'), df['offset'].to_numpy(dtype=np.int32))
+    df.to_csv(os.path.join(output_dir, 'index.csv'), index=False)
+
+    meta = {
+        'version': shards_version,
+        'image_size': size,
+        'n_images': len(df),
+        'shards': shard_names,
+        'categories': categories,
+        'mean': mean.tolist(),
+        'std': std.tolist(),
+    }
+    ## meta last, so a half-built directory is never considered valid
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f'training shards - {len(df)} images written in {time.time() - start:.0f}s')
+    return meta
+
+
+class TrainingShards:
+    '''
+    Read side of build_shards: every shard and label array is memory-mapped, nothing is loaded up front.
+
+    usage:
+        shards = TrainingShards()
+        for images, labels in shards.iter_batches(batch_size=64, label='model', seed=epoch):
+            ...  # images: (64, 224, 224, 3) uint8 view into a shard, labels: (64,) int32
+    '''
+
+    def __init__(self, directory:str=training_shards_dir):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.shards = [np.load(os.path.join(directory, name), mmap_mode='r') for name in self.meta['shards']]
+        self.labels = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                       for name in label_columns + ['vehicle_id', 'shard', 'offset']}
+        ## label rows are in shard order, so each shard is one contiguous range of them
+        self.shard_starts = np.concatenate([[0], np.cumsum([len(shard) for shard in self.shards])]).astype(np.int64)
+        self.mean = np.asarray(self.meta['mean'], dtype=np.float32)
+        self.std = np.asarray(self.meta['std'], dtype=np.float32)
+
+    def __len__(self) -> int:
+        return int(self.shard_starts[-1])
+
+    @property
+    def categories(self) -> dict:
+        return self.meta['categories']
+
+    def __getitem__(self, i:int) -> tuple:
+        '''
+        :return: (image, {label: value}) of image i
+        '''
+        shard, offset = int(self.labels['shard'][i]), int(self.labels['offset'][i])
+        return self.shards[shard][offset], {name: self.labels[name][i] for name in label_columns + ['vehicle_id']}
+
+    def iter_batches(self, batch_size:int=64, label:str='model', shuffle:bool=True, seed:int=None,
+                     drop_last:bool=False):
+        '''
+        Yield (images, labels) batches that are views into the memory-mapped shards, without copying.
+
+        Shuffling is by block: the order of shards and of batch_size blocks within each shard is random,
+        the images within a block stay together. Since build_shards shuffled the images before writing,
+        a block is still a random mix, and reads stay sequential.
+        '''
+        rng = np.random.default_rng(seed)
+        shard_order = rng.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+        label_values = self.labels[label]
+        for shard_index in shard_order:
+            shard = self.shards[shard_index]
+            starts = np.arange(0, len(shard), batch_size)
+            if shuffle:
+                starts = rng.permutation(starts)
+            label_start = self.shard_starts[shard_index]
+            for start in starts:
+                stop = min(start + batch_size, len(shard))
+                if drop_last and stop - start < batch_size:
+                    continue
+                yield shard[start:stop], label_values[label_start + start:label_start + stop]
+
+    def normalize(self, images:np.ndarray) -> np.ndarray:
+        '''
+        :return: float32 copy, per-channel standardized with the dataset mean / std
+        '''
+        return (images.astype(np.float32) - self.mean) / self.std
+
+
+if __name__ == '__main__':
+    build_shards()
+    shards = TrainingShards()
+    start = time.time()
+    n = sum(len(images) for images, _ in shards.iter_batches(batch_size=256))
+    print(f'read {n} images in {time.time() - start:.1f}s')